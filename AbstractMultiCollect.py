@@ -7,8 +7,10 @@ import errno
 import abc
 import collections
 import gevent
+import gevent.queue
 import autoprocessing
-import gevent
+import snapshot_service
+import timings
 from HardwareRepository.TaskUtils import *
 
 BeamlineControl = collections.namedtuple('BeamlineControl',
@@ -46,6 +48,56 @@ BeamlineConfig = collections.namedtuple('BeamlineConfig',
                                          'input_files_server'])
 
 
+class FramePipeline(object):
+    """
+    Background stage for the per-frame bookkeeping of a data collection
+    (LIMS image records, jpeg generation, signals, auto processing).
+
+    Jobs are executed by a single worker greenlet in submission order.
+    At most <depth> jobs can be pending: put() blocks when the stage is
+    full, which throttles the acquisition loop if bookkeeping cannot keep
+    up. A depth of 0 executes every job synchronously in put().
+    """
+    def __init__(self, depth=0):
+        self.depth = max(0, int(depth))
+        self._queue = None
+        self._worker = None
+
+        if self.depth > 0:
+            self._queue = gevent.queue.Queue(self.depth)
+            self._worker = gevent.spawn(self._run)
+
+
+    def put(self, fun, *args, **kwargs):
+        if self._worker is None or self._worker.dead:
+            return fun(*args, **kwargs)
+        self._queue.put((fun, args, kwargs))
+
+
+    def pending(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+
+    def _run(self):
+        for fun, args, kwargs in self._queue:
+            try:
+                fun(*args, **kwargs)
+            except:
+                logging.getLogger("HWR").exception("Error in frame bookkeeping")
+
+
+    def join(self, timeout=None):
+        """Waits for all pending jobs to be done and stops the worker"""
+        if self._worker is not None and not self._worker.dead:
+            self._queue.put(StopIteration)
+            self._worker.join(timeout)
+
+
+    def abort(self):
+        if self._worker is not None:
+            self._worker.kill(block=False)
+
+
 class AbstractMultiCollect(object):
     __metaclass__ = abc.ABCMeta
 
@@ -55,6 +107,7 @@ class AbstractMultiCollect(object):
         self.data_collect_task = None
         self.oscillations_history = []
         self.current_lims_sample = None
+        self.current_snapshots = []
         self.__safety_shutter_close_task = None
 
 
@@ -405,6 +458,8 @@ class AbstractMultiCollect(object):
 
     @task
     def do_collect(self, owner, data_collect_parameters):
+        laps = timings.laps("collect")
+
         if self.__safety_shutter_close_task is not None:
             self.__safety_shutter_close_task.kill()
 
@@ -412,6 +467,7 @@ class AbstractMultiCollect(object):
 
         # reset collection id on each data collect
         self.collection_id = None
+        self.current_snapshots = []
 
         # Preparing directory path for images and processing files
         # creating image file template and jpegs files templates
@@ -432,6 +488,7 @@ class AbstractMultiCollect(object):
         else:
           jpeg_file_template = None
           jpeg_thumbnail_file_template = None
+        laps.lap("prepare")
          
         # database filling
         if self.bl_control.lims:
@@ -447,11 +504,13 @@ class AbstractMultiCollect(object):
 
             if detector_id:
                 data_collect_parameters['detector_id'] = detector_id
+        laps.lap("lims_store")
               
         # Creating the directory for images and processing information
         self.create_directories(file_parameters['directory'],  file_parameters['process_directory'])
         self.xds_directory, self.mosflm_directory, self.hkl2000_directory = self.prepare_input_files(file_parameters["directory"], file_parameters["prefix"], file_parameters["run_number"], file_parameters['process_directory'])
         data_collect_parameters['xds_dir'] = self.xds_directory
+        laps.lap("directories")
 
 	sample_id, sample_location, sample_code = self.get_sample_info_from_parameters(data_collect_parameters)
         data_collect_parameters['blSampleId'] = sample_id
@@ -479,13 +538,17 @@ class AbstractMultiCollect(object):
         positions_str = " ".join([motor+"="+("None" if pos is None else "%f" % pos) for motor, pos in motors_to_move_before_collect.iteritems()])
         data_collect_parameters['actualCenteringPosition'] = positions_str
         ###
+        laps.restart()
         self.move_motors(motors_to_move_before_collect)
+        laps.lap("move_motors")
 
         # take snapshots, then assign centring status (which contains images) to centring_info variable
         self._take_crystal_snapshots(data_collect_parameters.get("take_snapshots", False))
         centring_info = self.bl_control.diffractometer.getCentringStatus()
+        laps.lap("snapshots")
         # move *again* motors, since taking snapshots may change positions
         self.move_motors(motors_to_move_before_collect)
+        laps.lap("move_motors")
 
         if self.bl_control.lims:
           try:
@@ -494,53 +557,46 @@ class AbstractMultiCollect(object):
               self.bl_control.lims.update_bl_sample(self.current_lims_sample)
           except:
             logging.getLogger("HWR").exception("Could not update sample infromation in LIMS")
+        laps.lap("lims_sample")
 
         if centring_info.get('images'):
-          # Save snapshots
+          # Save snapshots: the archive files are written in the
+          # background, their paths are given to LIMS right away; the
+          # ones that could not be written are cleared at the end of the
+          # collection (see store_snapshot_paths)
           snapshot_directory = self.get_archive_directory(file_parameters["directory"])
           logging.getLogger("HWR").debug("Snapshot directory is %s" % snapshot_directory)
 
-          try:
-            self.create_directories(snapshot_directory)
-          except:
-              logging.getLogger("HWR").exception("Error creating snapshot directory")
-          else:
-              snapshot_i = 1
-              snapshots = []
-              for img in centring_info["images"]:
-                img_phi_pos = img[0]
-                img_data = img[1]
-                snapshot_filename = "%s_%s_%s.snapshot.jpeg" % (file_parameters["prefix"],
-                                                                file_parameters["run_number"],
-                                                                snapshot_i)
-                full_snapshot = os.path.join(snapshot_directory,
-                                             snapshot_filename)
-
-                try:
-                  f = open(full_snapshot, "w")
-                  f.write(img_data)
-                except:
-                  logging.getLogger("HWR").exception("Could not save snapshot!")
-                  try:
-                    f.close()
-                  except:
-                    pass
-
-                data_collect_parameters['xtalSnapshotFullPath%i' % snapshot_i] = full_snapshot
+          snapshot_writer = snapshot_service.get_writer()
+          for snapshot_i, img in enumerate(centring_info["images"], 1):
+            img_phi_pos = img[0]
+            img_data = img[1]
+            snapshot_filename = "%s_%s_%s.snapshot.jpeg" % (file_parameters["prefix"],
+                                                            file_parameters["run_number"],
+                                                            snapshot_i)
+            full_snapshot = os.path.join(snapshot_directory,
+                                         snapshot_filename)
 
-                snapshots.append(full_snapshot)
-                snapshot_i+=1
+            try:
+              snapshot_writer.write(full_snapshot, img_data)
+            except:
+              logging.getLogger("HWR").exception("Could not save snapshot!")
+            else:
+              data_collect_parameters['xtalSnapshotFullPath%i' % snapshot_i] = full_snapshot
+              self.current_snapshots.append(('xtalSnapshotFullPath%i' % snapshot_i, full_snapshot))
 
           try:
             data_collect_parameters["centeringMethod"] = centring_info['method']
           except:
             data_collect_parameters["centeringMethod"] = None
+        laps.lap("snapshot_files")
 
         if self.bl_control.lims:
             try:
                 self.bl_control.lims.update_data_collection(data_collect_parameters)
             except:
                 logging.getLogger("HWR").exception("Could not update data collection in LIMS")
+        laps.lap("lims_update")
 
         oscillation_parameters = data_collect_parameters["oscillation_sequence"][0]
         sample_id = data_collect_parameters['blSampleId']
@@ -595,7 +651,11 @@ class AbstractMultiCollect(object):
         # 0: software binned, 1: unbinned, 2:hw binned
         self.set_detector_mode(data_collect_parameters["detector_mode"])
 
-        with cleanup(self.data_collection_cleanup):
+        frame_pipeline = FramePipeline(self.get_frame_pipeline_depth())
+        frame_laps = timings.laps("collect.frame")
+        laps.lap("setup")
+
+        with cleanup(self.data_collection_cleanup), error_cleanup(frame_pipeline.abort):
             if not self.safety_shutter_opened():
                 self.open_safety_shutter(timeout=10)
 
@@ -637,8 +697,8 @@ class AbstractMultiCollect(object):
 
                     logging.info("Updating data collection in ISPyB")
 
-                    self.bl_control.lims.update_data_collection(data_collect_parameters, wait=True)
-                    logging.info("Done")
+                    # written in the background, the collection only needs the id
+                    self.bl_control.lims.update_data_collection(data_collect_parameters)
                   except:
                     logging.getLogger("HWR").exception("Could not store data collection into LIMS")
 
@@ -647,6 +707,11 @@ class AbstractMultiCollect(object):
 
             # at this point input files should have been written           
             if data_collect_parameters.get("processing", False)=="True":
+                # processing reads the data collection from LIMS
+                if self.bl_control.lims and hasattr(self.bl_control.lims, "wait_data_collection_updated"):
+                    if not self.bl_control.lims.wait_data_collection_updated(self.collection_id, timeout=10):
+                        logging.getLogger("HWR").warning("Data collection not yet updated in LIMS")
+
                 self.trigger_auto_processing("before",
                                        self.xds_directory,
                                        data_collect_parameters["EDNA_files_dir"],
@@ -655,6 +720,7 @@ class AbstractMultiCollect(object):
                                        data_collect_parameters["do_inducedraddam"],
                                        data_collect_parameters.get("sample_reference", {}).get("spacegroup", ""),
                                        data_collect_parameters.get("sample_reference", {}).get("cell", ""))
+            laps.lap("start")
  
             for start, wedge_size in wedges_to_collect:
                 self.prepare_acquisition(1 if data_collect_parameters.get("dark", 0) else 0,
@@ -669,6 +735,7 @@ class AbstractMultiCollect(object):
                 i = 0
                 j = wedge_size
                 while j > 0: 
+                  frame_laps.restart()
                   frame_start = start+i*osc_range
                   i+=1
 
@@ -684,38 +751,26 @@ class AbstractMultiCollect(object):
 
                   self.set_detector_filenames(frame, frame_start, str(file_path), str(jpeg_full_path), str(jpeg_thumbnail_full_path))
                   osc_start, osc_end = self.prepare_oscillation(frame_start, osc_range, exptime, npass)
+                  frame_laps.lap("prepare")
 
                   with error_cleanup(self.reset_detector):
                       self.start_acquisition(exptime, npass, j == wedge_size)
                       self.do_oscillation(osc_start, osc_end, exptime, npass)
                       self.stop_acquisition()
                       self.write_image(j == 1)
+                      frame_laps.lap("oscillation")
                                      
-                      # Store image in lims
-                      if self.bl_control.lims:
-                        if self.store_image_in_lims(frame, j == wedge_size, j == 1):
-                          lims_image={'dataCollectionId': self.collection_id,
-                                      'fileName': filename,
-                                      'fileLocation': file_location,
-                                      'imageNumber': frame,
-                                      'measuredIntensity': self.get_measured_intensity(),
-                                      'synchrotronCurrent': self.get_machine_current(),
-                                      'machineMessage': self.get_machine_message(),
-                                      'temperature': self.get_cryo_temperature()}
-
-                          if archive_directory:
-                            lims_image['jpegFileFullPath'] = jpeg_full_path
-                            lims_image['jpegThumbnailFileFullPath'] = jpeg_thumbnail_full_path
-
-                          try:
-                              self.bl_control.lims.store_image(lims_image)
-                          except:
-                              logging.getLogger("HWR").exception("Could not store store image in LIMS")
-                          
-                          self.generate_image_jpeg(str(file_path), str(jpeg_full_path), str(jpeg_thumbnail_full_path),wait=False)
-                
+                      # Store image in lims, generate jpegs and trigger
+                      # processing (in the background if pipelined); the
+                      # beam and sample conditions are read now, at
+                      # acquisition
+                      if self.bl_control.lims and self.store_image_in_lims(frame, j == wedge_size, j == 1):
+                          frame_pipeline.put(self.store_frame_in_lims, frame, filename, file_location,
+                                             str(file_path), jpeg_full_path, jpeg_thumbnail_full_path,
+                                             archive_directory, self.get_frame_conditions())
+
                       if data_collect_parameters.get("processing", False)=="True":
-                        self.trigger_auto_processing("image",
+                        frame_pipeline.put(self.trigger_auto_processing, "image",
                                                      self.xds_directory, 
                                                      data_collect_parameters["EDNA_files_dir"],
                                                      data_collect_parameters["anomalous"],
@@ -725,13 +780,13 @@ class AbstractMultiCollect(object):
                                                      data_collect_parameters.get("sample_reference", {}).get("cell", ""))
 
                       if data_collect_parameters.get("shutterless"):
-			  while self.last_image_saved() == 0:
+                          while self.last_image_saved() == 0:
                             time.sleep(exptime)
                           
                           time.sleep(exptime*wedge_size/100.0)
                           last_image_saved = self.last_image_saved()
                           frame = max(start_image_number+1, start_image_number+last_image_saved-1)
-                          self.emit("collectImageTaken", frame)
+                          frame_pipeline.put(self.emit, "collectImageTaken", frame)
                           new_j = wedge_size - last_image_saved
                           if new_j < 1 and j > 1:
                               # make sure to do finalization
@@ -740,10 +795,94 @@ class AbstractMultiCollect(object):
                               j = new_j
                       else:
                           j -= 1
-                          self.emit("collectImageTaken", frame)
+                          frame_pipeline.put(self.emit, "collectImageTaken", frame)
                           frame += 1
+                      frame_laps.lap("bookkeeping")
+
+            # wait for the bookkeeping of the last frames
+            laps.restart()
+            frame_pipeline.join()
+            laps.lap("pipeline_join")
+
+            if self.bl_control.lims and hasattr(self.bl_control.lims, "flush_images"):
+                try:
+                    self.bl_control.lims.flush_images()
+                except:
+                    logging.getLogger("HWR").exception("Could not store images in LIMS")
+
+
+    def get_frame_pipeline_depth(self):
+        """
+        Returns the number of frames whose bookkeeping can be pending
+        while the next frames are acquired ("frame_pipeline_depth"
+        property), 0 means synchronous per-frame bookkeeping
+        """
+        try:
+            return max(0, int(self.getProperty("frame_pipeline_depth") or 0))
+        except (TypeError, ValueError, AttributeError):
+            return 0
+
+
+    def get_frame_conditions(self):
+        """
+        Beam and sample conditions stored in LIMS with a frame, to be read
+        when the frame is acquired
+        """
+        return {'measuredIntensity': self.get_measured_intensity(),
+                'synchrotronCurrent': self.get_machine_current(),
+                'machineMessage': self.get_machine_message(),
+                'temperature': self.get_cryo_temperature()}
+
+
+    def store_frame_in_lims(self, frame, filename, file_location, file_path,
+                            jpeg_full_path, jpeg_thumbnail_full_path, archive_directory,
+                            frame_conditions=None):
+        lims_image={'dataCollectionId': self.collection_id,
+                    'fileName': filename,
+                    'fileLocation': file_location,
+                    'imageNumber': frame}
+        if frame_conditions is None:
+            frame_conditions = self.get_frame_conditions()
+        lims_image.update(frame_conditions)
+
+        if archive_directory:
+          lims_image['jpegFileFullPath'] = jpeg_full_path
+          lims_image['jpegThumbnailFileFullPath'] = jpeg_thumbnail_full_path
+
+        try:
+            if hasattr(self.bl_control.lims, "queue_image"):
+                self.bl_control.lims.queue_image(lims_image)
+            else:
+                self.bl_control.lims.store_image(lims_image)
+        except:
+            logging.getLogger("HWR").exception("Could not store store image in LIMS")
+
+        self.generate_image_jpeg(file_path, str(jpeg_full_path), str(jpeg_thumbnail_full_path),wait=False)
 
                 
+    def store_snapshot_paths(self, data_collect_parameters, timeout=5):
+        """
+        Clears in <data_collect_parameters> the paths of the snapshots of
+        the current collection that could not be written (their paths
+        were given to LIMS when the collection started). Waits at most
+        <timeout> seconds for the writes still pending, the snapshots
+        still not written after that keep their paths.
+        """
+        if not self.current_snapshots:
+            return
+
+        snapshot_writer = snapshot_service.get_writer()
+        if not snapshot_writer.join(timeout):
+            logging.getLogger("HWR").warning("Snapshots still being written: %s",
+                                             ", ".join(snapshot_writer.pending()))
+
+        pending = snapshot_writer.pending()
+        for key, snapshot in self.current_snapshots:
+            if snapshot not in pending and snapshot_writer.failed(snapshot):
+                data_collect_parameters[key] = None
+        self.current_snapshots = []
+
+
     @task
     def loop(self, owner, data_collect_parameters_list):
         failed_msg = "Data collection failed!"
@@ -795,6 +934,8 @@ class AbstractMultiCollect(object):
                                                       "reference_interval" in data_collect_parameters["oscillation_sequence"][0],
                                                       data_collect_parameters["do_inducedraddam"]))
   
+                self.store_snapshot_paths(data_collect_parameters)
+
                 if self.bl_control.lims:    
                   data_collect_parameters["flux_end"]=self.get_flux()
                   try:
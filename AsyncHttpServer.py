@@ -26,6 +26,12 @@ Features this version offers:
 9. Doesn't try to open reserved names on Windows.
 10. Has a tuning mechanism to change buffer performance depending on small
     or large files.
+11. HTTP/1.1 keep-alive connections, with a limit on pipelined requests.
+12. Range requests, ETag/Last-Modified conditional GET, and sendfile()
+    transfer of regular files when available (os.sendfile or the
+    pysendfile module).
+13. Live MJPEG streams (multipart/x-mixed-replace) of the video hardware
+    objects, see MJPEGStream and Server.add_stream.
 
 For most people, one can run this from the command line and get a reasonably
 functioning web server with minor issue.
@@ -45,8 +51,9 @@ tended to hang below 10% processor utilization.
 There exists a live host running this web server: nada.ics.uci.edu
 """
 
-import asynchat, asyncore, socket, BaseHTTPServer
-import sys, cgi, cStringIO, os, traceback, zlib, optparse
+import asynchat, asyncore, socket, BaseHTTPServer, SimpleHTTPServer
+import sys, cgi, cStringIO, os, traceback, zlib, optparse, time, errno
+from email.utils import parsedate_tz, mktime_tz
 
 __version__ = ".4.1"
 
@@ -99,6 +106,14 @@ except:
         def __len__(self):
             return self.right - self.left
 
+try:
+    sendfile = os.sendfile
+except AttributeError:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
 reserved_names = dict.fromkeys(('com1 com2 com3 com4 com5 com6 com7 com8 com9 '
                                 'lpt1 lpt2 lpt3 lpt4 lpt5 lpt6 lpt7 lpt8 lpt9 '
                                 'con nul prn').split())
@@ -127,6 +142,51 @@ class writewrapper(object):
                 buf.append(data[i:i+BS])
             if xtra:
                 buf.append(data[-xtra:])
+
+#end of a response on a keep-alive connection (None closes the connection)
+KEEP_ALIVE = ()
+
+class FileRange(object):
+    """Part of an open file, from <offset> and of <length> bytes"""
+    def __init__(self, f, offset, length):
+        self.f = f
+        self.offset = offset
+        self.length = length
+        self.remaining = length
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def read(self, size):
+        self.f.seek(self.offset)
+        data = self.f.read(min(size, self.remaining))
+        self.offset += len(data)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+def parse_range(header, size):
+    """(first, last) byte positions of a single range "bytes=..." header,
+    None if the header is not supported (multiple ranges), raises
+    ValueError if the range cannot be satisfied"""
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            #suffix range: last <n> bytes
+            first, last = max(size - int(last), 0), size - 1
+        else:
+            first = int(first)
+            last = last and min(int(last), size - 1) or size - 1
+    except ValueError:
+        return None
+    if first > last or first >= size:
+        raise ValueError("unsatisfiable range %r" % header)
+    return first, last
 #
 class ParseHeaders(dict):
     if 1:
@@ -147,7 +207,69 @@ class ParseHeaders(dict):
     def get(self,key,default=""):
         return self._ci_dict.get(key.lower(),default)
 #
-class RequestHandler(asynchat.async_chat, BaseHTTPServer.BaseHTTPRequestHandler):
+def encode_jpeg(image, quality=80):
+    """JPEG data of a video image: JPEG string, as sent by the JPEG
+    cameras, or QImage"""
+    if isinstance(image, str):
+        return image
+    import qt
+    buf = qt.QBuffer()
+    buf.open(qt.IO_WriteOnly)
+    image.save(buf, "JPEG", quality)
+    buf.close()
+    return str(buf.buffer())
+
+class MJPEGStream(object):
+    """Live JPEG stream, served to any number of clients as a
+    multipart/x-mixed-replace response (see Server.add_stream).
+
+    Images are given by publish() or by the "imageReceived" signal of a
+    video hardware object (connect_video). Only the latest image is kept:
+    it is encoded once, when the first client needs it, and the same
+    multipart chunk is sent to all clients. A client gets the next frame
+    once the previous one is sent, and at most <max_fps> frames per
+    second (or less, with a "fps" query parameter); the frames published
+    in between are dropped for this client, so a slow client never
+    accumulates frames in its outgoing queue.
+
+    Frames are pulled by the asyncore loop, which should run with a
+    timeout shorter than 1/max_fps."""
+    boundary = "mjpegframe"
+
+    def __init__(self, max_fps=10, encoder=encode_jpeg):
+        self.max_fps = max_fps
+        self.encoder = encoder
+        self.clients = set()
+        self.sequence = 0
+        self.encoded_frames = 0
+        self._image = None
+        self._part = None
+
+    def content_type(self):
+        return "multipart/x-mixed-replace; boundary=%s" % self.boundary
+
+    def publish(self, image):
+        self.sequence += 1
+        self._image = image
+        self._part = None
+
+    def connect_video(self, video_hwobj):
+        video_hwobj.connect("imageReceived", self._image_received)
+
+    def _image_received(self, image, *args):
+        self.publish(image)
+
+    def part(self):
+        """Multipart chunk of the latest image, encoded on the first call"""
+        if self._part is None and self._image is not None:
+            jpeg = self.encoder(self._image)
+            self._image = None
+            self._part = "--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n%s\r\n" % \
+                         (self.boundary, len(jpeg), jpeg)
+            self.encoded_frames += 1
+        return self._part
+#
+class RequestHandler(asynchat.async_chat, SimpleHTTPServer.SimpleHTTPRequestHandler):
     if 1:
         server_version = "BaseAsyncHTTPServer/"+__version__
         protocol_version = "HTTP/1.1"
@@ -159,9 +281,25 @@ class RequestHandler(asynchat.async_chat, BaseHTTPServer.BaseHTTPRequestHandler)
         #sent.
         use_buffer = False
         use_favicon = True
+        use_sendfile = True
+
+        #responses not sent yet before the connection stops reading new
+        #requests, and number of requests on one keep-alive connection
+        max_pipelined_requests = 8
+        max_keepalive_requests = 100
+
+        #consecutive small strings (headers, short bodies) are sent in one
+        #send() call, up to this size
+        coalesce_size = 65536
     
     def __init__(self, conn, addr, server):
         asynchat.async_chat.__init__(self,conn)
+        # responses are sent in several parts: without this, the client
+        # delayed ACK stalls each response of a keep-alive connection
+        try:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except socket.error:
+            pass
         self.client_address = addr
         self.connection = conn
         self.server = server
@@ -176,6 +314,13 @@ class RequestHandler(asynchat.async_chat, BaseHTTPServer.BaseHTTPRequestHandler)
         self.found_terminator = self.handle_request_line
         self.request_version = "HTTP/1.1"
         self.code = None
+        self.stream = None
+        self.stream_sequence = 0
+        self.stream_interval = 0
+        self.stream_last_sent = 0
+        self.requests = 0
+        self.pending_responses = 0
+        self.close_connection = 1
         # buffer the response and headers to avoid several calls to select()
 
     def update_b(self, fsize):
@@ -203,6 +348,9 @@ class RequestHandler(asynchat.async_chat, BaseHTTPServer.BaseHTTPRequestHandler)
         """Called when a POST request body has been read"""
         self.rfile = cStringIO.StringIO(''.join(popall(self.incoming)))
         self.rfile.seek(0)
+        # the next data is a new request
+        self.set_terminator('\r\n\r\n')
+        self.found_terminator = self.handle_request_line
         self.do_POST()
             
     def do_GET(self):
@@ -215,6 +363,17 @@ class RequestHandler(asynchat.async_chat, BaseHTTPServer.BaseHTTPRequestHandler)
             self.path = self.path[:qspos]
 
         self.handle_data()
+
+    def do_HEAD(self):
+        """Serves a HEAD request"""
+        qspos = self.path.find('?')
+        if qspos>=0:
+            self.path = self.path[:qspos]
+        f = self.send_head()
+        if f:
+            f.close()
+        self.log_request(self.code)
+        self.end_request()
         
     def do_POST(self):
         """Begins serving a POST request. The request data must be readable
@@ -240,7 +399,12 @@ class RequestHandler(asynchat.async_chat, BaseHTTPServer.BaseHTTPRequestHandler)
             self.end_headers()
             self.log_request(self.code, len(favicon))
             self.outgoing.append(favicon)
-            self.outgoing.append(None)
+            self.end_request()
+            return
+
+        stream = self.server.streams.get(self.path)
+        if stream is not None:
+            self.start_stream(stream)
             return
         
         f = self.send_head()
@@ -249,10 +413,13 @@ class RequestHandler(asynchat.async_chat, BaseHTTPServer.BaseHTTPRequestHandler)
             # to read them all into memory at the same time...may leave a
             # file handle open for longer than is really desired, but it does
             # make it able to handle files of unlimited size.
-            try:
-                size = os.fstat(f.fileno())[6]
-            except AttributeError:
-                size = f.len
+            if isinstance(f, FileRange):
+                size = f.length
+            else:
+                try:
+                    size = os.fstat(f.fileno())[6]
+                except AttributeError:
+                    size = len(f.getvalue())
             self.update_b(size)
             self.log_request(self.code, size)
             self.outgoing.append(f)
@@ -260,7 +427,48 @@ class RequestHandler(asynchat.async_chat, BaseHTTPServer.BaseHTTPRequestHandler)
             self.log_request(self.code)
         
         # signal the end of this request
-        self.outgoing.append(None)
+        self.end_request()
+
+    def end_request(self):
+        """Marks the end of the response: the connection is closed once it
+        is sent, unless it is kept alive"""
+        if self.close_connection or self.requests >= self.max_keepalive_requests:
+            self.outgoing.append(None)
+        else:
+            self.outgoing.append(KEEP_ALIVE)
+
+    def start_stream(self, stream):
+        """Sends the headers of a live stream, the frames are then sent
+        by writable()"""
+        fps = stream.max_fps
+        try:
+            fps = min(fps, float(self.body["fps"][0]))
+        except (AttributeError, KeyError, ValueError):
+            pass
+        self.stream_interval = fps > 0 and 1.0 / fps or 0
+
+        self.send_response(200)
+        self.send_header("Content-type", stream.content_type())
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.log_request(self.code)
+        self.stream = stream
+        stream.clients.add(self)
+
+    def next_stream_frame(self):
+        """Queues the latest frame of the stream, if it was not sent yet
+        and the frame rate limit allows it"""
+        stream = self.stream
+        now = time.time()
+        if stream.sequence == self.stream_sequence or \
+          now - self.stream_last_sent < self.stream_interval:
+            return
+        part = stream.part()
+        if part is not None:
+            self.stream_sequence = stream.sequence
+            self.stream_last_sent = now
+            self.outgoing.append(part)
 
     def handle_request_line(self):
         """Called when the http request line and headers have been received"""
@@ -268,7 +476,15 @@ class RequestHandler(asynchat.async_chat, BaseHTTPServer.BaseHTTPRequestHandler)
         self.rfile = cStringIO.StringIO(''.join(popall(self.incoming)))
         self.rfile.seek(0)
         self.raw_requestline = self.rfile.readline()
-        self.parse_request()
+        # reset the state of the previous request of the connection
+        self.code = None
+        self.command = None
+        self.body = {}
+        self.requests += 1
+        self.pending_responses += 1
+        if not self.parse_request():
+            self.end_request()
+            return
 
         if self.command in ['GET','HEAD']:
             # if method is GET or HEAD, call do_GET or do_HEAD and finish
@@ -280,6 +496,7 @@ class RequestHandler(asynchat.async_chat, BaseHTTPServer.BaseHTTPRequestHandler)
             self.prepare_POST()
         else:
             self.send_error(501, "Unsupported method (%s)" %self.command)
+            self.end_request()
 
     def end_headers(self):
         """Send the blank line ending the MIME headers, send the buffered
@@ -291,8 +508,23 @@ class RequestHandler(asynchat.async_chat, BaseHTTPServer.BaseHTTPRequestHandler)
         traceback.print_exc(sys.stderr)
         self.close()
 
+    def readable(self):
+        # no new requests while too many responses are waiting; stream
+        # connections are read to see when the client goes away
+        return self.stream is not None or \
+               self.pending_responses < self.max_pipelined_requests
+
     def writable(self):
+        if self.stream is not None and not self.outgoing and self.connected:
+            # previous frame sent
+            self.next_stream_frame()
         return len(self.outgoing) and self.connected
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.clients.discard(self)
+            self.stream = None
+        asynchat.async_chat.close(self)
     
     def handle_write(self):
         O = self.outgoing
@@ -311,9 +543,21 @@ class RequestHandler(asynchat.async_chat, BaseHTTPServer.BaseHTTPRequestHandler)
                 # if self.close_connection:
                 self.close()
                 return
+            elif a is KEEP_ALIVE:
+                self.pending_responses -= 1
+                continue
+            #zero-copy transfer of regular files
+            elif isinstance(a, FileRange) and sendfile is not None and self.use_sendfile:
+                if self.send_file_range(a):
+                    O.appendleft(a)
+                return
             #handle file objects
             elif hasattr(a, 'read'):
-                _a, a = a, a.read(self.blocksize)
+                if isinstance(a, FileRange):
+                    size = max(self.blocksize, self.coalesce_size)
+                else:
+                    size = self.blocksize
+                _a, a = a, a.read(size)
                 if not a:
                     del _a
                     continue
@@ -327,6 +571,14 @@ class RequestHandler(asynchat.async_chat, BaseHTTPServer.BaseHTTPRequestHandler)
             #if we get here, the outgoing deque is empty
             return
         #if we get here, 'a' is a string or buffer object of length > 0
+        if isinstance(a, str) and len(O) and isinstance(O[0], str):
+            chunks = [a]
+            size = len(a)
+            while len(O) and isinstance(O[0], str) and size < self.coalesce_size:
+                chunk = O.popleft()
+                chunks.append(chunk)
+                size += len(chunk)
+            a = ''.join(chunks)
         try:
             num_sent = self.send(a)
             if num_sent < len(a):
@@ -348,6 +600,97 @@ class RequestHandler(asynchat.async_chat, BaseHTTPServer.BaseHTTPRequestHandler)
                 self.log_error(str(why))
             self.handle_error()
 
+    def send_file_range(self, f):
+        """Sends the file range <f> with sendfile(), returns True if it is
+        not completely sent"""
+        try:
+            num_sent = sendfile(self.socket.fileno(), f.fileno(), f.offset, f.remaining)
+        except (OSError, IOError, socket.error), why:
+            if why.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return True
+            f.close()
+            self.log_error(str(why))
+            self.handle_error()
+            return False
+        if not num_sent:
+            #file truncated: the announced length cannot be sent
+            f.close()
+            self.close()
+            return False
+        f.offset += num_sent
+        f.remaining -= num_sent
+        if f.remaining:
+            return True
+        f.close()
+        return False
+
+    def not_modified(self, etag, mtime):
+        """True if the client copy, as described by the conditional GET
+        headers, is up to date"""
+        if_none_match = self.headers.get('if-none-match')
+        if if_none_match:
+            return if_none_match.strip() == '*' or \
+                   etag in [tag.strip() for tag in if_none_match.split(',')]
+        if_modified_since = self.headers.get('if-modified-since')
+        if if_modified_since:
+            date = parsedate_tz(if_modified_since)
+            return date is not None and int(mtime) <= mktime_tz(date)
+        return False
+
+    def send_file_head(self, path):
+        """Sends the headers of a regular file response, handling the
+        conditional and range requests; returns the FileRange to send"""
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            self.send_error(404, "File not found")
+            return None
+        try:
+            fs = os.fstat(f.fileno())
+            size = fs.st_size
+            etag = '"%x-%x"' % (int(fs.st_mtime), size)
+            last_modified = self.date_time_string(fs.st_mtime)
+
+            if self.not_modified(etag, fs.st_mtime):
+                f.close()
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", last_modified)
+                self.end_headers()
+                return None
+
+            byte_range = None
+            range_header = self.headers.get('range')
+            if_range = self.headers.get('if-range')
+            if range_header and (not if_range or if_range in (etag, last_modified)):
+                try:
+                    byte_range = parse_range(range_header, size)
+                except ValueError:
+                    f.close()
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */%d" % size)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return None
+
+            if byte_range is None:
+                self.send_response(200)
+                first, length = 0, size
+            else:
+                self.send_response(206)
+                first, length = byte_range[0], byte_range[1] - byte_range[0] + 1
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (byte_range[0], byte_range[1], size))
+            self.send_header("Content-type", self.guess_type(path))
+            self.send_header("Content-Length", str(length))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.end_headers()
+            return FileRange(f, first, length)
+        except:
+            f.close()
+            raise
+
     def send_head(self):
         path = self.translate_path(self.path)
         if sys.platform == 'win32':
@@ -363,8 +706,10 @@ class RequestHandler(asynchat.async_chat, BaseHTTPServer.BaseHTTPRequestHandler)
                 self.end_headers()
                 self.wfile.write(x)
                 return None
+        elif os.path.isfile(path):
+            return self.send_file_head(path)
 
-        return BaseHTTPServer.BaseHTTPRequestHandler.send_head(self)
+        return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
     
     def send_response(self, code, message=None):
         if self.code:
@@ -381,6 +726,11 @@ class RequestHandler(asynchat.async_chat, BaseHTTPServer.BaseHTTPRequestHandler)
             # print (self.protocol_version, code, message)
         self.send_header('Server', self.version_string())
         self.send_header('Date', self.date_time_string())
+        if not self.close_connection:
+            if self.requests >= self.max_keepalive_requests:
+                self.send_header('Connection', 'close')
+            elif self.request_version == 'HTTP/1.0':
+                self.send_header('Connection', 'keep-alive')
     
     def log_message(self, format, *args):
         sys.stderr.write("%s - - [%s] %s \"%s\" \"%s\"\n" %
@@ -413,6 +763,7 @@ class Server(asyncore.dispatcher):
         self.port = port
         self.handler = handler
         asyncore.dispatcher.__init__ (self)
+        self.streams = {}
         self.create_socket (socket.AF_INET, socket.SOCK_STREAM)
 
         self.set_reuse_addr()
@@ -426,6 +777,10 @@ class Server(asyncore.dispatcher):
         #     5).
         self.listen (5)
 
+    def add_stream(self, path, stream):
+        """Serves the MJPEGStream <stream> at <path>"""
+        self.streams[path] = stream
+
     def handle_accept (self):
         try:
             conn, addr = self.accept()
@@ -475,8 +830,70 @@ class to_logfile:
         if self.fl:
             self.f.flush()
 
+def benchmark(port, count=200):
+    """Throughput of the server against a local client: thumbnails with
+    one connection per request and on a keep-alive connection, partial
+    reads of a large image, and full transfers with and without
+    sendfile()"""
+    import threading, tempfile, shutil, httplib
+
+    root = tempfile.mkdtemp()
+    thumbnail = os.path.join(root, "thumbnail.jpeg")
+    image = os.path.join(root, "image.cbf")
+    open(thumbnail, "wb").write(os.urandom(20*1024))
+    open(image, "wb").write(os.urandom(64*1048576))
+    os.chdir(root)
+
+    class QuietHandler(RequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    server = Server('127.0.0.1', port, QuietHandler)
+    server_thread = threading.Thread(target=asyncore.loop, kwargs={"timeout": 0.1})
+    server_thread.setDaemon(True)
+    server_thread.start()
+
+    def get(conn, path, headers={}):
+        conn.request("GET", path, headers=headers)
+        response = conn.getresponse()
+        return len(response.read())
+
+    try:
+        t0 = time.time()
+        for i in xrange(count):
+            conn = httplib.HTTPConnection('127.0.0.1', port)
+            get(conn, "/thumbnail.jpeg", {"Connection": "close"})
+            conn.close()
+        t1 = time.time()
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+        for i in xrange(count):
+            get(conn, "/thumbnail.jpeg")
+        t2 = time.time()
+        print "thumbnails: %.0f requests/s with a connection per request, %.0f requests/s kept alive" % \
+              (count / (t1 - t0), count / (t2 - t1))
+
+        t0 = time.time()
+        for i in xrange(count):
+            get(conn, "/image.cbf", {"Range": "bytes=%d-%d" % (i * 65536, (i + 1) * 65536 - 1)})
+        t1 = time.time()
+        print "64 kB range reads of a 64 MB image: %.0f requests/s" % (count / (t1 - t0))
+
+        for use_sendfile in (False, True):
+            if use_sendfile and sendfile is None:
+                continue
+            QuietHandler.use_sendfile = use_sendfile
+            t0 = time.time()
+            size = get(conn, "/image.cbf")
+            t1 = time.time()
+            print "64 MB image, %s: %.0f MB/s" % (use_sendfile and "sendfile" or "read/send",
+                                                   size / 1048576.0 / (t1 - t0))
+        conn.close()
+    finally:
+        server.close()
+        shutil.rmtree(root)
+
 if __name__=="__main__":
-    usage = "usage: \%prog -r<root> [-p<port>] [-0|-1|-2]"
+    usage = "usage: \%prog -r<root> [-p<port>] [-0|-1|-2] | -b<count> [-p<port>]"
     
     parser = optparse.OptionParser(usage)
     parser.add_option('-r', '--root', dest='root',
@@ -491,8 +908,15 @@ if __name__=="__main__":
     parser.add_option('-2', dest='server',
                       help='Run the server which will serve exact files and directory->index files',
                       action='store_const', const=2)
+    parser.add_option('-b', '--benchmark', dest='benchmark', type='int',
+                      help='Run a throughput benchmark with this number of requests',
+                      action='store')
     
     options, args = parser.parse_args()
+
+    if options.benchmark:
+        benchmark(options.port, options.benchmark)
+        sys.exit(0)
     
     if options.root is None:
         parser.error("Need root path to start server")
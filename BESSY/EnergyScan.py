@@ -2,9 +2,7 @@ from qt import *
 from HardwareRepository.BaseHardwareObjects import Equipment
 from HardwareRepository.TaskUtils import *
 import logging
-import PyChooch
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_agg import FigureCanvasAgg
+from energy_scan_analysis import ScanPoints, energy_in_eV, run_chooch, save_scan_files
 import os
 import time
 import types
@@ -314,7 +312,6 @@ class EnergyScan(Equipment):
 
 
     def doChooch(self, scanObject, elt, edge, scanArchiveFilePrefix, scanFilePrefix):
-        import pdb; pdb.set_trace()
         symbol = "_".join((elt, edge))
 
         if scanArchiveFilePrefix == scanFilePrefix:
@@ -334,58 +331,31 @@ class EnergyScan(Equipment):
         rawScanFile=os.path.extsep.join((scanFilePrefix, "raw"))
         scanFile=os.path.extsep.join((scanFilePrefix, "efs"))
 
-        try:
-            f=open(rawScanFile, "w")
-            if scanArchiveFilePrefix is not None:
-                pyarch_f=open(archiveRawScanFile, "w")
-        except:
-            logging.getLogger("HWR").exception("could not create raw scan files")
-            self.storeEnergyScan()
-            self.emit("energyScanFailed", ())
-            return
+        scanData = ScanPoints()
+        if scanObject is None:                
+            raw_data_file = os.path.join(os.path.dirname(scanFilePrefix), 'data.raw')
+            raw_data_file = '/141dat/pxrdat/scans/today/d_scan_000.raw'
+            try:
+                scanData.load(raw_data_file, skip_lines=2, to_eV=True)
+            except:
+                logging.getLogger("HWR").exception("could not read raw scan data")
+                self.storeEnergyScan()
+                self.emit("energyScanFailed", ())
+                return
         else:
-            scanData = []
-            import pdb; pdb.set_trace()
-            
-            if scanObject is None:                
-                raw_data_file = os.path.join(os.path.dirname(scanFilePrefix), 'data.raw')
-                raw_data_file = '/141dat/pxrdat/scans/today/d_scan_000.raw'
-                try:
-                    raw_file = open(raw_data_file, 'r')
-                except:
-                    self.storeEnergyScan()
-                    self.emit("energyScanFailed", ())
-                    return
-                
-                for line in raw_file.readlines()[2:]:
-                    (x, y) = line.split()
-                    x = float(x.strip())
-                    y = float(y.strip())
-                    x = x < 1000 and x*1000.0 or x
-                    scanData.append((x, y))
-                    f.write("%f,%f\r\n" % (x, y))
-                    if scanArchiveFilePrefix is not None:
-                        pyarch_f.write("%f,%f\r\n"% (x, y))
-            else:
-                for i in range(len(scanObject.x)):
-                    x = float(scanObject.x[i])
-                    x = x < 1000 and x*1000.0 or x 
-                    y = float(scanObject.y[i])
-                    scanData.append((x, y))
-                    f.write("%f,%f\r\n" % (x, y))
-                    if scanArchiveFilePrefix is not None:
-                         pyarch_f.write("%f,%f\r\n"% (x, y)) 
-
-            f.close()
-            if scanArchiveFilePrefix is not None:
-                pyarch_f.close()
-                self.scanInfo["scanFileFullPath"]=str(archiveRawScanFile)
-
-        pk, fppPeak, fpPeak, ip, fppInfl, fpInfl, chooch_graph_data = PyChooch.calc(scanData, elt, edge, scanFile)
-        rm=(pk+30)/1000.0
-        pk=pk/1000.0
+            for x, y in zip(scanObject.x, scanObject.y):
+                scanData.append(energy_in_eV(float(x)), float(y))
+
+        rawScanFiles = [rawScanFile]
+        if scanArchiveFilePrefix is not None:
+            rawScanFiles.append(archiveRawScanFile)
+            self.scanInfo["scanFileFullPath"]=str(archiveRawScanFile)
+
+        result = run_chooch(scanData, elt, edge, scanFile)
+        pk, fppPeak, fpPeak = result.pk, result.fppPeak, result.fpPeak
+        ip, fppInfl, fpInfl = result.ip, result.fppInfl, result.fpInfl
+        rm = result.rm
         savpk = pk
-        ip=ip/1000.0
         comm = ""
         logging.getLogger("HWR").info("th. Edge %s ; chooch results are pk=%f, ip=%f, rm=%f" % (self.thEdge, pk,ip,rm))
 
@@ -397,20 +367,10 @@ class EnergyScan(Equipment):
    
           logging.getLogger("HWR").warning('EnergyScan: calculated peak (%f) is more that 20eV %s the theoretical value (%f). Please check your scan and choose the energies manually' % (savpk, (self.thEdge - ip) > 0.02 and "below" or "above", self.thEdge))
 
-
+        efsCopies = []
         if scanArchiveFilePrefix is not None:
             archiveEfsFile=os.path.extsep.join((scanArchiveFilePrefix, "efs"))
-            try:
-              fi=open(scanFile)
-              fo=open(archiveEfsFile, "w")
-            except:
-              self.storeEnergyScan()
-              self.emit("energyScanFailed", ())
-              return
-            else:
-              fo.write(fi.read())
-              fi.close()
-              fo.close()
+            efsCopies.append((scanFile, archiveEfsFile))
 
         self.scanInfo["peakEnergy"]=pk
         self.scanInfo["inflectionEnergy"]=ip
@@ -421,56 +381,26 @@ class EnergyScan(Equipment):
         self.scanInfo["inflectionFDoublePrime"]=fppInfl
         self.scanInfo["comments"] = comm
 
-        chooch_graph_x, chooch_graph_y1, chooch_graph_y2 = zip(*chooch_graph_data)
-        chooch_graph_x = list(chooch_graph_x)
         # 2010-08-03-bessy-mh: disable converting energy scale to keV for chooch result graphs
         #                      in order to allow for same x axis values with raw data
-        # for i in range(len(chooch_graph_x)):
-        #  chooch_graph_x[i]=chooch_graph_x[i]/1000.0
+        chooch_graph_x = result.graph_x
+        chooch_graph_y1, chooch_graph_y2 = result.graph_y1, result.graph_y2
 
-        logging.getLogger("HWR").info("<chooch> Saving png" )
-        # prepare to save png files
         # 2010-08-03-bessy-mh
         # title="%10s  %6s  %6s\n%10s  %6.2f  %6.2f\n%10s  %6.2f  %6.2f" % ("energy", "f'", "f''", pk, fpPeak, fppPeak, ip, fpInfl, fppInfl) 
         title="%10s  %6s  %6s\n%10.4f  %6.2f  %6.2f\n%10.4f  %6.2f  %6.2f" % ("energy", "f'", "f''", pk, fpPeak, fppPeak, ip, fpInfl, fppInfl) 
-        fig=Figure(figsize=(15, 11))
-        ax=fig.add_subplot(211)
-        ax.set_title("%s\n%s" % (scanFile, title))
-        ax.grid(True)
-        ax.plot(*(zip(*scanData)), **{"color":'black'})
-        ax.set_xlabel("Energy")
-        ax.set_ylabel("MCA counts")
-        ax2=fig.add_subplot(212)
-        ax2.grid(True)
-        ax2.set_xlabel("Energy")
-        ax2.set_ylabel("")
-        # 2010-08-03-bessy-mh: begin
-        # set X axis limits of chooch results to same range as for the raw data
-        (xmin, xmax) = ax.get_xlim()
-        ax2.set_autoscalex_on(False)
-        ax2.set_xlim(xmin, xmax)
-        # 2010-08-03-bessy-mh: end
-        handles = []
-        handles.append(ax2.plot(chooch_graph_x, chooch_graph_y1, color='blue'))
-        handles.append(ax2.plot(chooch_graph_x, chooch_graph_y2, color='red'))
-        canvas=FigureCanvasAgg(fig)
 
         # 2010-07-20-mh-bessy: disable writing to archive directory
         escan_png = os.path.extsep.join((scanFilePrefix, "png"))
-        if scanArchiveFilePrefix is not None:
-            escan_archivepng = os.path.extsep.join((scanArchiveFilePrefix, "png")) 
-        #self.scanInfo["jpegChoochFileFullPath"]=str(escan_archivepng)
         self.scanInfo["jpegChoochFileFullPath"]=str(escan_png)
-        try:
-          logging.getLogger("HWR").info("Rendering energy scan and Chooch graphs to PNG file : %s", escan_png)
-          canvas.print_figure(escan_png, dpi=80)
-        except:
-          logging.getLogger("HWR").exception("could not print figure")
-        #try:
-        #  logging.getLogger("HWR").info("Saving energy scan to archive directory for ISPyB : %s", escan_archivepng)
-        #  canvas.print_figure(escan_archivepng, dpi=80)
-        #except:
-        #  logging.getLogger("HWR").exception("could not save figure")
+
+        # raw files, efs archive copy and graphs are written in the background
+        logging.getLogger("HWR").info("Rendering energy scan and Chooch graphs to PNG file : %s", escan_png)
+        save_scan_files(scanData, raw_files=rawScanFiles, copies=efsCopies,
+                        png_files=(escan_png,), chooch_result=result,
+                        title="%s\n%s" % (scanFile, title),
+                        # 2010-08-03-bessy-mh: same X axis limits for chooch results as for the raw data
+                        same_xlim=True)
 
         self.storeEnergyScan()
         self.scanInfo=None
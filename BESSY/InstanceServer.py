@@ -1,12 +1,15 @@
 from HardwareRepository.BaseHardwareObjects import Procedure
 import logging
 import time
-import pickle
+import json
+import struct
+import collections
 import os,tempfile
 import BlissFramework
 import operator
 import gevent
 import gevent.server
+import gevent.event
 import socket
 import pwd
 import qt
@@ -21,7 +24,12 @@ patch_socket()
 </procedure>
 """
 
-TERMINATOR = "\0" 
+# messages are sent as a 4 bytes big endian length, followed by the
+# JSON encoded message
+HEADER = struct.Struct("!I")
+MAX_MESSAGE_SIZE = 16*1024*1024
+# messages waiting to be sent to one peer, before it is disconnected
+MAX_QUEUED_MESSAGES = 1000
 INSTANCE_HO = None
 SERVER_CLIENTS = {}
 CLIENTS = {}
@@ -424,9 +432,9 @@ class InstanceServer(Procedure):
         data=msg.encode()
         if self.isServer():
             self.addEventToCache(brick_name,widget_name,data)
-            broadcast_to_clients(data)
+            broadcast_to_clients(data,key=(brick_name,widget_name))
         elif self.isClient():
-            send_data_to_server(self.instanceClient, data)
+            send_data_to_server(self.instanceClient, data, key=(brick_name,widget_name))
         else:
             logging.getLogger("HWR").warning('InstanceServer: sendBrickUpdateMessage while not server nor client!')
 
@@ -896,7 +904,7 @@ class InstanceServer(Procedure):
                 logging.getLogger("HWR").exception('InstanceServer: problem while calling a brick!')
 
         elif isinstance(m,BrickUpdateInstanceMessage):
-            broadcast_to_clients(data,avoid=(client_addr,))
+            broadcast_to_clients(data,avoid=(client_addr,),key=(m.getBrickName(),m.getWidgetName()))
 
             try:
                 timestamp=m.getTimestamp()
@@ -963,43 +971,143 @@ class InstanceServer(Procedure):
                 send_data_to_client(cli_addr,data)
 
 
+class FrameDecoder:
+    """Splits the received data into messages; the data of a message is
+    only joined once complete"""
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+        self.length = None
+
+    def feed(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        messages = []
+        while True:
+            if self.length is None:
+                if self.size < HEADER.size:
+                    break
+                data = "".join(self.chunks)
+                self.length = HEADER.unpack_from(data)[0]
+                if self.length > MAX_MESSAGE_SIZE:
+                    raise ValueError("message too long (%d bytes)" % self.length)
+                self.chunks = [data[HEADER.size:]]
+                self.size -= HEADER.size
+            if self.size < self.length:
+                break
+            data = "".join(self.chunks)
+            messages.append(data[:self.length])
+            data = data[self.length:]
+            self.chunks = data and [data] or []
+            self.size = len(data)
+            self.length = None
+        return messages
+
+class MessageConnection:
+    """Connection to a peer, with its own queue of outgoing messages and
+    sender greenlet: sending never blocks the caller, a slow peer only
+    delays its own messages.
+
+    Queued messages with the same coalescing key (brick updates of the
+    same brick widget) replace each other: only the latest one is sent.
+    A peer with more than MAX_QUEUED_MESSAGES pending messages is
+    disconnected."""
+    def __init__(self, sock, name, max_queued=MAX_QUEUED_MESSAGES):
+        self.socket = sock
+        self.name = name
+        self.max_queued = max_queued
+        self.closed = False
+        self._queue = collections.deque()
+        self._queued = 0
+        self._coalesced = {}
+        self._wakeup = gevent.event.Event()
+        self._sender = gevent.spawn(self._send_messages)
+
+    def send(self, data, key=None):
+        if self.closed:
+            return
+        # queue entries are [data] lists, emptied when superseded
+        entry = [data]
+        if key is not None:
+            superseded = self._coalesced.get(key)
+            if superseded is not None and superseded[0] is not None:
+                superseded[0] = None
+                self._queued -= 1
+            self._coalesced[key] = entry
+        if self._queued >= self.max_queued:
+            logging.getLogger("HWR").error("InstanceServer: %s does not read its messages, disconnecting", self.name)
+            self.close()
+            return
+        self._queue.append(entry)
+        self._queued += 1
+        self._wakeup.set()
+
+    def _send_messages(self):
+        while not self.closed:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            frames = []
+            while self._queue:
+                data = self._queue.popleft()[0]
+                if data is not None:
+                    frames.append(HEADER.pack(len(data)))
+                    frames.append(data)
+            self._queued = 0
+            self._coalesced.clear()
+            if frames:
+                try:
+                    self.socket.sendall("".join(frames))
+                except:
+                    # broken pipe? peer disconnected
+                    self.close()
+
+    def receive(self, message_cb):
+        """Reads the messages of the peer until it closes the connection"""
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = self.socket.recv(65536)
+                if not data:
+                    break
+                for msg in decoder.feed(data):
+                    message_cb(msg)
+        except:
+            if not self.closed:
+                logging.getLogger("HWR").exception("InstanceServer: error reading messages from %s", self.name)
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.clear()
+        self._wakeup.set()
+        try:
+            self.socket.close()
+        except:
+            pass
+
 def handleRemoteClient(client_socket, addr):
-  SERVER_CLIENTS[addr]=client_socket  
+  connection = MessageConnection(client_socket, "client %s:%d" % addr)
+  SERVER_CLIENTS[addr]=connection
   INSTANCE_HO.clientConnected(addr, client_socket)
 
-  buffer = ""  
-  while True:
-    data = client_socket.recv(1024)
-    if data == "":
-      try:
-        SERVER_CLIENTS.pop(addr) 
-      except:
-        #Huh? socket closed but client is not in SERVER_CLIENTS dict!
-        # just ignore silently
-        pass
-      else:
-        INSTANCE_HO.clientClosed(addr)
-      break
-    buffer += data
-    msgs = buffer.split(TERMINATOR)
-    buffer = msgs.pop()
-    for msg in msgs:
-      INSTANCE_HO.serverMessageReceived(addr, msg)
-
-def broadcast_to_clients(data, avoid=None):
+  connection.receive(lambda msg: INSTANCE_HO.serverMessageReceived(addr, msg))
+
+  if SERVER_CLIENTS.get(addr) is connection:
+    SERVER_CLIENTS.pop(addr)
+    INSTANCE_HO.clientClosed(addr)
+
+def broadcast_to_clients(data, avoid=None, key=None):
   for client_addr in SERVER_CLIENTS.keys(): 
     if avoid and client_addr in avoid:
       continue
-    send_data_to_client(client_addr, data)
+    send_data_to_client(client_addr, data, key)
 
-def send_data_to_client(client_addr, data):
-  client_socket = SERVER_CLIENTS.get(client_addr)
-  if client_socket:
-    try:
-      client_socket.sendall("%s%s" % (data, TERMINATOR))
-    except:
-      # broken pipe? client disconnected
-      SERVER_CLIENTS.pop(client_addr)
+def send_data_to_client(client_addr, data, key=None):
+  connection = SERVER_CLIENTS.get(client_addr)
+  if connection:
+    connection.send(data, key)
 
 def InstanceClient(host, port):
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -1010,28 +1118,24 @@ def InstanceClient(host, port):
     else:
         socketName = s.getsockname()
 
-    def handle_incoming_data(client_socket):  
-        buffer = ""  
-        while True:
-           data = client_socket.recv(1024)
-           if data == "":
-             INSTANCE_HO.serverClosed()
-             break
-           buffer += data
-           msgs = buffer.split(TERMINATOR)
-           buffer = msgs.pop()
-           for msg in msgs:
-             INSTANCE_HO.clientMessageReceived(msg)
+    def handle_incoming_data(connection):
+        connection.receive(INSTANCE_HO.clientMessageReceived)
+        INSTANCE_HO.serverClosed()
    
-    CLIENTS[socketName] = s 
-    gevent.spawn(handle_incoming_data, s) 
+    connection = MessageConnection(s, "server %s:%d" % (host, port))
+    CLIENTS[socketName] = connection
+    gevent.spawn(handle_incoming_data, connection) 
 
     return socketName
 
 
-def send_data_to_server(socket_name, data):
-    client_socket = CLIENTS[socket_name]
-    client_socket.sendall("%s%s" % (data, TERMINATOR))
+def send_data_to_server(socket_name, data, key=None):
+    CLIENTS[socket_name].send(data, key)
+
+
+def _json_default(obj):
+    # e.g QString arguments of the brick methods
+    return unicode(obj)
 
 
 class InstanceMessage:
@@ -1049,13 +1153,13 @@ class InstanceMessage:
     def __init__(self,data=None):
         self.messageDict={}
         if data is not None:
-            self.messageDict=pickle.loads(data)
+            self.messageDict=json.loads(data)
     def encode(self):
         try:
             self.messageDict["type"]
         except KeyError:
             raise ValueError
-        return pickle.dumps(self.messageDict)
+        return json.dumps(self.messageDict, separators=(',',':'), default=_json_default)
     def getType(self):
         try:
             t=self.messageDict["type"]
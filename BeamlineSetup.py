@@ -1,10 +1,12 @@
 import os
 import logging
 import jsonpickle
+import diffractometer_state
 import queue_model_objects_v1 as queue_model_objects
 
 from HardwareRepository.BaseHardwareObjects import HardwareObject
 from XSDataMXCuBEv1_3 import XSDataInputMXCuBE
+import xsdata_io
 import queue_model_enumerables_v1 as queue_model_enumerables
 
 from HardwareRepository.HardwareRepository import HardwareRepository
@@ -34,6 +36,12 @@ class BeamlineSetup(HardwareObject):
         self._object_by_path['/beamline/resolution'] = self.resolution_hwobj
         self._object_by_path['/beamline/transmission'] = self.transmission_hwobj
 
+        # gonio axes positions, kept up to date by the motor signals
+        self.axes_state = diffractometer_state.DiffractometerState(\
+            {"omega": self.omega_axis_hwobj,
+             "kappa": self.kappa_axis_hwobj,
+             "kappa_phi": self.kappa_phi_axis_hwobj})
+
     def _get_object_by_role(self, role):
         """
         Gets the object with the role <role>' and adds the attribute
@@ -394,7 +402,7 @@ class BeamlineSetup(HardwareObject):
         result = 0
 
         try:
-            result = round(float(self.omega_axis_hwobj.getPosition()), 2)
+            result = round(float(self.axes_state.get_position("omega")), 2)
         except TypeError:
             parent_key = "default_acquisition_values"
             result = round(float(self[parent_key].getProperty('start_angle')), 2)
@@ -410,7 +418,7 @@ class BeamlineSetup(HardwareObject):
         """
         result = 0
         try:
-            result = round(float(self.kappa_axis_hwobj.getPosition()), 2)
+            result = round(float(self.axes_state.get_position("kappa")), 2)
         except:
             pass
         return result
@@ -421,7 +429,7 @@ class BeamlineSetup(HardwareObject):
         """
         result = 0
         try:
-            result = round(float(self.kappa_phi_axis_hwobj.getPosition()), 2)
+            result = round(float(self.axes_state.get_position("kappa_phi")), 2)
         except:
             pass
         return result
@@ -2,6 +2,7 @@ from HardwareRepository import HardwareRepository
 from HardwareRepository.BaseHardwareObjects import Device
 import math
 import numpy
+import diffractometer_state
 
 class CentringMath(Device):
     """
@@ -44,95 +45,98 @@ class CentringMath(Device):
                     but not just x,y as in original MiniDiff.
         """
         if not factorized : self.factorize()
-        tau_cntrd = self.centred_positions_to_vector(centring_dict)
-        dum = self.tau - tau_cntrd
-        return self.vector_to_camera_coordinates(numpy.dot(self.F.T,dum))
+        return self.vector_to_camera_coordinates(self.project_to_screen(\
+                   self.centred_positions_to_vector(centring_dict))[0])
 
     def listOfCentringsToScreen(self,list_of_centring_dicts):
+        """
+        Descript. : projects all centrings with one matrix product
+        """
         self.factorize()
-        lst= []
-        for centring in list_of_centring_dicts:
-          lst.append(self.centringToScreen(centring,factorized = True))
-        return lst
+        screen = self.project_to_screen(\
+                     self.centred_positions_to_array(list_of_centring_dicts))
+        return [self.vector_to_camera_coordinates(xy) for xy in screen]
+
+    def project_to_screen(self,positions):
+        """
+        Descript. : positions is a (N, translationAxesCount) array of
+                    centred positions, returns the (N, cameraAxesCount) 
+                    array of camera coordinates. factorize() before.
+        """
+        return numpy.dot(self.tau - numpy.atleast_2d(positions), self.F)
   
     def factorize(self):
         """
-        Descript. : this should be automatic, on the gonio both rot and 
-                    trans datum update
+        Descript. : F and tau are computed again only if the gonio
+                    positions changed
         """
-        self.F=self.factor_matrix()
-        self.tau=self.translation_datum()
+        positions = self.motor_state.get_positions()
+        if self.motor_state.version != self.factorized_version:
+            self.F=self.factor_matrix(positions)
+            self.tau=self.translation_datum(positions)
+            self.factorized_version = self.motor_state.version
 
     def initCentringProcedure(self):
         """
         Descript. : call before starting rotate-click sequence 
         """
-        self.centringDataTensor=[]
-        self.centringDataMatrix=[]
+        self.centringDataTensor=numpy.zeros(shape=(0,self.translationAxesCount,len(self.cameraAxes)))
+        self.centringDataMatrix=numpy.zeros(shape=(0,len(self.cameraAxes)))
         self.motorConstraints=[]
 
     def appendCentringDataPoint(self,camera_coordinates):
         """
         Descript. : call after each click and send click points - but relative in mm 
         """
-        self.centringDataTensor.append(self.factor_matrix())
-        self.centringDataMatrix.append(self.camera_coordinates_to_vector(camera_coordinates))
+        self.centringDataTensor=numpy.concatenate((self.centringDataTensor,
+                                                   self.factor_matrix()[numpy.newaxis]))
+        self.centringDataMatrix=numpy.concatenate((self.centringDataMatrix,
+                                                   [self.camera_coordinates_to_vector(camera_coordinates)]))
 
     def centeredPosition(self, return_by_name=False):
         """
         Descript. : call after appending the last click. 
         Return    : {motorHO:position} dictionary.
         """
-        M=numpy.zeros(shape=(self.translationAxesCount,self.translationAxesCount))
-        V=numpy.zeros(shape=(self.translationAxesCount))
-
-        for l in range(0,self.translationAxesCount):
-           for i in range (0,len(self.centringDataMatrix)):
-              for k in range(0,len(self.cameraAxes)):
-                 V[l] += self.centringDataTensor[i][l][k]*self.centringDataMatrix[i][k]
-           for m in range(0,self.translationAxesCount):
-              for i in range (0,len(self.centringDataMatrix)):
-                 for k in range(0,len(self.cameraAxes)):
-                    M[l][m] += self.centringDataTensor[i][l][k]*self.centringDataTensor[i][m][k]
+        # normal equations, summed over clicks (i) and camera axes (k)
+        M=numpy.einsum('ilk,imk->lm',self.centringDataTensor,self.centringDataTensor)
+        V=numpy.einsum('ilk,ik->l',self.centringDataTensor,self.centringDataMatrix)
         tau_cntrd = numpy.dot(numpy.linalg.pinv(M,rcond=1e-6),V)
         
         tau_cntrd = self.apply_constraints(M,tau_cntrd)
         return self.vector_to_centred_positions( - tau_cntrd + self.translation_datum(), return_by_name)
 
     def apply_constraints(self,M,tau):
-        V=numpy.zeros(shape=(self.translationAxesCount))
         for c in self.motorConstraints:
-            for i in range(0,self.translationAxesCount):
-                V[i] = M[i][c['index']]
-                M[i][c['index']] = 0.0
-                M[c['index']][i] = 0.0
+            V=M[:,c['index']].copy()
+            M[:,c['index']] = 0.0
+            M[c['index'],:] = 0.0
             tau = tau -  (c['position'] - tau[c['index']]) * numpy.dot(numpy.linalg.pinv(M,rcond=1e-6),V)
             tau[c['index']] = c['position']
         return tau
         
-    def factor_matrix(self):
+    def factor_matrix(self, positions=None):
         """
         Descript. : This should be connected to goniostat rotation datum 
                     update, with F globalized
         """  
-        F=numpy.zeros(shape=(self.translationAxesCount,len(self.cameraAxes)))
+        if positions is None:
+           positions = self.motor_state.get_positions()
+        # cumulated rotation seen by each translation axis
         R=self.mI
-        j=0
-        for axis in self.gonioAxes: # skip base gonio axis
-           if axis['type'] =="rotation":
-              Ra=self.rotation_matrix(axis['direction'],axis['motor_HO'].getPosition())
-              R=numpy.dot(Ra,R)
-           elif axis['type'] == "translation":
-              f=numpy.dot(R,axis['direction'])
-              k=0
-              for camera_axis in self.cameraAxes:
-                 F[j][k]=numpy.dot(f,camera_axis['direction'])
-                 k += 1
-              j += 1
-        return F
+        rotations=[R]
+        for axis in self.rotationAxes:
+           R=numpy.dot(self.rotation_matrix(axis['direction'],positions[axis['motor_name']],axis),R)
+           rotations.append(R)
+        rotations=numpy.array(rotations)[self.translationStages]
+        f=numpy.einsum('jab,jb->ja',rotations,self.translationDirections)
+        return numpy.dot(f,self.cameraDirections.T)
 
     def calibrate(self): 
         count = 0
+        self.rotationAxes = []
+        self.translationAxes = []
+        self.translationStages = []
         for axis in self.gonioAxes: # make first gonio rotation matrix for base axis
            if axis['type'] == 'rotation':
               d=axis['direction']
@@ -140,40 +144,53 @@ class CentringMath(Device):
               axis['mC']=numpy.array([[ 0.0 ,-d[2], d[1]],
                                      [ d[2], 0.0 ,-d[0] ],
                                      [-d[1], d[0], 0.0  ]])
+              self.rotationAxes.append(axis)
            elif axis['type'] == 'translation':
               axis['index']= count
               count += 1
+              self.translationAxes.append(axis)
+              self.translationStages.append(len(self.rotationAxes))
         self.translationAxesCount = count 
+        self.translationDirections = numpy.array([axis['direction'] for axis in self.translationAxes],dtype=float).reshape(count,3)
         count = 0
         for axis in self.cameraAxes:
            axis['index']=count
            count += 1
+        self.cameraDirections = numpy.array([axis['direction'] for axis in self.cameraAxes],dtype=float).reshape(count,3)
+        # gonio positions from the motor signals
+        self.motor_state = diffractometer_state.DiffractometerState(\
+            dict([(axis['motor_name'], axis['motor_HO']) for axis in self.gonioAxes]))
+        self.factorized_version = None
+        self.initCentringProcedure()
 
-    def rotation_matrix(self,dir,angle):
+    def rotation_matrix(self,dir,angle,axis=None):
         rads = angle * math.pi/180.0
         cosa=math.cos(rads)
         sina=math.sin(rads)
-        mT=numpy.outer(dir,dir)
-        mC=numpy.array([[ 0.0   ,-dir[2], dir[1]],
-                       [ dir[2], 0.0   ,-dir[0] ],
-                       [-dir[1], dir[0], 0.0    ]])
+        if axis is not None:
+           mT=axis['mT']
+           mC=axis['mC']
+        else:
+           mT=numpy.outer(dir,dir)
+           mC=numpy.array([[ 0.0   ,-dir[2], dir[1]],
+                          [ dir[2], 0.0   ,-dir[0] ],
+                          [-dir[1], dir[0], 0.0    ]])
         return self.mI * cosa + mT * (1. - cosa) + mC * sina
 
-    def translation_datum(self):
-        vector=[]
-        for axis in self.gonioAxes:
-           if axis['type'] == "translation":
-             vector.append(axis['motor_HO'].getPosition())
-        return vector
+    def translation_datum(self, positions=None):
+        if positions is None:
+           positions = self.motor_state.get_positions()
+        return numpy.array([positions[axis['motor_name']] for axis in self.translationAxes],dtype=float)
 
     def centred_positions_to_vector(self,centrings_dictionary):
-        vector=numpy.zeros(shape=(self.translationAxesCount))
-        index = 0 
-        for axis in self.gonioAxes:
-           if axis['type'] == "translation":
-              vector[index]=float(centrings_dictionary[axis['motor_name']])
-              index += 1
-        return vector
+        return numpy.array([float(centrings_dictionary[axis['motor_name']]) for axis in self.translationAxes])
+
+    def centred_positions_to_array(self,list_of_centring_dicts):
+        """
+        Descript. : stacks centrings in a (N, translationAxesCount) array
+        """
+        names = [axis['motor_name'] for axis in self.translationAxes]
+        return numpy.array([[float(centring[name]) for name in names] for centring in list_of_centring_dicts]).reshape(-1,self.translationAxesCount)
 
     def vector_to_centred_positions(self,vector,return_by_name=False):
         dic = {}
@@ -222,3 +239,43 @@ class CentringMath(Device):
                for camaxis in self.cameraAxes:
                    res = res + numpy.dot(axis['direction'],camaxis['direction'])*camxy[camaxis['axis_name']]
                return res
+
+
+if __name__ == '__main__':
+    # micro-benchmark: projection of N stored centred positions to screen
+    import time
+
+    class _Motor:
+        def __init__(self, position):
+            self.position = position
+        def getPosition(self):
+            return self.position
+        def connect(self, signal, slot):
+            pass
+
+    cm = CentringMath("centring")
+    cm.gonioAxes = [{'type':'translation','direction':[0,0,-1],'motor_name':'phiz','motor_HO':_Motor(0.1)},
+                    {'type':'rotation','direction':[1,0,0],'motor_name':'phi','motor_HO':_Motor(30.)},
+                    {'type':'translation','direction':[0,1,0],'motor_name':'sampx','motor_HO':_Motor(0.2)},
+                    {'type':'translation','direction':[0,0,1],'motor_name':'sampy','motor_HO':_Motor(0.3)}]
+    cm.cameraAxes = [{'axis_name':'X','direction':[0,1,0]},
+                     {'axis_name':'Y','direction':[0,0,-1]}]
+    cm.mI = numpy.diag([1.,1.,1.])
+    cm.calibrate()
+
+    for n in (1, 10, 100, 1000, 10000):
+        centrings = [{'phiz':0.001*i,'sampx':0.002*i,'sampy':-0.001*i} for i in range(n)]
+        repeat = max(1, 10000 // n)
+
+        t0 = time.time()
+        for r in range(repeat):
+            cm.listOfCentringsToScreen(centrings)
+        batched = (time.time() - t0) / repeat
+
+        t0 = time.time()
+        for r in range(repeat):
+            cm.factorize()
+            [cm.centringToScreen(c, factorized=True) for c in centrings]
+        single = (time.time() - t0) / repeat
+
+        print "%6d points: batched %9.3f ms, one by one %9.3f ms" % (n, batched*1E3, single*1E3)
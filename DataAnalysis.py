@@ -1,6 +1,10 @@
 import os
+import time
+import signal
 import logging
+import itertools
 import gevent.event
+import gevent.queue
 import threading
 import subprocess
 import AbstractDataAnalysis
@@ -26,11 +30,18 @@ from XSDataCommon import XSDataInteger
 from XSDataCommon import XSDataSize
 from XSDataCommon import XSDataString
 
+# fast input/output for the XSData bindings
+import xsdata_io
+
 #from edna_test_data import EDNA_DEFAULT_INPUT
 #from edna_test_data import EDNA_TEST_DATA
 
 
 class EdnaProcessingThread(threading.Thread):
+    """
+    Runs the EDNA command in a thread, <edna_cmd> is either a shell command
+    or a callable (see fake_edna_command) called with the same arguments.
+    """
     def __init__(self, edna_cmd, edna_input_file, edna_output_file, base_dir):
         threading.Thread.__init__(self)
 
@@ -38,6 +49,8 @@ class EdnaProcessingThread(threading.Thread):
         self.edna_input_file = edna_input_file
         self.edna_output_file = edna_output_file
         self.base_dir = base_dir
+        self.process = None
+        self.killed = False
 
     def start(self):
         self.edna_processing_watcher = gevent.get_hub().loop.async()
@@ -49,8 +62,175 @@ class EdnaProcessingThread(threading.Thread):
         self.edna_processing_watcher.start(self.edna_processing_done.set)
         args = (self.edna_cmd, self.edna_input_file,
                 self.edna_output_file, self.base_dir)
-        subprocess.call("%s %s %s %s" % args, shell=True)
-        self.edna_processing_watcher.send()
+        try:
+            if callable(self.edna_cmd):
+                self.edna_cmd(*args[1:])
+            elif not self.killed:
+                # own process group, to be able to kill EDNA and not only
+                # the shell
+                self.process = subprocess.Popen("%s %s %s %s" % args,
+                                                shell=True, preexec_fn=os.setsid)
+                if self.killed:
+                    # killed while it was starting
+                    self.kill()
+                self.process.wait()
+        finally:
+            self.edna_processing_watcher.send()
+
+    def kill(self):
+        self.killed = True
+        if self.process is not None and self.process.poll() is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+
+def fake_edna_command(edna_input_file, edna_output_file, base_dir, delay=1):
+    """
+    In-process replacement of the EDNA command, for tests and mockups:
+    writes an EDNA result without collection plan after <delay> seconds.
+    """
+    time.sleep(delay)
+    edna_input = XSDataInputMXCuBE.parseFile(edna_input_file)
+    edna_result = XSDataResultMXCuBE()
+    edna_result.setCharacterisationExecutiveSummary(XSDataString("Fake characterisation of %d images" % \
+        sum([len(data_set.getImageFile()) for data_set in edna_input.getDataSet()])))
+    edna_result.exportToFile(edna_output_file)
+
+
+class CharacterisationJob(object):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, job_id, edna_input, callback=None):
+        self.id = job_id
+        self.edna_input = edna_input
+        self.callback = callback
+        self.status = CharacterisationJob.QUEUED
+        self.result = None
+        self.edna_thread = None
+        self.done_event = gevent.event.Event()
+
+    def is_finished(self):
+        return self.done_event.is_set()
+
+
+class CharacterisationJobManager(object):
+    """
+    Runs the characterisation jobs submitted with submit() on a pool of
+    <max_workers> greenlets, <run_fun> is called with the job and returns
+    the EDNA result. Completion callbacks are called with the job.
+    """
+    def __init__(self, run_fun, max_workers=1, max_finished_jobs=100):
+        self.run_fun = run_fun
+        self.max_workers = max(1, max_workers)
+        self.max_finished_jobs = max_finished_jobs
+        self._queue = gevent.queue.Queue()
+        self._jobs = {}
+        self._finished = []
+        self._ids = itertools.count(1)
+        self._workers = []
+
+    def submit(self, edna_input, callback=None):
+        """
+        Queues a characterisation, returns the job id
+        """
+        job = CharacterisationJob(self._ids.next(), edna_input, callback)
+        self._jobs[job.id] = job
+        self._queue.put(job)
+
+        if len(self._workers) < self.max_workers and \
+          self._queue.qsize() > len([w for w in self._workers if w.idle]):
+            self._start_worker()
+
+        return job.id
+
+    def _start_worker(self):
+        worker = gevent.spawn(self._worker)
+        worker.idle = False
+        self._workers.append(worker)
+
+    def _worker(self):
+        worker = gevent.getcurrent()
+
+        while True:
+            worker.idle = True
+            job = self._queue.get()
+            worker.idle = False
+
+            if job.status == CharacterisationJob.CANCELLED:
+                continue
+
+            job.status = CharacterisationJob.RUNNING
+            try:
+                job.result = self.run_fun(job)
+            except:
+                if job.status != CharacterisationJob.CANCELLED:
+                    logging.getLogger("queue_exec").exception("Characterisation job %d failed", job.id)
+                    job.status = CharacterisationJob.FAILED
+            else:
+                if job.status != CharacterisationJob.CANCELLED:
+                    job.status = CharacterisationJob.DONE
+            self._finish(job)
+
+    def _finish(self, job):
+        if job.is_finished():
+            return
+        job.done_event.set()
+
+        self._finished.append(job.id)
+        while len(self._finished) > self.max_finished_jobs:
+            self._jobs.pop(self._finished.pop(0), None)
+
+        if callable(job.callback):
+            try:
+                job.callback(job)
+            except:
+                logging.getLogger("queue_exec").exception("Error in characterisation job %d callback", job.id)
+
+    def get_job(self, job_id):
+        return self._jobs[job_id]
+
+    def status(self, job_id):
+        return self._jobs[job_id].status
+
+    def result(self, job_id, timeout=None):
+        """
+        Waits for the end of job <job_id>, returns its result (None if
+        it failed or was cancelled)
+        """
+        job = self._jobs[job_id]
+        job.done_event.wait(timeout)
+        return job.result
+
+    def cancel(self, job_id):
+        job = self._jobs[job_id]
+        if job.is_finished():
+            return False
+
+        was_running = job.status == CharacterisationJob.RUNNING
+        job.status = CharacterisationJob.CANCELLED
+        if was_running:
+            # the worker finishes the job when EDNA is gone
+            if job.edna_thread is not None:
+                job.edna_thread.kill()
+        else:
+            self._finish(job)
+        return True
+
+    def jobs(self):
+        """
+        [(job id, status), ...] of the known jobs, in submission order
+        """
+        return [(job_id, self._jobs[job_id].status) for job_id in sorted(self._jobs)]
+
+    def is_busy(self):
+        return len([job for job in self._jobs.itervalues() \
+                    if not job.is_finished()]) > 0
 
 
 class DataAnalysis(AbstractDataAnalysis.AbstractDataAnalysis, HardwareObject):
@@ -58,11 +238,15 @@ class DataAnalysis(AbstractDataAnalysis.AbstractDataAnalysis, HardwareObject):
         HardwareObject.__init__(self, name)
         self.collect_obj = None
         self.result = None
-        self.processing_done_event = gevent.event.Event()
+        self.job_manager = None
 
     def init(self):
         self.collect_obj = self.getObjectByRole("collect")
         self.start_edna_command = self.getProperty("edna_command")
+        if self.start_edna_command == "fake":
+            self.start_edna_command = fake_edna_command
+        self.job_manager = CharacterisationJobManager(self._run_characterisation,
+            self.getProperty("max_characterisations") or 1)
         self.edna_default_file = self.getProperty("edna_default_file")
         hwr_dir = HardwareRepository().getHardwareRepositoryPath()
 
@@ -210,6 +394,37 @@ class DataAnalysis(AbstractDataAnalysis.AbstractDataAnalysis, HardwareObject):
         return edna_input
 
     def characterise(self, edna_input):
+        """
+        Runs the characterisation and waits for its result
+        """
+        job_id = self.submit_characterisation(edna_input)
+        self.result = self.job_manager.result(job_id)
+        return self.result
+
+    def submit_characterisation(self, edna_input, callback=None):
+        """
+        Queues the characterisation and returns immediately, <callback> is
+        called with the CharacterisationJob when it is finished.
+
+        :returns: the job id
+        :rtype: int
+        """
+        return self.job_manager.submit(edna_input, callback)
+
+    def get_characterisation_status(self, job_id):
+        return self.job_manager.status(job_id)
+
+    def get_characterisation_result(self, job_id, timeout=None):
+        return self.job_manager.result(job_id, timeout)
+
+    def cancel_characterisation(self, job_id):
+        return self.job_manager.cancel(job_id)
+
+    def get_characterisation_jobs(self):
+        return self.job_manager.jobs()
+
+    def _run_characterisation(self, job):
+        edna_input = job.edna_input
         path = edna_input.process_directory
 
         # if there is no data collection id, the id will be a random number
@@ -231,18 +446,22 @@ class DataAnalysis(AbstractDataAnalysis.AbstractDataAnalysis, HardwareObject):
         else:
             raise RuntimeError("No process directory specified in edna_input")
 
-        msg = "Starting EDNA using xml file %r", edna_input_file
+        if job.status == CharacterisationJob.CANCELLED:
+            # cancelled before EDNA was started
+            return None
+
+        msg = "Starting EDNA (job %d) using xml file %r" % (job.id, edna_input_file)
         logging.getLogger("queue_exec").info(msg)
 
-        edna_processing_thread = \
+        job.edna_thread = \
           EdnaProcessingThread(self.start_edna_command, edna_input_file,
                                edna_results_file, path)
 
-        self.processing_done_event = edna_processing_thread.start()
-        self.processing_done_event.wait()
-        self.result = XSDataResultMXCuBE.parseFile(edna_results_file)
+        job.edna_thread.start().wait()
 
-        return self.result
+        if job.status == CharacterisationJob.CANCELLED:
+            return None
+        return XSDataResultMXCuBE.parseFile(edna_results_file)
 
     def is_running(self):
-        return not self.processing_done_event.is_set()
+        return self.job_manager is not None and self.job_manager.is_busy()
@@ -5,18 +5,17 @@ import os
 import copy
 import time
 import logging
-import tempfile
 import gevent
 import random
 from gevent.event import AsyncResult
 
 import queue_model_objects_v1 as qmo
+import snapshot_service
 
 from HardwareRepository import HardwareRepository
 from HardwareRepository.TaskUtils import *
 from HardwareRepository.BaseHardwareObjects import Equipment
 
-from Qub.Tools import QubImageSave
 
 class myimage:
     """
@@ -31,14 +30,7 @@ class myimage:
         self.zoom = 1
         if matrix is not None:
             self.zoom = matrix.m11()
-        self.img = self.drawing.getPPP()
-        fd, name = tempfile.mkstemp()
-        os.close(fd)
-        QubImageSave.save(name, self.img, self.drawing.canvas(), self.zoom, "JPEG")
-        f = open(name, "r")
-        self.imgcopy = f.read()
-        f.close()
-        os.unlink(name)
+        self.imgcopy = snapshot_service.encode_snapshot(self.drawing)
     def __str__(self):
         """
         Descript. :
@@ -382,6 +374,13 @@ class DiffractometerMockup(Equipment):
         """ 
         return last_centred_position[0], last_centred_position[1]
 
+    def motor_positions_list_to_screen(self, centred_positions_list):
+        """
+        Descript. :
+        """
+        return [self.motor_positions_to_screen(centred_positions_dict) \
+                for centred_positions_dict in centred_positions_list]
+
     def manual_centring_done(self, manual_centring_procedure):
         """
         Descript. :
@@ -5,7 +5,7 @@ import os
 import time
 import logging
 import gevent 
-import subprocess
+import autoprocessing
 
 from XSDataAutoprocv1_0 import XSDataAutoprocInput
 
@@ -35,6 +35,8 @@ class EMBLAutoProcessing(HardwareObject):
         Descript. :
         """
         self.autoproc_programs = self["programs"]
+        autoprocessing.get_dispatcher().configure(self.getProperty("max_processes"),
+                                                  self.getProperty("image_interval"))
 
     def execute_autoprocessing(self, process_event, params_dict, frame_number):
         """
@@ -78,25 +80,27 @@ class EMBLAutoProcessing(HardwareObject):
                     if process_event == "after": 
                         input_filename, will_execute = self.create_autoproc_input(process_event, params_dict)
                         if will_execute:
-                            endOfLineToExecute = ' ' + input_filename + ' ' + \
-                                params_dict["fileinfo"]["directory"]
+                            args = [input_filename, params_dict["fileinfo"]["directory"]]
                     if process_event == 'image':
                         if frame_number == 1 or frame_number == params_dict['oscillation_sequence'][0]['number_of_images']:
-                            endOfLineToExecute = " %s %s/%s_%d_%05d.cbf" % (params_dict["fileinfo"]["directory"],
-                               params_dict["fileinfo"]["directory"], 
-                               params_dict["fileinfo"]["prefix"],
-                               params_dict["fileinfo"]["run_number"], 
-                               frame_number)
+                            args = [params_dict["fileinfo"]["directory"],
+                                    "%s/%s_%d_%05d.cbf" % (params_dict["fileinfo"]["directory"],
+                                                           params_dict["fileinfo"]["prefix"],
+                                                           params_dict["fileinfo"]["run_number"], 
+                                                           frame_number)]
                             will_execute = True 	
                     if will_execute:	
-                        lineToExecute = executable + endOfLineToExecute
-                        #logging.info("Process event %s, executing %s" % (process_event, str(lineToExecute)))
-                        subprocess.Popen(str(lineToExecute), shell = True, 
-                                    stdin = None, stdout = None, stderr = None, 
-                                    close_fds = True)	
+                        # first and last images only, nothing to coalesce
+                        autoprocessing.get_dispatcher().submit(process_event, executable, args)
                 else:
                     logging.getLogger().error("EMBLAutoprocessing: No program to execute found (%s)", executable)
 
+    def get_status(self):
+        """
+        Descript. : running, queued and recently finished processes
+        """
+        return autoprocessing.get_status()
+
     def autoproc_done(self, current_autoproc):
         """
         Descript. :
@@ -151,7 +155,11 @@ class EMBLAutoProcessing(HardwareObject):
                 logging.debug('EMBLAutoprocessing: XDS.INP file is there, size={0}'.\
                         format(os.stat(autoproc_xds_filename).st_size))
             else:
-                os.system("ls %s> /dev/null"%(os.path.dirname(autoproc_path)))
+                # refreshes the NFS directory cache
+                try:
+                    os.listdir(os.path.dirname(autoproc_path))
+                except OSError:
+                    pass
                 gevent.sleep(WAIT_XDS_RESOLUTION)
         if not xds_appeared:
             logging.error('EMBLAutoprocessing: XDS.INP file ({0}) failed to appear after {1} seconds'.\
@@ -6,9 +6,7 @@ import os
 import time
 import gevent
 import logging
-import PyChooch
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_agg import FigureCanvasAgg
+from energy_scan_analysis import ScanPoints, energy_in_eV, run_chooch, save_scan_files
 from HardwareRepository.TaskUtils import *
 from HardwareRepository.BaseHardwareObjects import Equipment
 
@@ -31,7 +29,7 @@ class EMBLEnergyScan(Equipment):
         self.thEdge = None
         self.previousResolution = None
         self.lastResolution = None
-        self.scanData = None
+        self.scanData = ScanPoints()
         
         self.energy2WavelengthConstant = None
         self.defaultWavelength = None
@@ -129,13 +127,10 @@ class EMBLEnergyScan(Equipment):
                 y = values[-1][1]
                 if not (x == 0 and y == 0):	
                     # if x is in keV, transform into eV otherwise let it like it is
-	            # if point larger than previous point (for chooch)
-                    if len(self.scanData) > 0: 
-                        if x > self.scanData[-1][0]:
-                            self.scanData.append([(x < 1000 and x*1000.0 or x), y])
-                    else:
-                        self.scanData.append([(x < 1000 and x*1000.0 or x), y])
-                    self.emit('scanNewPoint', ((x < 1000 and x*1000.0 or x), y, ))	
+                    # only points larger than previous point are kept (for chooch)
+                    x = energy_in_eV(x)
+                    self.scanData.append(x, y, increasing=True)
+                    self.emit('scanNewPoint', (x, y, ))	
             except:
                 pass
 
@@ -177,7 +172,7 @@ class EMBLEnergyScan(Equipment):
         self._edge = edge
         self.scanInfo = {"sessionId": session_id, "blSampleId": blsample_id,
                          "element": element,"edgeEnergy": edge}
-        self.scanData = []
+        self.scanData.clear()
         if not os.path.isdir(directory):
             logging.getLogger("HWR").debug("EnergyScan: creating directory %s" % directory)
             try:
@@ -289,7 +284,7 @@ class EMBLEnergyScan(Equipment):
 
         if os.path.exists(scan_file_prefix + ".raw"):
             i = 1
-            while os.path.exists(scan_file_prefix + ".raw"):
+            while os.path.exists(scan_file_prefix + "_%d.raw" % i):
                   i = i + 1
             scan_file_prefix += "_%d" % i
             archive_file_prefix += "_%d" % i
@@ -313,33 +308,18 @@ class EMBLEnergyScan(Equipment):
             return
 
         try:
-            scan_file_raw = open(scan_file_raw_filename, "w")
-            archive_file_raw = open(archive_file_raw_filename, "w")
+            result = run_chooch(self.scanData, elt, edge, scan_file_efs_filename)
         except:
-            logging.getLogger("HWR").exception("EMBLEnergyScan: could not create energy scan result raw file")
+            logging.getLogger("HWR").exception("EMBLEnergyScan: Chooch failed")
             self.store_energy_scan()
             self.emit("energyScanFailed", ())
             return
-        else:
-            scanData = []
-            for i in range(len(self.scanData)):
-                x = float(self.scanData[i][0])
-                x = x < 1000 and x * 1000.0 or x 
-                y = float(self.scanData[i][1])
-                scanData.append((x, y))
-                scan_file_raw.write("%f,%f\r\n" % (x, y))
-                archive_file_raw.write("%f,%f\r\n" % (x, y)) 
-            scan_file_raw.close()
-            archive_file_raw.close()
-            self.scanInfo["scanFileFullPath"] = str(scan_file_raw_filename)
-
-        pk, fppPeak, fpPeak, ip, fppInfl, fpInfl, chooch_graph_data = \
-             PyChooch.calc(scanData, elt, edge, scan_file_efs_filename)
-
-        rm = (pk + 30) / 1000.0
-        pk = pk / 1000.0
-        savpk = pk
-        ip = ip / 1000.0
+
+        pk = result.pk
+        ip = result.ip
+        rm = result.rm
+        fppPeak, fpPeak = result.fppPeak, result.fpPeak
+        fppInfl, fpInfl = result.fppInfl, result.fpInfl
         comm = ""
         logging.getLogger("HWR").info("EMBLEnergyScan : Results th. Edge %s ; chooch results are pk=%f, ip=%f, rm=%f" %\
                (self.thEdgeThreshold, pk, ip, rm))
@@ -352,18 +332,7 @@ class EMBLEnergyScan(Equipment):
    
           logging.getLogger("HWR").warning('EMBLEnergyScan: calculated peak (%f) is more that 20eV %s the theoretical value (%f). Please check your scan and choose the energies manually' % (savpk, (self.thEdge - ip) > 0.02 and "below" or "above", self.thEdge))"""
 
-        try:
-            fi = open(scan_file_efs_filename)
-            fo = open(archive_file_efs_filename, "w")
-        except:
-            self.store_energy_scan()
-            self.emit("energyScanFailed", ())
-            return
-        else:
-            fo.write(fi.read())
-            fi.close()
-            fo.close()
-
+        self.scanInfo["scanFileFullPath"] = str(scan_file_raw_filename)
         self.scanInfo["peakEnergy"] = pk
         self.scanInfo["inflectionEnergy"] = ip
         self.scanInfo["remoteEnergy"] = rm
@@ -373,43 +342,26 @@ class EMBLEnergyScan(Equipment):
         self.scanInfo["inflectionFDoublePrime"] = fppInfl
         self.scanInfo["comments"] = comm
 
-        chooch_graph_x, chooch_graph_y1, chooch_graph_y2 = zip(*chooch_graph_data)
-        chooch_graph_x = list(chooch_graph_x)
-        for i in range(len(chooch_graph_x)):
-            chooch_graph_x[i] = chooch_graph_x[i] / 1000.0
+        chooch_graph_x = result.graph_x_keV()
+        chooch_graph_y1 = result.graph_y1
+        chooch_graph_y2 = result.graph_y2
 
-        #logging.getLogger("HWR").info("EMBLEnergyScan: Saving png" )
-        # prepare to save png files
         title = "%s  %s  %s\n%.4f  %.2f  %.2f\n%.4f  %.2f  %.2f" % \
               ("energy", "f'", "f''", pk, fpPeak, fppPeak, ip, fpInfl, fppInfl) 
-        fig = Figure(figsize = (15, 11))
-        ax = fig.add_subplot(211)
-        ax.set_title("%s\n%s" % (scan_file_efs_filename, title))
-        ax.grid(True)
-        ax.plot(*(zip(*scanData)), **{"color": 'black'})
-        ax.set_xlabel("Energy")
-        ax.set_ylabel("MCA counts")
-        ax2 = fig.add_subplot(212)
-        ax2.grid(True)
-        ax2.set_xlabel("Energy")
-        ax2.set_ylabel("")
-        handles = []
-        handles.append(ax2.plot(chooch_graph_x, chooch_graph_y1, color = 'blue'))
-        handles.append(ax2.plot(chooch_graph_x, chooch_graph_y2, color = 'red'))
-        canvas = FigureCanvasAgg(fig)
 
-        self.scanInfo["jpegChoochFileFullPath"] = str(archive_file_png_filename)
-        try:
-            logging.getLogger("HWR").info("Rendering energy scan and Chooch graphs to PNG file : %s", scan_file_png_filename)
-            canvas.print_figure(scan_file_png_filename, dpi = 80)
-        except:
-            logging.getLogger("HWR").exception("could not print figure")
-        try:
-            logging.getLogger("HWR").info("Saving energy scan to archive directory for ISPyB : %s", archive_file_png_filename)
-            canvas.print_figure(archive_file_png_filename, dpi = 80)
-        except:
-            logging.getLogger("HWR").exception("could not save figure")
+        # raw files, archive copy of the efs file and graphs are written
+        # in the background, only their names are needed for ISPyB
+        logging.getLogger("HWR").info("Rendering energy scan and Chooch graphs to PNG files : %s, %s", \
+               scan_file_png_filename, archive_file_png_filename)
+        save_scan_files(self.scanData,
+                        raw_files = (scan_file_raw_filename, archive_file_raw_filename),
+                        copies = ((scan_file_efs_filename, archive_file_efs_filename),),
+                        png_files = (scan_file_png_filename, archive_file_png_filename),
+                        chooch_result = result,
+                        graph_x = chooch_graph_x,
+                        title = "%s\n%s" % (scan_file_efs_filename, title))
 
+        self.scanInfo["jpegChoochFileFullPath"] = str(archive_file_png_filename)
         self.store_energy_scan()
 
         logging.getLogger("HWR").info("<chooch> returning" )
@@ -560,7 +512,7 @@ class EMBLEnergyScan(Equipment):
         """
         Descript. :
         """
-        return self.scanData 
+        return self.scanData.tolist()
 
     def store_energy_scan(self):
         """
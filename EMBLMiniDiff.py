@@ -5,11 +5,11 @@ import os
 import copy
 import time
 import logging
-import tempfile
 import gevent
 from gevent.event import AsyncResult
-from Qub.Tools import QubImageSave
 
+import motor_wait
+import snapshot_service
 import queue_model_objects_v1 as queue_model_objects
 
 from HardwareRepository import HardwareRepository
@@ -29,15 +29,7 @@ class myimage:
         self.zoom = 1
         if matrix is not None:
             self.zoom = matrix.m11()
-        self.image = self.drawing.getPPP()
-        fd, name = tempfile.mkstemp()
-        os.close(fd)
-        QubImageSave.save(name, self.image, self.drawing.canvas(), \
-                          self.zoom, "JPEG")
-        f = open(name, "r")
-        self.image_copy = f.read()
-        f.close()
-        os.unlink(name)
+        self.image_copy = snapshot_service.encode_snapshot(self.drawing)
 
     def __str__(self):
         """
@@ -852,7 +844,29 @@ class EMBLMiniDiff(Equipment):
         y = (xy['Y'] + c['beam_y']) * self.pixels_per_mm_y + \
              self.zoom_centre['y']
         return x, y
- 
+
+    def motor_positions_list_to_screen(self, centred_positions_list):
+        """
+        Descript. : projects a list of centred positions to screen
+                    coordinates with one batched matrix product
+        """
+        kappa = self.current_positions_dict["kappa"]
+        phi = self.current_positions_dict["kappa_phi"]
+
+        shifted_positions_list = []
+        for c in centred_positions_list:
+            if (c['kappa'], c['kappa_phi']) != (kappa, phi) \
+             and self.minikappa_correction_hwobj is not None:
+                # the centred positions of the caller are left unchanged
+                c = dict(c)
+                c['sampx'], c['sampy'], c['phiy'] = self.minikappa_correction_hwobj.shift(
+                c['kappa'], c['kappa_phi'], [c['sampx'], c['sampy'], c['phiy']], kappa, phi)
+            shifted_positions_list.append(c)
+        xy_list = self.centring_hwobj.listOfCentringsToScreen(shifted_positions_list)
+        return [((xy['X'] + c['beam_x']) * self.pixels_per_mm_x + self.zoom_centre['x'],
+                 (xy['Y'] + c['beam_y']) * self.pixels_per_mm_y + self.zoom_centre['y']) \
+                for xy, c in zip(xy_list, shifted_positions_list)]
+
     def manual_centring_done(self, manual_centring_procedure):
         """
         Descript. :
@@ -985,10 +999,7 @@ class EMBLMiniDiff(Equipment):
                 if motor is None:
                     continue
                 motor_position_dict[motor] = position   
-            #logging.getLogger("HWR").info("Moving motor '%s' to %f", motor.getMotorMnemonic(), position)
-            motor.move(position)
-        while any([motor.motorIsMoving() for motor in motor_position_dict.iterkeys()]):
-            time.sleep(0.5)
+        motor_wait.move_motors(motor_position_dict)
         """with gevent.Timeout(15):
              while not all([m.getState() == m.READY for m in motors_positions if m is not None]):
                    time.sleep(0.1)"""
@@ -7,9 +7,8 @@ import os
 import httplib
 import math
 import calc_gaps
-import PyChooch
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_agg import FigureCanvasAgg
+from GetStaticPars import GetStaticParameters
+from energy_scan_analysis import ScanPoints, run_chooch, save_scan_files
 
 
 class FixedEnergy:
@@ -30,58 +29,6 @@ class TunableEnergy:
         return self._tunable_bl.energy_obj.startMoveEnergy(energy, wait=True)
 
     
-class GetStaticParameters:
-    def __init__(self, element, edge):
-        self.element = element
-        self.edge = edge
-        config_file = "/users/blissadm/local/spec/userconf/EdgeScan.dat"
-        self.STATICPARS_DICT = {}
-        self.STATICPARS_DICT = self._readParamsFromFile(config_file)
-
-    def _readParamsFromFile(self, config_file):
-        try:
-            f = open(config_file)
-            array = []
-            for line in f:
-                if not line.startswith('#'):
-                    array.append(line.split())
-                else:
-                    pass
-        except:
-            return []
-        else:
-            larr = []
-            for k in range(len(array)):
-                if self.element == array[k][1] and self.edge[0] == array[k][2]:
-                    larr = map(float,array[k][3:13])
-                    larr.append(float(array[k][17]))
-            if self.edge == "K":
-                to_delete = [1,2,3,4,5,6,7]
-            else:
-                try:
-                    if int(self.edge[1]) == 1:
-                        to_delete = [0,1,2,4,5,6,7]
-                    elif int(self.edge[1]) == 2:
-                        to_delete = [0,1,2,3,5,6,7]
-                    else:
-                        to_delete = [0,1,2,3,4,6,7]
-                except:
-                    to_delete = [0,1,2,3,4,6,7]
-            for ii in sorted(to_delete, reverse=True):
-                del larr[ii]
-
-            static_pars = {}
-            larr[0] /= 1000
-            static_pars["edgeEnergy"] = larr[0]
-            static_pars["startEnergy"] = larr[0] - 0.05
-            static_pars["endEnergy"] = larr[0] + 0.05
-            static_pars["findattEnergy"] = larr[0] + 0.03
-            static_pars["remoteEnergy"] = larr[0] + 1
-            static_pars["eroi_min"] = larr[1]
-            static_pars["eroi_max"] = larr[2]
-            
-            return static_pars
-        
 class ESRFEnergyScan(AbstractEnergyScan, HardwareObject):
     def __init__(self, name, tunable_bl):
         AbstractEnergyScan.__init__(self)
@@ -226,44 +173,22 @@ class ESRFEnergyScan(AbstractEnergyScan, HardwareObject):
         if not os.path.exists(os.path.dirname(scanArchiveFilePrefix)):
             os.makedirs(os.path.dirname(scanArchiveFilePrefix))
         
+        scanData = ScanPoints()
+        raw_data_file = os.path.join(os.path.dirname(scanFilePrefix), 'data.raw')
         try:
-            f=open(rawScanFile, "w")
-            pyarch_f=open(archiveRawScanFile, "w")
+            scanData.load(raw_data_file, skip_lines=2, delimiter='\t')
         except:
-            logging.getLogger("HWR").exception("could not create raw scan files")
+            logging.getLogger("HWR").exception("could not read raw scan data")
             self.storeEnergyScan()
             self.emit("energyScanFailed", ())
             return
-        else:
-            scanData = []
-            
-            raw_data_file = os.path.join(os.path.dirname(scanFilePrefix), 'data.raw')
-            try:
-                raw_file = open(raw_data_file, 'r')
-            except:
-                self.storeEnergyScan()
-                self.emit("energyScanFailed", ())
-                return
-
-            for line in raw_file.readlines()[2:]:
-                (x, y) = line.split('\t')
-                x = float(x.strip())
-                y = float(y.strip())
-                #x = x < 1000 and x*1000.0 or x
-                scanData.append((x, y))
-                f.write("%f,%f\r\n" % (x, y))
-                pyarch_f.write("%f,%f\r\n"% (x, y))
-
-
-            f.close()
-            pyarch_f.close()
-            self.energy_scan_parameters["scanFileFullPath"]=str(archiveRawScanFile)
-
-        pk, fppPeak, fpPeak, ip, fppInfl, fpInfl, chooch_graph_data = PyChooch.calc(scanData, elt, edge, scanFile)
-        rm=(pk+30)/1000.0
-        pk=pk/1000.0
+        self.energy_scan_parameters["scanFileFullPath"]=str(archiveRawScanFile)
+
+        result = run_chooch(scanData, elt, edge, scanFile)
+        pk, fppPeak, fpPeak = result.pk, result.fppPeak, result.fpPeak
+        ip, fppInfl, fpInfl = result.ip, result.fppInfl, result.fpInfl
+        rm = result.rm
         savpk = pk
-        ip=ip/1000.0
         comm = ""
         self.thEdge = self.energy_scan_parameters['edgeEnergy']
         logging.getLogger("HWR").info("th. Edge %s ; chooch results are pk=%f, ip=%f, rm=%f" % (self.thEdge, pk,ip,rm))
@@ -279,17 +204,6 @@ class ESRFEnergyScan(AbstractEnergyScan, HardwareObject):
           logging.getLogger("HWR").warning('EnergyScan: calculated peak (%f) is more that 20eV %s the theoretical value (%f). Please check your scan and choose the energies manually' % (savpk, (self.thEdge - ip) > 0.02 and "below" or "above", self.thEdge))
 
         archiveEfsFile=os.path.extsep.join((scanArchiveFilePrefix, "efs"))
-        try:
-          fi=open(scanFile)
-          fo=open(archiveEfsFile, "w")
-        except:
-          self.storeEnergyScan()
-          self.emit("energyScanFailed", ())
-          return
-        else:
-          fo.write(fi.read())
-          fi.close()
-          fo.close()
 
         self.energy_scan_parameters["peakEnergy"]=pk
         self.energy_scan_parameters["inflectionEnergy"]=ip
@@ -300,43 +214,22 @@ class ESRFEnergyScan(AbstractEnergyScan, HardwareObject):
         self.energy_scan_parameters["inflectionFDoublePrime"]=fppInfl
         self.energy_scan_parameters["comments"] = comm
 
-        chooch_graph_x, chooch_graph_y1, chooch_graph_y2 = zip(*chooch_graph_data)
-        chooch_graph_x = list(chooch_graph_x)
-        for i in range(len(chooch_graph_x)):
-          chooch_graph_x[i]=chooch_graph_x[i]/1000.0
+        chooch_graph_x = result.graph_x_keV()
+        chooch_graph_y1, chooch_graph_y2 = result.graph_y1, result.graph_y2
 
-        logging.getLogger("HWR").info("<chooch> Saving png" )
-        # prepare to save png files
         title="%10s  %6s  %6s\n%10s  %6.2f  %6.2f\n%10s  %6.2f  %6.2f" % ("energy", "f'", "f''", pk, fpPeak, fppPeak, ip, fpInfl, fppInfl) 
-        fig=Figure(figsize=(15, 11))
-        ax=fig.add_subplot(211)
-        ax.set_title("%s\n%s" % (scanFile, title))
-        ax.grid(True)
-        ax.plot(*(zip(*scanData)), **{"color":'black'})
-        ax.set_xlabel("Energy")
-        ax.set_ylabel("MCA counts")
-        ax2=fig.add_subplot(212)
-        ax2.grid(True)
-        ax2.set_xlabel("Energy")
-        ax2.set_ylabel("")
-        handles = []
-        handles.append(ax2.plot(chooch_graph_x, chooch_graph_y1, color='blue'))
-        handles.append(ax2.plot(chooch_graph_x, chooch_graph_y2, color='red'))
-        canvas=FigureCanvasAgg(fig)
 
         escan_png = os.path.extsep.join((scanFilePrefix, "png"))
         escan_archivepng = os.path.extsep.join((scanArchiveFilePrefix, "png")) 
         self.energy_scan_parameters["jpegChoochFileFullPath"]=str(escan_archivepng)
-        try:
-          logging.getLogger("HWR").info("Rendering energy scan and Chooch graphs to PNG file : %s", escan_png)
-          canvas.print_figure(escan_png, dpi=80)
-        except:
-          logging.getLogger("HWR").exception("could not print figure")
-        try:
-          logging.getLogger("HWR").info("Saving energy scan to archive directory for ISPyB : %s", escan_archivepng)
-          canvas.print_figure(escan_archivepng, dpi=80)
-        except:
-          logging.getLogger("HWR").exception("could not save figure")
+
+        # raw files, efs archive copy and graphs are written in the background
+        logging.getLogger("HWR").info("Rendering energy scan and Chooch graphs to PNG files : %s, %s", escan_png, escan_archivepng)
+        save_scan_files(scanData, raw_files=(rawScanFile, archiveRawScanFile),
+                        copies=((scanFile, archiveEfsFile),),
+                        png_files=(escan_png, escan_archivepng),
+                        chooch_result=result, graph_x=chooch_graph_x,
+                        title="%s\n%s" % (scanFile, title))
 
         self.energy_scan_parameters['endTime']=time.strftime("%Y-%m-%d %H:%M:%S")
         self.storeEnergyScan()
@@ -2,12 +2,20 @@
 A client for ISPyB Webservices. 
 """
 
+import os
+import copy
+import json
+import time
 import logging
+import functools
+import collections
 import gevent
+import gevent.event
 import suds; logging.getLogger("suds").setLevel(logging.INFO)
 
 from suds.transport.http import HttpAuthenticated
 from suds.client import Client
+from suds.plugin import MessagePlugin
 from suds import WebFault
 from suds.sudsobject import asdict
 from urllib2 import URLError
@@ -16,6 +24,8 @@ from datetime import datetime
 from collections import namedtuple
 from pprint import pformat
 
+import timings
+
 
 # Production web-services:    http://160.103.210.1:8080/ispyb-ejb3/ispybWS/
 # Test web-services:          http://160.103.210.4:8080/ispyb-ejb3/ispybWS/
@@ -38,42 +48,220 @@ SampleReference = namedtuple('SampleReference', ['code',
                                                  'sample_reference',
                                                  'container_code'])
 
-def trace(fun):
-    def _trace(*args):      
-        log_msg = "lims client " + fun.__name__ + " called with: "
-        
-        for arg in args[1:]:
+
+class SampleReferenceIndex(object):
+    """
+    Dictionary indexes of sample references by code, by location
+    (container_reference, sample_reference) and by both. A matched
+    sample reference is not returned by find() any more.
+    """
+    def __init__(self, sample_refs):
+        self.sample_refs = list(sample_refs)
+        self._matched = set()
+        self._by_code = {}
+        self._by_location = {}
+        self._by_code_location = {}
+        self._positions = {}
+
+        for i, sample_ref in enumerate(self.sample_refs):
+            self._positions[id(sample_ref)] = i
+            location = (sample_ref.container_reference,
+                        sample_ref.sample_reference)
+            self._by_code.setdefault(sample_ref.code, []).append(i)
+            self._by_location.setdefault(location, []).append(i)
+            self._by_code_location.setdefault((sample_ref.code, location), []).append(i)
+
+
+    def find(self, code = None, location = None):
+        """
+        Returns the first unmatched sample reference with <code> and/or
+        <location>.
+        """
+        if code and location:
+            indexes = self._by_code_location.get((code, tuple(location)), [])
+        elif code:
+            indexes = self._by_code.get(code, [])
+        elif location:
+            indexes = self._by_location.get(tuple(location), [])
+        else:
+            return None
+
+        for i in indexes:
+            if i not in self._matched:
+                return self.sample_refs[i]
+
+        return None
+
+
+    def remove(self, sample_ref):
+        i = self._positions[id(sample_ref)]
+        if i in self._matched:
+            raise ValueError("sample reference already matched")
+        self._matched.add(i)
+
+
+    def unmatched(self):
+        return [ref for i, ref in enumerate(self.sample_refs) \
+                if i not in self._matched]
+
+class _Pformat(object):
+    """
+    Formats <values> for the trace messages, only when a message is
+    actually emitted.
+    """
+    __slots__ = ("values", )
+
+    def __init__(self, values):
+        self.values = values
+
+
+    def __str__(self):
+        formatted = []
+
+        for value in self.values:
             try:
-                log_msg += pformat(arg, indent = 4, width = 80) + ', '
+                formatted.append(pformat(value, indent = 4, width = 80))
             except:
                 pass
 
-        logging.getLogger("ispyb_client").debug(log_msg)        
-        result = fun(*args)
+        return ", ".join(formatted)
+
+
+class WSCallStats(object):
+    """
+    Latency histogram (see timings.Histogram), error count and payload
+    sizes of the calls to a web-service method.
+    """
+    def __init__(self):
+        self.latency = timings.Histogram()
+        self.errors = 0
+        self.last_error = None
+        self.request_bytes = 0
+        self.request_bytes_max = 0
+        self.reply_bytes = 0
+        self.reply_bytes_max = 0
+
+
+    def add(self, duration, request_size, reply_size, error = None):
+        self.latency.add(duration)
+        if error is not None:
+            self.errors += 1
+            self.last_error = error
+        self.request_bytes += request_size
+        self.request_bytes_max = max(self.request_bytes_max, request_size)
+        self.reply_bytes += reply_size
+        self.reply_bytes_max = max(self.reply_bytes_max, reply_size)
+
+
+    def as_dict(self):
+        calls = self.latency.count
+        return {"calls": calls,
+                "errors": self.errors,
+                "last_error": self.last_error,
+                "latency": self.latency.as_dict(),
+                "request_bytes_mean": self.request_bytes / calls if calls else None,
+                "request_bytes_max": self.request_bytes_max,
+                "reply_bytes_mean": self.reply_bytes / calls if calls else None,
+                "reply_bytes_max": self.reply_bytes_max}
+
+
+class WSMetrics(MessagePlugin):
+    """
+    Statistics of the web-service calls, by method name.
+
+    Installed as a suds plugin, to get the size of the SOAP messages, and
+    as a proxy of the client service (see meter()) to time the calls.
+    """
+    def __init__(self):
+        self.stats = {}
+        self._sizes = {}
+
+
+    def meter(self, client):
+        client.service = _MeteredService(client.service, self)
+        return client
+
+
+    def sending(self, context):
+        self._sizes[gevent.getcurrent()] = [len(context.envelope or ""), 0]
+
+
+    def received(self, context):
+        sizes = self._sizes.get(gevent.getcurrent())
+        if sizes is not None:
+            sizes[1] = len(context.reply or "")
+
+
+    def call(self, name, method, *args, **kwargs):
+        error = None
+        t0 = time.time()
 
         try:
-            result_msg = "lims client " + fun.__name__ + \
-                " returned  with: " + pformat(result, indent = 4, width = 80)
-        except:
-            pass
-            
-        logging.getLogger("ispyb_client").debug(result_msg)
+            return method(*args, **kwargs)
+        except Exception, ex:
+            error = "%s: %s" % (ex.__class__.__name__, ex)
+            raise
+        finally:
+            duration = time.time() - t0
+            request_size, reply_size = \
+                self._sizes.pop(gevent.getcurrent(), (0, 0))
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = WSCallStats()
+            stats.add(duration, request_size, reply_size, error)
+
+
+    def as_dict(self):
+        return dict([(name, stats.as_dict()) \
+                     for name, stats in self.stats.iteritems()])
+
+
+    def clear(self):
+        self.stats.clear()
+
+
+class _MeteredService(object):
+    def __init__(self, service, metrics):
+        self._service = service
+        self._metrics = metrics
+
+
+    def __getattr__(self, name):
+        method = getattr(self._service, name)
+        call = self._metrics.call
+
+        def _metered(*args, **kwargs):
+            return call(name, method, *args, **kwargs)
+
+        return _metered
+
+
+def trace(fun):
+    logger = logging.getLogger("ispyb_client")
+
+    @functools.wraps(fun)
+    def _trace(*args):
+        if not logger.isEnabledFor(logging.DEBUG):
+            return fun(*args)
+
+        logger.debug("lims client %s called with: %s", fun.__name__,
+                     _Pformat(args[1:]))
+        result = fun(*args)
+        logger.debug("lims client %s returned  with: %s", fun.__name__,
+                     _Pformat((result, )))
         return result
 
     return _trace
 
 
 def in_greenlet(fun):
+    logger = logging.getLogger("ispyb_client")
+
+    @functools.wraps(fun)
     def _in_greenlet(*args, **kwargs):
-        log_msg = "lims client " + fun.__name__ + " called with: "
-        
-        for arg in args[1:]:
-            try:
-                log_msg += pformat(arg, indent = 4, width = 80) + ', '
-            except:
-                pass
-                
-        logging.getLogger("ispyb_client").debug(log_msg)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("lims client %s called with: %s", fun.__name__,
+                         _Pformat(args[1:]))
         task = gevent.spawn(fun, *args)
         if kwargs.get("wait", False):
           task.get()
@@ -95,6 +283,259 @@ def utf_encode(res_d):
     return res_d
 
 
+def utf_encode_json(json_d):
+    """
+    object_hook for json.load, encodes the unicode strings in utf8 like
+    utf_encode does for the web-service results.
+    """
+    return dict([(key.encode('utf8'), value.encode('utf8') \
+                  if isinstance(value, unicode) else value) \
+                 for key, value in json_d.iteritems()])
+
+
+class ImageStoreQueue(object):
+    """
+    Gathers image records and stores them in batches, off the data
+    collection path.
+
+    A batch is flushed when <batch_size> records are pending or
+    <flush_interval> seconds after the first pending record. At most
+    <max_pending> records are kept in memory, put() flushes synchronously
+    when the limit is reached. Records that can not be stored because of
+    a connection error (after <max_retries> retries) are appended to the
+    spool file and replayed on the next flush.
+    """
+    def __init__(self, store_fun, batch_size=100, flush_interval=5,
+                 max_pending=1000, max_retries=3, retry_delay=1,
+                 spool_file=None):
+        self.store_fun = store_fun
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max(max_pending, batch_size)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.spool_file = spool_file
+
+        self._pending = collections.deque()
+        self._flush_task = None
+        self._flush_timer = None
+
+
+    def __len__(self):
+        return len(self._pending)
+
+
+    def put(self, image_dict):
+        if len(self._pending) >= self.max_pending:
+            self.flush(wait=True)
+
+        self._pending.append(image_dict)
+
+        if len(self._pending) >= self.batch_size:
+            self.flush(wait=False)
+        elif self._flush_timer is None:
+            self._flush_timer = gevent.spawn_later(self.flush_interval,
+                                                   self.flush, wait=False)
+
+
+    def flush(self, wait=True, timeout=None):
+        """
+        Stores all pending (and spooled) records.
+
+        :returns: The flushing greenlet
+        """
+        if self._flush_task is None or self._flush_task.ready():
+            self._flush_task = gevent.spawn(self._flush)
+
+        if wait:
+            self._flush_task.join(timeout)
+
+            # records added while flushing
+            if self._pending and self._flush_task.ready():
+                return self.flush(wait, timeout)
+
+        return self._flush_task
+
+
+    def _flush(self):
+        if self._flush_timer is not None:
+            self._flush_timer.kill(block=False)
+            self._flush_timer = None
+
+        spooled = self._read_spool()
+
+        if spooled:
+            logging.getLogger("ispyb_client").info(\
+                "Storing %d spooled image(s)" % len(spooled))
+            self._pending.extendleft(reversed(spooled))
+
+        while self._pending:
+            batch = [self._pending.popleft() for i in \
+                     range(min(self.batch_size, len(self._pending)))]
+
+            if not self._store_batch(batch):
+                # connection lost, keep everything for the next flush
+                self._write_spool(list(self._pending))
+                self._pending.clear()
+                break
+
+
+    def _store_batch(self, batch):
+        for i, image_dict in enumerate(batch):
+            attempt = 0
+
+            while True:
+                try:
+                    self.store_fun(image_dict)
+                except URLError:
+                    if attempt >= self.max_retries:
+                        logging.getLogger("ispyb_client").\
+                            exception(_CONNECTION_ERROR_MSG)
+                        self._write_spool(batch[i:])
+                        return False
+
+                    gevent.sleep(self.retry_delay * 2**attempt)
+                    attempt += 1
+                except WebFault:
+                    logging.getLogger("ispyb_client").\
+                        exception("ISPyBClient: exception in store_image")
+                    break
+                else:
+                    break
+
+        return True
+
+
+    def _read_spool(self):
+        if not self.spool_file or not os.path.exists(self.spool_file):
+            return []
+
+        records = []
+
+        try:
+            with open(self.spool_file) as spool:
+                for line in spool:
+                    if line.strip():
+                        records.append(json.loads(line))
+            os.remove(self.spool_file)
+        except (IOError, OSError, ValueError):
+            logging.getLogger("ispyb_client").\
+                exception("Could not read image spool file %s" % self.spool_file)
+
+        return records
+
+
+    def _write_spool(self, records):
+        if not records:
+            return
+
+        if not self.spool_file:
+            logging.getLogger("ispyb_client").error(\
+                "%d image(s) could not be stored in ISPyB" % len(records))
+            return
+
+        try:
+            # readable by the owner only
+            with os.fdopen(os.open(self.spool_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                                   0600), "a") as spool:
+                for image_dict in records:
+                    spool.write(json.dumps(image_dict) + "\n")
+        except (IOError, OSError, TypeError, ValueError):
+            logging.getLogger("ispyb_client").\
+                exception("Could not write image spool file %s" % self.spool_file)
+
+
+class WriteBehindQueue(object):
+    """
+    Writes records to ISPyB in the background, in order for a given key.
+
+    Records with the same key are coalesced: if a record is still pending
+    when a new one is put, only the newest one is written. Records are
+    written one at a time by a single greenlet, connection errors are
+    retried <max_retries> times with exponential backoff. put() blocks
+    if <max_pending> keys are pending.
+    """
+    def __init__(self, write_fun, max_pending=100, max_retries=5,
+                 retry_delay=1):
+        self.write_fun = write_fun
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+        self._pending = collections.OrderedDict()
+        self._in_flight = None
+        self._changed = gevent.event.Event()
+        self._worker = None
+
+
+    def depth(self):
+        """
+        Returns the number of records waiting to be written.
+        """
+        return len(self._pending) + (1 if self._in_flight is not None else 0)
+
+
+    def put(self, key, record):
+        while key not in self._pending and \
+                len(self._pending) >= self.max_pending:
+            self._changed.clear()
+            self._changed.wait()
+
+        self._pending[key] = record
+
+        if self._worker is None or self._worker.ready():
+            self._worker = gevent.spawn(self._run)
+
+
+    def is_pending(self, key):
+        return key in self._pending or \
+            (self._in_flight is not None and self._in_flight == key)
+
+
+    def wait(self, key=None, timeout=None):
+        """
+        Waits until the records with <key> (all records if None) are
+        written, returns False on timeout.
+        """
+        with gevent.Timeout(timeout, False):
+            while self.depth() if key is None else self.is_pending(key):
+                self._changed.clear()
+                self._changed.wait()
+            return True
+
+        return False
+
+
+    def _run(self):
+        while self._pending:
+            key, record = self._pending.popitem(last=False)
+            self._in_flight = key
+
+            try:
+                self._write(key, record)
+            except:
+                logging.getLogger("ispyb_client").\
+                    exception("ISPyBClient: could not write %r" % (key, ))
+            finally:
+                self._in_flight = None
+                self._changed.set()
+
+
+    def _write(self, key, record):
+        attempt = 0
+
+        while True:
+            try:
+                return self.write_fun(record)
+            except URLError:
+                if attempt >= self.max_retries:
+                    raise
+                logging.getLogger("ispyb_client").warning(\
+                    "ISPyBClient: could not write %r, retrying" % (key, ))
+                gevent.sleep(self.retry_delay * 2**attempt)
+                attempt += 1
+
+
 class ISPyBClient2(HardwareObject):
     """
     Web-service client for ISPyB.
@@ -108,6 +549,12 @@ class ISPyBClient2(HardwareObject):
         self.__translations = {}
         self.__disabled = False
         self.beamline_name = False
+        self.image_queue = None
+        self.data_collection_queue = WriteBehindQueue(self._update_data_collection)
+        self.samples_cache_ttl = 300
+        self.samples_cache_dir = None
+        self.__samples_cache = {}
+        self.ws_metrics = WSMetrics()
         
         logger = logging.getLogger('ispyb_client')
         
@@ -156,12 +603,16 @@ class ISPyBClient2(HardwareObject):
                                       password = _WS_PASSWORD)
                 
                 try: 
-                    self.__shipping = Client(_WS_SHIPPING_URL, timeout = 3,
-                                             transport = t1, cache = None)
-                    self.__collection = Client(_WS_COLLECTION_URL, timeout = 3,
-                                               transport = t2, cache = None)
-                    self.__tools_ws = Client(_WS_BL_SAMPLE_URL, timeout = 3,
-                                             transport = t3, cache = None)
+                    plugins = [self.ws_metrics]
+                    self.__shipping = self.ws_metrics.meter(\
+                        Client(_WS_SHIPPING_URL, timeout = 3, transport = t1,
+                               cache = None, plugins = plugins))
+                    self.__collection = self.ws_metrics.meter(\
+                        Client(_WS_COLLECTION_URL, timeout = 3, transport = t2,
+                               cache = None, plugins = plugins))
+                    self.__tools_ws = self.ws_metrics.meter(\
+                        Client(_WS_BL_SAMPLE_URL, timeout = 3, transport = t3,
+                               cache = None, plugins = plugins))
                     
                 except URLError:
                     logging.getLogger("ispyb_client")\
@@ -196,6 +647,55 @@ class ISPyBClient2(HardwareObject):
 
         self.beamline_name = session_hwobj.beamline_name
 
+        self.samples_cache_ttl = \
+            float(self.getProperty("samples_cache_ttl") or self.samples_cache_ttl)
+        # the cache contains user data: no disk cache if no (private)
+        # directory is configured
+        self.samples_cache_dir = self.getProperty("samples_cache_dir")
+        if self.samples_cache_dir and not os.path.isdir(self.samples_cache_dir):
+            try:
+                os.makedirs(self.samples_cache_dir, 0700)
+            except OSError:
+                logging.getLogger("ispyb_client").exception(\
+                    "Could not create samples cache directory %s" % self.samples_cache_dir)
+                self.samples_cache_dir = None
+
+        # one spool file per instance, no spool (images not stored during
+        # a LIMS outage are only logged) if not configured
+        spool_file = self.getProperty("image_spool_file")
+        if not spool_file:
+            logging.getLogger("ispyb_client").warning(\
+                "No image_spool_file configured, images are not spooled")
+
+        self.image_queue = ImageStoreQueue(self._store_image,
+            batch_size = int(self.getProperty("image_batch_size") or 100),
+            flush_interval = float(self.getProperty("image_flush_interval") or 5),
+            max_pending = int(self.getProperty("image_max_pending") or 1000),
+            spool_file = spool_file)
+
+    def get_ws_metrics(self):
+        """
+        Returns the statistics of the web-service calls by method name:
+        number of calls and errors, latency histogram and mean/max
+        request and reply sizes (bytes).
+        """
+        return self.ws_metrics.as_dict()
+
+
+    def log_ws_metrics(self):
+        """
+        Logs a summary of the web-service calls, slowest methods first.
+        """
+        stats = sorted(self.ws_metrics.stats.iteritems(),
+                       key = lambda item: item[1].latency.total, reverse = True)
+
+        for name, method_stats in stats:
+            latency = method_stats.latency
+            logging.getLogger("ispyb_client").info(\
+                "%s: %d calls, %d errors, mean %.3f s, p90 %.3f s, max %.3f s, reply max %d bytes" % \
+                (name, latency.count, method_stats.errors, latency.total / latency.count,
+                 latency.percentile(0.9), latency.max, method_stats.reply_bytes_max))
+
     def translate(self, code, what):  
         """
         Given a proposal code, returns the correct code to use in the GUI,
@@ -478,47 +978,85 @@ class ISPyBClient2(HardwareObject):
         return blSetupId
 
 
-    #@trace
-    @in_greenlet
     def update_data_collection(self, mx_collection, wait=False):
         """
         Updates the datacollction mx_collection, this requires that the
         collectionId attribute is set and exists in the database.
 
+        The update is written in the background by the
+        data_collection_queue, pending updates of the same data collection
+        are replaced by the newest one.
+
         :param mx_collection: The dictionary with collections parameters.
         :type mx_collection: dict
 
+        :param wait: Wait until the update is written.
+        :type wait: bool
+
         :returns: None
         """  
         if self.__disabled:
             return
 
+        if 'collection_id' in mx_collection:
+            try:
+                mx_collection = copy.deepcopy(mx_collection)
+            except:
+                mx_collection = dict(mx_collection)
+
+            logging.getLogger("ispyb_client").debug(\
+                "lims client update_data_collection called for collection %s" % \
+                mx_collection['collection_id'])
+
+            self.data_collection_queue.put(mx_collection['collection_id'],
+                                           mx_collection)
+            if wait:
+                self.data_collection_queue.wait(mx_collection['collection_id'])
+        else:
+            logging.getLogger("ispyb_client").error("Error in update_data_collection: " + \
+                                    "collection-id missing, the ISPyB data-collection is not updated.")
+
+
+    def _update_data_collection(self, mx_collection):
         if self.__collection:
-            if 'collection_id' in mx_collection:
-                try:
-                    # Update the data collection group
-                    self.store_data_collection_group(mx_collection)
-                
-                    data_collection = ISPyBValueFactory().\
-                        from_data_collect_parameters(self.__collection, mx_collection)
-  
-                    self.__collection.service.\
-                        storeOrUpdateDataCollection(data_collection)
-                except WebFault:
-                    logging.getLogger("ispyb_client").\
-                        exception("ISPyBClient: exception in update_data_collection")
-                except URLError:
-                    logging.getLogger("ispyb_client").exception(_CONNECTION_ERROR_MSG)
-            else:
-                logging.getLogger("ispyb_client").error("Error in update_data_collection: " + \
-                                        "collection-id missing, the ISPyB data-collection is not updated.")
-                
+            try:
+                # Update the data collection group
+                self.store_data_collection_group(mx_collection)
+            
+                data_collection = ISPyBValueFactory().\
+                    from_data_collect_parameters(self.__collection, mx_collection)
+
+                self.__collection.service.\
+                    storeOrUpdateDataCollection(data_collection)
+            except WebFault:
+                logging.getLogger("ispyb_client").\
+                    exception("ISPyBClient: exception in update_data_collection")
         else:
             logging.getLogger("ispyb_client").\
                 exception("Error in update_data_collection: could not connect" + \
                           " to server")
 
 
+    def wait_data_collection_updated(self, collection_id = None, timeout = None):
+        """
+        Waits until the pending updates of the data collection
+        <collection_id> (of all data collections if None) are written.
+
+        :returns: False on timeout
+        :rtype: bool
+        """
+        return self.data_collection_queue.wait(collection_id, timeout)
+
+
+    def get_pending_updates(self):
+        """
+        :returns: The number of data collection updates waiting to be
+                  written to ISPyB.
+        :rtype: int
+        """
+        return self.data_collection_queue.depth()
+
+
     @trace
     def update_bl_sample(self, bl_sample):
         """
@@ -556,60 +1094,54 @@ class ISPyBClient2(HardwareObject):
 
         :returns: None
         """
+        try:
+            self._store_image(image_dict)
+        except WebFault:
+            logging.getLogger("ispyb_client").\
+                exception("ISPyBClient: exception in store_image")
+        except URLError:
+            logging.getLogger("ispyb_client").exception(_CONNECTION_ERROR_MSG)
+
+
+    def _store_image(self, image_dict):
         if self.__disabled:
             return
         
         if self.__collection:
             if 'dataCollectionId' in image_dict:
-                try:
-                    self.__collection.service.storeOrUpdateImage(image_dict)
-                except WebFault:
-                    logging.getLogger("ispyb_client").\
-                        exception("ISPyBClient: exception in store_image")
-                except URLError:
-                    logging.getLogger("ispyb_client").exception(_CONNECTION_ERROR_MSG)
+                self.__collection.service.storeOrUpdateImage(image_dict)
             else:
                 logging.getLogger("ispyb_client").error("Error in store_image: " + \
                                                         "data_collection_id missing, could not store image in ISPyB")
         else:
             logging.getLogger("ispyb_client").\
                 exception("Error in store_image: could not connect to server")
-        
-    
-    def __find_sample(self, sample_ref_list, code = None, location = None):
+
+
+    def queue_image(self, image_dict):
         """
-        Returns the sample with the matching "search criteria" <code> and/or
-        <location> with-in the list sample_ref_list.
+        Queues the image (image parameters) <image_dict> to be stored
+        with the next batch, see ImageStoreQueue.
 
-        The sample_ref object is defined in the head of the file.
-        
-        :param sample_ref_list: The list of sample_refs to search.
-        :type sample_ref: list
-        
-        :param code: The vial datamatrix code (or bar code)
-        :param type: str
+        :param image_dict: A dictonary with image pramaters.
+        :type image_dict: dict
 
-        :param location: A tuple (<basket>, <vial>) to search for.
-        :type location: tuple
+        :returns: None
         """
-        for sample_ref in sample_ref_list:
-            
-            if code and location:
-                if sample_ref.code == code and \
-                        sample_ref.container_reference == location[0] and \
-                        sample_ref.sample_reference == location[1]:
-                    return sample_ref
-            elif code:
-                if sample_ref.code == code:
-                    return sample_ref
-            elif location:
-                if sample_ref.container_reference == location[0] and \
-                       sample_ref.sample_reference == location[1]:
-                    return sample_ref
+        if self.image_queue is None:
+            return self.store_image(image_dict)
 
-        return None
+        self.image_queue.put(image_dict)
 
 
+    def flush_images(self, wait=False):
+        """
+        Stores all the queued images.
+        """
+        if self.image_queue is not None:
+            return self.image_queue.flush(wait)
+        
+    
     @trace 
     def get_samples(self, proposal_id, session_id):
         response_samples = None
@@ -631,7 +1163,8 @@ class ISPyBClient2(HardwareObject):
 
 
     @trace
-    def get_session_samples(self, proposal_id, session_id, sample_refs):
+    def get_session_samples(self, proposal_id, session_id, sample_refs,
+                            refresh = False):
         """
         Retrives the list of samples associated with the session <session_id>.
         The samples from ISPyB is cross checked with the ones that are
@@ -651,73 +1184,60 @@ class ISPyBClient2(HardwareObject):
                             objects
         :type sample_refs: list (of sample_ref objects).
 
+        :param refresh: Reads the samples from ISPyB even if the cached
+                        ones are recent enough (explicit user refresh).
+        :type refresh: bool
+
         :returns: A list with sample_ref objects.
         :rtype: list
         """
         if self.__tools_ws: 
-            sample_references = []
-            session = self.get_session(session_id)
-            response_samples = []
-
-            for sample_ref in sample_refs:
-                sample_reference = SampleReference(*sample_ref)
-                sample_references.append(sample_reference)
-            
-            try:
-                response_samples = self.__tools_ws.service.\
-                    findSampleInfoLightForProposal(proposal_id, 
-                                                   self.beamline_name)
-
-            except WebFault, e:
-                logging.getLogger("ispyb_client").exception(e.message)
-            except URLError:
-                logging.getLogger("ispyb_client").exception(_CONNECTION_ERROR_MSG)
+            sample_references = SampleReferenceIndex(\
+                [SampleReference(*sample_ref) for sample_ref in sample_refs])
                 
             samples = []
-            for sample in response_samples:
+            for sample in self.get_proposal_samples(proposal_id, refresh):
                 try:
+                    # the cached samples are shared, work on a copy
+                    sample = dict(sample)
                     loc = [None, None]
                     try:
-                      loc[0]=int(sample.containerSampleChangerLocation)
+                      loc[0]=int(sample.get('containerSampleChangerLocation'))
                     except:
                       pass
                     try:
-                      loc[1]=int(sample.sampleLocation) 
+                      loc[1]=int(sample.get('sampleLocation')) 
                     except: 
                       pass
 
                     # Unmatched sample, just catch and do nothing
                     # (dont remove from sample_ref)
-                    if not sample.code and \
-                            not sample.sampleLocation:
+                    if not sample.get('code') and \
+                            not sample.get('sampleLocation'):
                         pass
                     # Sample location and code was found in ISPyB and they match
                     # with the sample changer.
-                    elif sample.code and sample.sampleLocation:
+                    elif sample.get('code') and sample.get('sampleLocation'):
                         sc_sample = \
-                            self.__find_sample(sample_references,
-                                               code = sample.code,
-                                               location = loc)
+                            sample_references.find(code = sample['code'],
+                                                   location = loc)
 
                         # The sample codes dose not match
                         if not sc_sample:
-                            sc_sample = self.__find_sample(sample_references,
-                                                           location = loc)
+                            sc_sample = sample_references.find(location = loc)
                             
                             if sc_sample.code != '':
-                                sample.code = sc_sample.code
+                                sample['code'] = sc_sample.code
 
                         sample_references.remove(sc_sample)
                             
                             
                     # Only location was found, update with the code 
                     # from sample changer if it exists.
-                    elif sample.sampleLocation:
-                        sc_sample = \
-                            self.__find_sample(sample_references,
-                                               location = loc)
+                    elif sample.get('sampleLocation'):
+                        sc_sample = sample_references.find(location = loc)
                         if sc_sample:
-                            sample.sampleCode = sc_sample.code 
+                            sample['sampleCode'] = sc_sample.code 
                             sample_references.remove(sc_sample)
 
                     # Sample code was found in ISPyB but dosent match with
@@ -726,50 +1246,31 @@ class ISPyBClient2(HardwareObject):
                     # Use the information from the sample changer.
                     else:
                         #Use sample changer code for sample  ?
-                        sample.containerSampleChangerLocation = \
+                        sample['containerSampleChangerLocation'] = \
                             sample_references.containter_referance
-                        sample.sampleLocation = \
+                        sample['sampleLocation'] = \
                             sample_references.sample_reference
 
-                        loc = (int(sample.containerSampleChangerLocation),
-                               int(sample.sampleLocation))
+                        loc = (int(sample['containerSampleChangerLocation']),
+                               int(sample['sampleLocation']))
 
-                        sc_sample = \
-                            self.__find_sample(sample_references,
-                                               location = loc)
+                        sc_sample = sample_references.find(location = loc)
                         if sc_sample:
-                            sample.code = sc_sample.code 
+                            sample['code'] = sc_sample.code 
                             sample_references.remove(sc_sample)
 
 
-                    samples.append(utf_encode(asdict(sample)))
-                    
-#                         {'BLSample': utf_encode(asdict(sample.blSample)),
-#                          'Container': utf_encode(asdict(sample.container)),
-#                          'Crystal': utf_encode(asdict(sample.crystal)),
-#                          'DiffractionPlan_BLSample': \
-#                              utf_encode(asdict(sample.diffractionPlan)),
-#                          'Protein': utf_encode(asdict(sample.protein))})
+                    samples.append(sample)
                 except:
                     pass
 
 
             # Add the unmatched samples to the result from ISPyB
-            for sample_ref in sample_references:
+            for sample_ref in sample_references.unmatched():
                 samples.append(
                     {'code': sample_ref.code, 
                      'location': sample_ref.sample_reference,
                      'containerSampleChangerLocation': sample_ref.container_reference})
-                #  samples.append(
-#                     {'BLSample': {'code': sample_ref.code, 
-#                                   'location': \
-#                                   sample_ref.sample_reference},
-#                      'Container': {'sampleChangerLocation': \
-#                                        sample_ref.container_reference},
-#                      'Crystal': {},
-#                      'DiffractionPlan_BLSample': {},
-#                      'Protein': {}})
-
             
             return {'loaded_sample': samples, 
                     'status': {'code':'ok'}}
@@ -779,6 +1280,111 @@ class ISPyBClient2(HardwareObject):
                           "to server")
 
 
+    def get_proposal_samples(self, proposal_id, refresh = False):
+        """
+        Returns the samples of the proposal <proposal_id> for this beamline,
+        as a list of dictionaries (findSampleInfoLightForProposal).
+
+        The samples are cached in memory, and on disk if samples_cache_dir
+        is configured, for samples_cache_ttl seconds (see
+        invalidate_samples_cache). The cached samples are returned if
+        ISPyB can not be reached.
+
+        :param proposal_id: ISPyB proposal id.
+        :type proposal_id: int
+
+        :param refresh: Reads the samples from ISPyB even if the cached
+                        ones are recent enough.
+        :type refresh: bool
+
+        :returns: A list of sample dictionaries, not to be modified.
+        :rtype: list
+        """
+        key = (proposal_id, self.beamline_name)
+        cached = self.__samples_cache.get(key) or self.__read_samples_cache(key)
+
+        # on refresh, the cached samples are only used if ISPyB can not
+        # be reached
+        if cached and not refresh and \
+               time.time() - cached[0] < self.samples_cache_ttl:
+            return cached[1]
+
+        try:
+            response_samples = self.__tools_ws.service.\
+                findSampleInfoLightForProposal(proposal_id, 
+                                               self.beamline_name)
+        except WebFault, e:
+            logging.getLogger("ispyb_client").exception(e.message)
+        except URLError:
+            logging.getLogger("ispyb_client").exception(_CONNECTION_ERROR_MSG)
+        else:
+            samples = [utf_encode(asdict(sample)) for sample in response_samples or []]
+            cached = (time.time(), samples)
+            self.__samples_cache[key] = cached
+            self.__write_samples_cache(key, cached)
+
+        return cached[1] if cached else []
+
+
+    def invalidate_samples_cache(self, proposal_id = None):
+        """
+        Drops the cached samples of <proposal_id>, or of all proposals.
+        """
+        for key in self.__samples_cache.keys():
+            if proposal_id is None or key[0] == proposal_id:
+                del self.__samples_cache[key]
+
+        if self.samples_cache_dir and os.path.isdir(self.samples_cache_dir):
+            if proposal_id is None:
+                prefix = "ispyb_samples_%s_" % self.beamline_name
+                cache_files = [os.path.join(self.samples_cache_dir, filename) \
+                               for filename in os.listdir(self.samples_cache_dir) \
+                               if filename.startswith(prefix) and filename.endswith(".json")]
+            else:
+                cache_files = [self.__samples_cache_file((proposal_id, self.beamline_name))]
+            for cache_file in cache_files:
+                try:
+                    os.remove(cache_file)
+                except OSError:
+                    pass
+
+
+    def __samples_cache_file(self, key):
+        if self.samples_cache_dir:
+            return os.path.join(self.samples_cache_dir,
+                                "ispyb_samples_%s_%s.json" % (key[1], key[0]))
+
+
+    def __read_samples_cache(self, key):
+        cache_file = self.__samples_cache_file(key)
+
+        if cache_file and os.path.isfile(cache_file):
+            try:
+                with open(cache_file) as f:
+                    cached = json.load(f, object_hook = utf_encode_json)
+                cached = (cached["time"], cached["samples"])
+                self.__samples_cache[key] = cached
+                return cached
+            except (IOError, ValueError, KeyError):
+                logging.getLogger("ispyb_client").\
+                    exception("Could not read samples cache %s" % cache_file)
+
+
+    def __write_samples_cache(self, key, cached):
+        cache_file = self.__samples_cache_file(key)
+
+        if cache_file:
+            try:
+                # readable by the owner only
+                with os.fdopen(os.open(cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                       0600), "w") as f:
+                    json.dump({"time": cached[0], "samples": cached[1]}, f,
+                              default = str)
+            except (IOError, OSError, TypeError, ValueError):
+                logging.getLogger("ispyb_client").\
+                    exception("Could not write samples cache %s" % cache_file)
+
+
     @trace
     def get_bl_sample(self, bl_sample_id):
         """
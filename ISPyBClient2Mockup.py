@@ -148,6 +148,26 @@ class ISPyBClient2Mockup(HardwareObject):
         pass
 
 
+    def wait_data_collection_updated(self, collection_id = None, timeout = None):
+        """
+        Waits until the pending updates of the data collection
+        <collection_id> (of all data collections if None) are written.
+
+        :returns: False on timeout
+        :rtype: bool
+        """
+        return True
+
+
+    def get_pending_updates(self):
+        """
+        :returns: The number of data collection updates waiting to be
+                  written to ISPyB.
+        :rtype: int
+        """
+        return 0
+
+
     def update_bl_sample(self, bl_sample):
         """
         Creates or stos a BLSample entry. 
@@ -169,6 +189,26 @@ class ISPyBClient2Mockup(HardwareObject):
         """
         pass
 
+
+    def queue_image(self, image_dict):
+        """
+        Queues the image (image parameters) <image_dict> to be stored
+        with the next batch.
+
+        :param image_dict: A dictonary with image pramaters.
+        :type image_dict: dict
+
+        :returns: None
+        """
+        pass
+
+
+    def flush_images(self, wait=False):
+        """
+        Stores all the queued images.
+        """
+        pass
+
     
     def __find_sample(self, sample_ref_list, code = None, location = None):
         """
@@ -191,9 +231,17 @@ class ISPyBClient2Mockup(HardwareObject):
 
     def get_samples(self, proposal_id, session_id):
         pass
+
+
+    def invalidate_samples_cache(self, proposal_id = None):
+        """
+        Drops the cached samples of <proposal_id>, or of all proposals.
+        """
+        pass
     
         
-    def get_session_samples(self, proposal_id, session_id, sample_refs):
+    def get_session_samples(self, proposal_id, session_id, sample_refs,
+                            refresh = False):
         """
         Retrives the list of samples associated with the session <session_id>.
         The samples from ISPyB is cross checked with the ones that are
@@ -4,10 +4,57 @@ Lima video HO to capture images from camera
 import time
 import logging
 import gevent
+import numpy
 from Lima import Core
 from Qub.CTools import pixmaptools
 from HardwareRepository import BaseHardwareObjects
 from HardwareRepository.HardwareObjects.Camera import JpegType, BayerType, MmapType, RawType
+from video_frame_hub import FrameHub
+
+# Lima video modes: pixel type, and number of values per pixel (None:
+# one, "I420": planar YUV 4:2:0, i.e 1.5 bytes per pixel)
+_VIDEO_MODES = (("Y8", numpy.uint8, None),
+                ("Y16", numpy.uint16, None),
+                ("Y32", numpy.uint32, None),
+                ("Y64", numpy.uint64, None),
+                ("RGB555", numpy.uint16, None),
+                ("RGB565", numpy.uint16, None),
+                ("RGB24", numpy.uint8, 3),
+                ("BGR24", numpy.uint8, 3),
+                ("RGB32", numpy.uint8, 4),
+                ("BGR32", numpy.uint8, 4),
+                ("BAYER_RG8", numpy.uint8, None),
+                ("BAYER_BG8", numpy.uint8, None),
+                ("BAYER_RG16", numpy.uint16, None),
+                ("BAYER_BG16", numpy.uint16, None),
+                ("I420", numpy.uint8, "I420"),
+                ("YUV411", numpy.uint8, "I420"),
+                ("YUV411PACKED", numpy.uint8, "I420"),
+                ("YUV422", numpy.uint8, 2),
+                ("YUV422PACKED", numpy.uint8, 2),
+                ("YUV444", numpy.uint8, 3),
+                ("YUV444PACKED", numpy.uint8, 3))
+VIDEO_MODES = dict([(getattr(Core, name), (dtype, values)) \
+                    for name, dtype, values in _VIDEO_MODES if hasattr(Core, name)])
+
+
+def frame_layout(mode, width, height, size):
+    """
+    Returns the (dtype, shape) of a Lima video image of <mode>, or None
+    if unknown. Images of an unknown mode are copied as they are, as
+    bytes, if their <size> is a multiple of the number of pixels.
+    """
+    try:
+        dtype, values = VIDEO_MODES[mode]
+    except (KeyError, TypeError):
+        if size % (width * height):
+            return None
+        dtype, values = numpy.uint8, size / (width * height)
+    if values is None:
+        return dtype, (height, width)
+    if values == "I420":
+        return dtype, (height * 3 / 2, width)
+    return dtype, (height, width, values)
 
 class LimaVideo(BaseHardwareObjects.Device):
 
@@ -15,6 +62,9 @@ class LimaVideo(BaseHardwareObjects.Device):
 	BaseHardwareObjects.Device.__init__(self, name)
 
         self.scaling = pixmaptools.LUT.Scaling()
+        self.frameHub = None
+        self.__imagePolling = None
+        self.__sendImages = False
 
     def _init(self):
 	self.scalingType = None	
@@ -49,6 +99,7 @@ class LimaVideo(BaseHardwareObjects.Device):
             logging.getLogger().warning('%s: not initialized. Check camera settings', self.name())
 
 	self.setImageTypeFromXml('imagetype')
+        self.frameHub = FrameHub(self.getProperty("frame_buffers") or 4, self._frame_to_qimage)
  	self.setIsReady(True)
 
     def setImageTypeFromXml(self, property_name):
@@ -134,30 +185,87 @@ class LimaVideo(BaseHardwareObjects.Device):
     def getHeight(self):
 	return self.__imageDimensions[1]
 
+    def get_frame_hub(self):
+        return self.frameHub
+
+    def _frame_to_qimage(self, frame):
+        raw_buffer = frame.array
+        self.scaling.autoscale_plus_minus_sigma(raw_buffer,
+                                                frame.width, frame.height,
+                                                self.scalingType)
+        validFlag, qimage = pixmaptools.LUT.raw_video_2_image(raw_buffer,
+                                                              frame.width, frame.height,
+                                                              self.scalingType,
+                                                              self.scaling)
+        if validFlag:
+            if self.camMirror is not None:
+                qimage = qimage.mirror(self.camMirror[0], self.camMirror[1])
+            return qimage
+
+    def _read_frame(self):
+        """Stores the last image of the video in the frame hub,
+        returns None if there is no new one"""
+        if self.video.getLive():
+            image = self.video.getLastImage()
+            if image.frameNumber() < 0:
+                return None
+            # the raw data is copied as it is, Qub converts it
+            data = image.buffer()
+            width, height = image.width(), image.height()
+            layout = frame_layout(image.mode(), width, height, len(data))
+            if layout is None:
+                raise ValueError("unknown video mode %s (%d bytes for %dx%d)" % \
+                                 (image.mode(), len(data), width, height))
+            dtype, shape = layout
+            return self.frameHub.publish(image.frameNumber(), data,
+                                         width, height, dtype, shape=shape)
+
+    def get_frame(self, new_frame=False, timeout=5):
+        """Returns the latest frame; if <new_frame> is True, a frame
+        read after the call"""
+        newer_than = time.time() if new_frame else None
+        if self.__imagePolling is None or self.__imagePolling.ready():
+            # nobody polls the camera: read it now
+            with gevent.Timeout(timeout):
+                while True:
+                    self._read_frame()
+                    frame = self.frameHub.latest()
+                    if frame is not None and (newer_than is None or frame.timestamp > newer_than):
+                        return frame
+                    time.sleep(self.getProperty("interval")/1000.0)
+        return self.frameHub.wait_frame(newer_than, timeout)
+
+    def takeSnapshot(self, *args, **kwargs):
+        try:
+            qimage = self.get_frame(kwargs.get("new_frame", False)).qimage()
+            qimage.save(args[0], "PNG")
+        except:
+            logging.getLogger("HWR").exception("%s: could not save snapshot", self.name())
+            return False
+        else:
+            return True
+
     def _do_imagePolling(self, sleep_time):
         while True:
-              self.newImage()
-              time.sleep(sleep_time)
-	     	
+            try:
+                self.newImage()
+            except:
+                logging.getLogger("HWR").exception("%s: could not read video image", self.name())
+            time.sleep(sleep_time)
+
     def connectNotify(self, signal):
-	if signal=="imageReceived":
-            self.__imagePolling = gevent.spawn(self._do_imagePolling, self.getProperty("interval")/1000.0)
+        if signal in ("imageReceived", "frameReceived"):
+            if signal == "imageReceived":
+                # frames are converted to QImage only for these receivers
+                self.__sendImages = True
+            if self.__imagePolling is None:
+                self.__imagePolling = gevent.spawn(self._do_imagePolling, self.getProperty("interval")/1000.0)
 
     def newImage(self):
-	if self.video.getLive():
- 	    image = self.video.getLastImage()
-            qimage = None
-	    if image.frameNumber() > -1:
-      		raw_buffer = image.buffer()	
-			
-	        self.scaling.autoscale_plus_minus_sigma(raw_buffer,
-                                          image.width(), image.height(),
-                                          self.scalingType)
-                validFlag, qimage = pixmaptools.LUT.raw_video_2_image(raw_buffer,
-                                                                      image.width(), image.height(),
-                                                                      self.scalingType,
-                                                                      self.scaling)
-		if validFlag:
-                    if self.camMirror is not None:
-                        qimage = qimage.mirror(self.camMirror[0], self.camMirror[1])     
-   	            self.emit("imageReceived", qimage, qimage.width(), qimage.height(), self.forceUpdate)
+        frame = self._read_frame()
+        if frame is not None:
+            self.emit("frameReceived", frame)
+            if self.__sendImages:
+                qimage = frame.qimage()
+                if qimage is not None:
+                    self.emit("imageReceived", qimage, qimage.width(), qimage.height(), self.forceUpdate)
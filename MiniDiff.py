@@ -3,7 +3,6 @@ from gevent.event import AsyncResult
 from Qub.Tools import QubImageSave
 from HardwareRepository.BaseHardwareObjects import Equipment
 from HardwareRepository.TaskUtils import *
-import tempfile
 import logging
 import math
 import os
@@ -11,6 +10,9 @@ import time
 from HardwareRepository import HardwareRepository
 import copy
 import sample_centring
+import snapshot_service
+import motor_wait
+import diffractometer_state
 import numpy
 import queue_model_objects_v1 as qmo
 
@@ -23,21 +25,12 @@ class myimage:
             self.zoom = matrix.m11()
 
     def save(self, filename=None):
-        self.img = self.drawing.getPPP()
-
         if filename is None:
-          fd, name = tempfile.mkstemp()
-          os.close(fd)
-        else:
-          name = filename
+          self.imgcopy = snapshot_service.encode_snapshot(self.drawing)
+          return
 
-        QubImageSave.save(name, self.img, self.drawing.canvas(), self.zoom, "JPEG")
-
-        if filename is None:
-          f = open(name, "r")
-          self.imgcopy = f.read()
-          f.close()
-          os.unlink(name)
+        self.img = self.drawing.getPPP()
+        QubImageSave.save(filename, self.img, self.drawing.canvas(), self.zoom, "JPEG")
 
     def __str__(self):
         self.save()
@@ -241,6 +234,19 @@ class MiniDiff(Equipment):
             self.connect(self.aperture, 'predefinedPositionChanged', self.apertureChanged)
             self.connect(self.aperture, 'positionReached', self.apertureChanged)
 
+        # motor positions, kept up to date by the motor signals
+        max_age = self.getProperty("positions_max_age")
+        self.motor_state = diffractometer_state.DiffractometerState({ "phi": self.phiMotor,
+                                                                      "focus": self.focusMotor,
+                                                                      "phiy": self.phiyMotor,
+                                                                      "phiz": self.phizMotor,
+                                                                      "sampx": self.sampleXMotor,
+                                                                      "sampy": self.sampleYMotor,
+                                                                      "kappa": self.kappaMotor,
+                                                                      "kappa_phi": self.kappaPhiMotor,
+                                                                      "zoom": self.zoomMotor },
+                                                                    None if max_age is None else float(max_age))
+
 
     def save_snapshot(self, filename):
         set_light_in(self.lightWago, self.lightMotor, self.zoomMotor)
@@ -467,23 +473,34 @@ class MiniDiff(Equipment):
 
   
     def motor_positions_to_screen(self, centred_positions_dict):
-        self.pixelsPerMmY, self.pixelsPerMmZ = self.getCalibrationData(self.zoomMotor.getPosition())
-        phi_angle = math.radians(self.centringPhi.direction*self.centringPhi.getPosition()) 
-        sampx = self.centringSamplex.direction * (centred_positions_dict["sampx"]-self.centringSamplex.getPosition())
-        sampy = self.centringSampley.direction * (centred_positions_dict["sampy"]-self.centringSampley.getPosition())
-        phiy = self.centringPhiy.direction * (centred_positions_dict["phiy"]-self.centringPhiy.getPosition())
-        phiz = self.centringPhiz.direction * (centred_positions_dict["phiz"]-self.centringPhiz.getPosition())
+        return self.motor_positions_list_to_screen([centred_positions_dict])[0]
+
+    def motor_positions_list_to_screen(self, centred_positions_list):
+        """
+        Projects a list of centred positions to screen coordinates: the
+        motor positions and the calibration are read once, and all the
+        positions are projected with one matrix product
+        """
+        positions = self.motor_state.get_positions(("zoom", "phi", "sampx", "sampy", "phiy", "phiz"))
+        self.pixelsPerMmY, self.pixelsPerMmZ = self.getCalibrationData(positions["zoom"])
+        phi_angle = math.radians(self.centringPhi.direction*positions["phi"]) 
+        centred = numpy.array([[c["sampx"], c["sampy"], c["phiy"], c["phiz"]] \
+                               for c in centred_positions_list], float).reshape(-1, 4)
+        sampx = self.centringSamplex.direction * (centred[:, 0]-positions["sampx"])
+        sampy = self.centringSampley.direction * (centred[:, 1]-positions["sampy"])
+        phiy = self.centringPhiy.direction * (centred[:, 2]-positions["phiy"])
+        phiz = self.centringPhiz.direction * (centred[:, 3]-positions["phiz"])
         rotMatrix = numpy.matrix([math.cos(phi_angle), -math.sin(phi_angle), math.sin(phi_angle), math.cos(phi_angle)])
         rotMatrix.shape = (2, 2)
         invRotMatrix = numpy.array(rotMatrix.I)
-        dx, dy = numpy.dot(numpy.array([sampx, sampy]), invRotMatrix)*self.pixelsPerMmY
+        dy = numpy.dot(numpy.column_stack((sampx, sampy)), invRotMatrix)[:, 1]*self.pixelsPerMmY
         beam_pos_x = self.getBeamPosX()
         beam_pos_y = self.getBeamPosY()
 
         x = (phiy * self.pixelsPerMmY) + beam_pos_x
         y = dy + (phiz * self.pixelsPerMmZ) + beam_pos_y
 
-        return x, y
+        return zip(x.tolist(), y.tolist())
  
     def manualCentringDone(self, manual_centring_procedure):
         try:
@@ -617,15 +634,11 @@ class MiniDiff(Equipment):
 
 
     def getPositions(self):
-      return { "phi": float(self.phiMotor.getPosition()),
-               "focus": float(self.focusMotor.getPosition()),
-               "phiy": float(self.phiyMotor.getPosition()),
-               "phiz": float(self.phizMotor.getPosition()),
-               "sampx": float(self.sampleXMotor.getPosition()),
-               "sampy": float(self.sampleYMotor.getPosition()),
-               "kappa": float(self.kappaMotor.getPosition()) if self.kappaMotor else None,
-               "kappa_phi": float(self.kappaPhiMotor.getPosition()) if self.kappaPhiMotor else None,    
-               "zoom": float(self.zoomMotor.getPosition())}
+      # from the motor signals, stale positions are read from the hardware
+      positions = { "kappa": None, "kappa_phi": None }
+      for role, position in self.motor_state.get_positions().iteritems():
+        positions[role] = float(position)
+      return positions
     
 
     def moveMotors(self, roles_positions_dict):
@@ -639,18 +652,21 @@ class MiniDiff(Equipment):
                   "kappa_phi": self.kappaPhiMotor,
                   "zoom": self.zoomMotor }
    
-        for role, pos in roles_positions_dict.iteritems():
-           m = motor.get(role)
-           if not None in (m, pos):
-             m.move(pos)
- 
-        # TODO: remove this sleep, the motors states should
-        # be MOVING since the beginning (or READY if move is
-        # already finished) 
-        time.sleep(1)
- 
-        while not all([m.getState() == m.READY for m in motor.itervalues() if m is not None]):
-           time.sleep(0.1)
+        with motor_wait.MotorGroup(motor.itervalues(), motor_wait.state_ready) as motors:
+            motors.mark()
+            moving = []
+            for role, pos in roles_positions_dict.iteritems():
+               m = motor.get(role)
+               if not None in (m, pos):
+                 if motor_wait.needs_move(m, pos):
+                   moving.append(m)
+                 m.move(pos)
+
+            # motors states may not be MOVING right after the move
+            # command, wait for them to report a state change (up to the
+            # former 1 s for the motors that never report it)
+            motors.wait_started(moving, timeout=0.1, fallback_timeout=0.9)
+            motors.wait_ready()
 
 
     def takeSnapshots(self, image_count, wait=False):
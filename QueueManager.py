@@ -10,6 +10,7 @@ documentation for the queue_entry module for more information.
 import logging
 import gevent
 import queue_entry
+import timings
 
 from HardwareRepository.BaseHardwareObjects import HardwareObject
 from queue_entry import QueueEntryContainer
@@ -39,10 +40,21 @@ class QueueManager(HardwareObject, QueueEntryContainer):
         self._paused_event.set()
         self._current_queue_entry = None
         self._current_queue_entries = []
+        self._background_queue_entries = []
         self._running = False
         self._disable_collect = False
         self._is_stopped = False
 
+    def init(self):
+        """
+        Framework-2 method, inherited from HardwareObject. The stage
+        timings are enabled by the "timings" property, and exported to
+        the "timings_file" file.
+        """
+        timings.configure(enabled=self.getProperty("timings"),
+                          max_runs=self.getProperty("timings_max_runs"),
+                          export_file=self.getProperty("timings_file"))
+
     def enqueue(self, queue_entry):
         """
         Method inherited from QueueEntryContainer, enqueues the QueueEntry
@@ -86,6 +98,7 @@ class QueueManager(HardwareObject, QueueEntryContainer):
 
     def __execute_task(self):
         self._running = True
+        timings.start_run("queue")
         #TODO could more nicer signal name to disable minidiff during any queue entry execution
         self.emit('centringAllowed', (False, ))
         try:
@@ -109,6 +122,7 @@ class QueueManager(HardwareObject, QueueEntryContainer):
                 raise ex
         finally:
           self._running = False
+          timings.end_run()
           self.emit('queue_execution_finished', (None,))
           self.emit('centringAllowed', (True, ))
 
@@ -128,11 +142,15 @@ class QueueManager(HardwareObject, QueueEntryContainer):
 
         self.wait_for_pause_event()
 
+        entry_laps = timings.laps("queue." + entry.__class__.__name__)
+
         try:
             # Procedure to be done before main implmentation
             # of task.
             entry.pre_execute()
+            entry_laps.lap("pre_execute")
             entry.execute()
+            entry_laps.lap("execute")
 
             for child in entry._queue_entry_list:
                 self.__execute_entry(child)
@@ -150,7 +168,9 @@ class QueueManager(HardwareObject, QueueEntryContainer):
             entry.handle_exception(ex)
             raise ex
         else:
+            entry_laps.restart()
             entry.post_execute()
+            entry_laps.lap("post_execute")
 
         self._current_queue_entries.remove(entry)
 
@@ -171,6 +191,14 @@ class QueueManager(HardwareObject, QueueEntryContainer):
                 except:
                     pass
 
+        # entries still running in the background (characterisations),
+        # they finish themselves when stopped
+        for qe in self._background_queue_entries[:]:
+            try:
+                qe.stop()
+            except:
+                logging.getLogger('queue_exec').exception('Could not stop ' + str(qe))
+
         self._root_task.kill(block = False)
 
         # Reset the pause event, incase we were waiting.
@@ -179,6 +207,21 @@ class QueueManager(HardwareObject, QueueEntryContainer):
         self.emit('centringAllowed', (True, )) 
         self._is_stopped = True
 
+    def add_background_entry(self, entry):
+        """
+        Registers <entry>, left the queue but still running (e.g. a
+        characterisation), so that it is stopped with the queue.
+        """
+        if entry not in self._background_queue_entries:
+            self._background_queue_entries.append(entry)
+
+    def remove_background_entry(self, entry):
+        """
+        Unregisters the background entry <entry>, once it is finished.
+        """
+        if entry in self._background_queue_entries:
+            self._background_queue_entries.remove(entry)
+
     def set_pause(self, state):
         """
         Sets the queue in paused state <state>. Emits the signal queue_paused
@@ -3,12 +3,234 @@ Handels interaction with the data model(s). Adding, removing and
 retreiving nodes are all done via this object. It is possbile to
 handle several models by using register_model and select_model.
 """
+import os
+import re
+import bisect
 import queue_entry
 import queue_model_objects_v1 as queue_model_objects
 
 from HardwareRepository.BaseHardwareObjects import HardwareObject
 
 
+class IntervalSet(object):
+    """
+    Half-open intervals [start, end) with an owner, sorted by start.
+    max_ends[i] is the largest end of the intervals up to i, so that
+    finding an interval overlapping a range is a bisection.
+    """
+    def __init__(self):
+        self.starts = []
+        self.intervals = []
+        self.max_ends = []
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def _update_max_ends(self, i):
+        del self.max_ends[i:]
+        max_end = None
+        if self.max_ends:
+            max_end = self.max_ends[-1]
+        for start, end, owner in self.intervals[i:]:
+            if max_end is None or end > max_end:
+                max_end = end
+            self.max_ends.append(max_end)
+
+    def add(self, start, end, owner):
+        i = bisect.bisect_right(self.starts, start)
+        self.starts.insert(i, start)
+        self.intervals.insert(i, (start, end, owner))
+        self._update_max_ends(i)
+
+    def remove(self, owner):
+        for i, interval in enumerate(self.intervals):
+            if interval[2] is owner:
+                del self.starts[i]
+                del self.intervals[i]
+                self._update_max_ends(i)
+                return
+
+    def owners(self):
+        return [interval[2] for interval in self.intervals]
+
+    def overlaps(self, start, end, exclude=None):
+        """
+        True if an interval, except the one of <exclude>, overlaps
+        [start, end)
+        """
+        # intervals starting before <end>
+        i = bisect.bisect_left(self.starts, end)
+        while i > 0 and self.max_ends[i - 1] > start:
+            i -= 1
+            interval = self.intervals[i]
+            if interval[1] > start and interval[2] is not exclude:
+                return True
+        return False
+
+
+class FileRangeRegistry(object):
+    """
+    Image number ranges [start_num, start_num + num_files) of path
+    templates, by normalized (directory, prefix) and run number.
+    """
+    def __init__(self):
+        self._runs = {}
+        self._entries = {}
+
+    def add(self, path_template):
+        path_template.__dict__["_indexed"] = True
+        key = path_template.get_key()
+        run_number = path_template.run_number
+        self._entries[path_template] = (key, run_number)
+        intervals = self._runs.setdefault(key, {}).setdefault(run_number, IntervalSet())
+        intervals.add(path_template.start_num,
+                      path_template.start_num + path_template.num_files,
+                      path_template)
+
+    def remove(self, path_template):
+        try:
+            key, run_number = self._entries.pop(path_template)
+        except KeyError:
+            return
+        runs = self._runs[key]
+        runs[run_number].remove(path_template)
+        if not runs[run_number]:
+            del runs[run_number]
+            if not runs:
+                del self._runs[key]
+
+    def __contains__(self, path_template):
+        return path_template in self._entries
+
+    def clear(self):
+        self._runs = {}
+        self._entries = {}
+
+    def run_numbers(self, path_template):
+        """
+        :returns: The run numbers used with the directory and prefix of
+                  <path_template>, by path templates other than itself.
+        :rtype: list
+        """
+        run_numbers = []
+        for run_number, intervals in self._runs.get(path_template.get_key(), {}).iteritems():
+            if [owner for owner in intervals.owners() if owner is not path_template]:
+                run_numbers.append(run_number)
+        return run_numbers
+
+    def overlaps(self, path_template):
+        """
+        True if another path template writes some of the files of
+        <path_template>
+        """
+        try:
+            intervals = self._runs[path_template.get_key()][path_template.run_number]
+        except KeyError:
+            return False
+        return intervals.overlaps(path_template.start_num,
+                                  path_template.start_num + path_template.num_files,
+                                  exclude=path_template)
+
+
+class DiskImageIndex(object):
+    """
+    Image numbers of the files found in directories, by prefix, run
+    number and suffix. A directory is listed again only when its
+    modification time changes.
+    """
+    FILE_NAME_RE = re.compile(r"^(.*)_(\d+)_(\d+)\.(.+)$")
+
+    def __init__(self):
+        self._directories = {}
+
+    def _images(self, directory):
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            return {}
+        cached = self._directories.get(directory)
+        if cached is None or cached[0] != mtime:
+            images = {}
+            for file_name in os.listdir(directory):
+                match = DiskImageIndex.FILE_NAME_RE.match(file_name)
+                if match:
+                    prefix, run_number, number, suffix = match.groups()
+                    images.setdefault((prefix, int(run_number), suffix), []).append(int(number))
+            for numbers in images.itervalues():
+                numbers.sort()
+            cached = self._directories[directory] = (mtime, images)
+        return cached[1]
+
+    def overlaps(self, path_template):
+        """
+        True if some files of <path_template> are already on disk
+        """
+        directory, prefix = path_template.get_key()
+        numbers = self._images(directory).get((prefix, path_template.run_number,
+                                               path_template.suffix))
+        if not numbers:
+            return False
+        i = bisect.bisect_left(numbers, path_template.start_num)
+        return i < len(numbers) and \
+               numbers[i] < path_template.start_num + path_template.num_files
+
+
+class ModelIndex(object):
+    """
+    Indexes of the nodes of one model, kept up to date by the QueueModel:
+    node id -> node, and the file ranges of the path templates.
+
+    The file ranges are indexed again when the directory, prefix, run
+    number or image range of an indexed path template changes.
+    """
+    def __init__(self):
+        self.nodes = {}
+        self.file_ranges = FileRangeRegistry()
+        self._path_template_nodes = set()
+        self._index_changes = queue_model_objects.PathTemplate.index_changes
+
+    def _walk(self, node):
+        yield node
+        for child in node.get_children():
+            for n in self._walk(child):
+                yield n
+
+    def add(self, node):
+        """
+        Indexes <node> and its children
+        """
+        for n in self._walk(node):
+            if n._node_id is not None:
+                self.nodes[n._node_id] = n
+            path_template = n.get_path_template()
+            if path_template:
+                self._path_template_nodes.add(n)
+                self.file_ranges.add(path_template)
+
+    def remove(self, node):
+        """
+        Removes <node> and its children from the indexes
+        """
+        for n in self._walk(node):
+            if self.nodes.get(n._node_id) is n:
+                del self.nodes[n._node_id]
+            if n in self._path_template_nodes:
+                self._path_template_nodes.discard(n)
+                self.file_ranges.remove(n.get_path_template())
+
+    def get_file_ranges(self):
+        """
+        :returns: The file range registry, up to date.
+        :rtype: FileRangeRegistry
+        """
+        if self._index_changes != queue_model_objects.PathTemplate.index_changes:
+            self._index_changes = queue_model_objects.PathTemplate.index_changes
+            self.file_ranges.clear()
+            for node in self._path_template_nodes:
+                self.file_ranges.add(node.get_path_template())
+        return self.file_ranges
+
+
 class QueueModel(HardwareObject):
     def __init__(self, name):
         HardwareObject.__init__(self, name)
@@ -22,6 +244,8 @@ class QueueModel(HardwareObject):
                         'free-pin': self._free_pin_model}
 
         self._selected_model = self._ispyb_model
+        self._indexes = {}
+        self._disk_images = DiskImageIndex()
 
     # Framework-2 method, inherited from HardwareObject and called
     # by the framework after the object has been initialized.
@@ -65,6 +289,7 @@ class QueueModel(HardwareObject):
         :returns: None
         :rtype: NoneType
         """
+        self._indexes.pop(self._models[name], None)
         self._models[name] = queue_model_objects.RootNode()
         self.queue_hwobj.clear()
 
@@ -86,6 +311,22 @@ class QueueModel(HardwareObject):
         else:
             self._models[name]
 
+    def _get_index(self, model=None):
+        """
+        :returns: The indexes of the model <model>, default the selected
+                  model.
+        :rtype: ModelIndex
+        """
+        if model is None:
+            model = self._selected_model
+        try:
+            return self._indexes[model]
+        except KeyError:
+            index = self._indexes[model] = ModelIndex()
+            for child in model.get_children():
+                index.add(child)
+            return index
+
     def _re_emit(self, parent_node):
         """
         Re-emits the 'child_added' for all the nodes in the model.
@@ -113,6 +354,7 @@ class QueueModel(HardwareObject):
             child._node_id = self._selected_model._total_node_count
             parent._children.append(child)
             child._set_name(child._name)
+            self._get_index().add(child)
             self.emit('child_added', (parent, child))
         else:
             raise TypeError("Expected type TaskNode, got %s "\
@@ -150,7 +392,7 @@ class QueueModel(HardwareObject):
         :rtype: TaskNode
         """
         if parent is None:
-            parent = self._selected_model 
+            return self._get_index().nodes.get(_id)
 
         for node in parent._children:
             if node._node_id == _id:
@@ -173,6 +415,7 @@ class QueueModel(HardwareObject):
         """
         if child in parent._children:
             parent._children.remove(child)
+            self._get_index().remove(child)
             self.emit('child_removed', (parent, child))
 
     def _detach_child(self, parent, child):
@@ -239,9 +482,9 @@ class QueueModel(HardwareObject):
 
     def get_next_run_number(self, new_path_template, exclude_current = True):
         """
-        Iterates through all the path templates of the tasks
-        in the model and returns the next available run number
-        for the path template <new_path_template>.
+        Returns the next available run number for the path template
+        <new_path_template>, among the tasks of the model with the same
+        directory and prefix.
 
         :param new_path_template: PathTempalte to match with.
         :type new_path_template: PathTemplate
@@ -252,18 +495,13 @@ class QueueModel(HardwareObject):
         :returns: The next available run number for the given path_template.
         :rtype: int
         """
-        all_path_templates = self.get_path_templates()
-        conflicting_path_templates = [0]
+        run_numbers = self._get_index().get_file_ranges().run_numbers(new_path_template)
 
-        for pt in all_path_templates:
-            if exclude_current:
-                if pt[1] is not new_path_template:
-                    if pt[1] == new_path_template:
-                        conflicting_path_templates.append(pt[1].run_number)
-            else:
-                if pt[1] == new_path_template:
-                    conflicting_path_templates.append(pt[1].run_number)
+        if not exclude_current and new_path_template in self._get_index().file_ranges:
+            # the run number of the path template itself counts
+            run_numbers.append(new_path_template.run_number)
 
+        conflicting_path_templates = [0] + run_numbers
         return max(conflicting_path_templates) + 1
 
     def get_path_templates(self):
@@ -291,22 +529,21 @@ class QueueModel(HardwareObject):
 
         return path_template_list
 
-    def check_for_path_collisions(self, new_path_template):
+    def check_for_path_collisions(self, new_path_template, files_on_disk=False):
         """
         Returns True if there is a path template (task) in the model,
-        that produces the same files as this one.
+        that produces the same files as this one, or if <files_on_disk>
+        is True, if some of the files already exist.
 
         :returns: True if there is a potential path collision.
         """
-        result = False
-        path_template_list = self.get_path_templates()
-        
-        for pt in path_template_list:
-            if pt[1] is not new_path_template:
-                if new_path_template.intersection(pt[1]):
-                    result = True
+        if self._get_index().get_file_ranges().overlaps(new_path_template):
+            return True
 
-        return result
+        if files_on_disk:
+            return self._disk_images.overlaps(new_path_template)
+
+        return False
 
     def copy_node(self, node):
         """
@@ -329,3 +566,85 @@ class QueueModel(HardwareObject):
         new_node.set_executed(False)
 
         return new_node
+
+
+if __name__ == '__main__':
+    # Builds a queue of 500 samples x 5 data collections, allocating the
+    # run numbers and checking the path collisions of each collection,
+    # then looks up every node by id: full model walks as before, and
+    # with the indexes.
+    import sys
+    import time
+
+    n_samples = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    def old_next_run_number(model, new_path_template):
+        run_numbers = [0]
+        for node, pt in model.get_path_templates():
+            if pt is not new_path_template and pt == new_path_template:
+                run_numbers.append(pt.run_number)
+        return max(run_numbers) + 1
+
+    def old_path_collisions(model, new_path_template):
+        result = False
+        for node, pt in model.get_path_templates():
+            if pt is not new_path_template:
+                if new_path_template.intersection(pt):
+                    result = True
+        return result
+
+    def build(model, next_run_number, path_collisions):
+        root = model.get_model_root()
+        for i in range(n_samples):
+            sample = queue_model_objects.Sample()
+            model.add_child(root, sample)
+            group = queue_model_objects.TaskGroup()
+            model.add_child(sample, group)
+            for j in range(5):
+                dc = queue_model_objects.DataCollection()
+                pt = dc.acquisitions[0].path_template
+                pt.directory = "/data/visitor/mx1234/id29/20150101/RAW_DATA/sample%d" % i
+                pt.base_prefix = "sample%d" % i
+                pt.num_files = 100
+                pt.run_number = next_run_number(pt)
+                path_collisions(pt)
+                model.add_child(group, dc)
+
+    results = []
+    for indexed in (False, True):
+        model = QueueModel("queue-model")
+        t0 = time.time()
+        if indexed:
+            build(model, model.get_next_run_number, model.check_for_path_collisions)
+        else:
+            build(model, lambda pt: old_next_run_number(model, pt),
+                  lambda pt: old_path_collisions(model, pt))
+        t1 = time.time()
+        root = model.get_model_root()
+        for _id in range(1, root._total_node_count + 1):
+            if indexed:
+                model.get_node(_id)
+            else:
+                model.get_node(_id, root)
+        t2 = time.time()
+        results.append((t1 - t0, t2 - t1))
+
+    print "%d samples x 5 collections: build %.2f s -> %.2f s, all get_node %.2f s -> %.4f s" % \
+          (n_samples, results[0][0], results[1][0], results[0][1], results[1][1])
+
+    pt = queue_model_objects.PathTemplate()
+    pt.directory = "/data/visitor/mx1234/id29/20150101/RAW_DATA"
+    pt.base_prefix = "sample"
+    pt.precision = "04"
+    pt.suffix = "cbf"
+    pt.run_number = 1
+    pt.num_files = 10000
+    t0 = time.time()
+    file_name_template = pt.get_image_file_name()
+    files = [os.path.join(pt.directory, file_name_template % i) \
+             for i in range(pt.start_num, pt.start_num + pt.num_files)]
+    t1 = time.time()
+    files = pt.get_files_to_be_written()
+    last_file = files[-1]
+    t2 = time.time()
+    print "10000 frames file list: %.2f ms -> %.3f ms" % (1000 * (t1 - t0), 1000 * (t2 - t1))
@@ -1,6 +1,7 @@
 from HardwareRepository.TaskUtils import *
 import MiniDiff
 import sample_centring
+import motor_wait
 import os
 import sys
 import logging
@@ -90,10 +91,16 @@ class Robodiff(MiniDiff.MiniDiff):
 
 
     def motor_positions_to_screen(self, centred_positions_dict):
-        centred_pos_dict = copy.deepcopy(centred_positions_dict)
-        centred_pos_dict["phiy"]=centred_positions_dict['y']
-        centred_pos_dict["phiz"]=centred_positions_dict['z']
-        return MiniDiff.MiniDiff.motor_positions_to_screen(self, centred_pos_dict) 
+        return self.motor_positions_list_to_screen([centred_positions_dict])[0]
+
+    def motor_positions_list_to_screen(self, centred_positions_list):
+        centred_pos_list = []
+        for centred_positions_dict in centred_positions_list:
+            centred_pos_dict = copy.deepcopy(centred_positions_dict)
+            centred_pos_dict["phiy"]=centred_positions_dict['y']
+            centred_pos_dict["phiz"]=centred_positions_dict['z']
+            centred_pos_list.append(centred_pos_dict)
+        return MiniDiff.MiniDiff.motor_positions_list_to_screen(self, centred_pos_list)
 
     def moveMotors(self, roles_positions_dict):
         motor = { "phi": self.phiMotor,
@@ -111,17 +118,20 @@ class Robodiff(MiniDiff.MiniDiff):
 
         _aperture_move = gevent.spawn(self.controller.move_to_last_known_aperture)
 
-        for role, pos in roles_positions_dict.iteritems():
-           logging.info("moving motor %s to %f", role, pos)
-           motor[role].move(pos)
-
-        # TODO: remove this sleep, the motors states should
-        # be MOVING since the beginning (or READY if move is
-        # already finished) 
-        time.sleep(1)
-
-        while any([m.getState() == m.MOVING for m in motor.itervalues()]):
-           time.sleep(0.1)
+        with motor_wait.MotorGroup(motor.itervalues(), lambda m: m.getState() != m.MOVING) as motors:
+            motors.mark()
+            moving = []
+            for role, pos in roles_positions_dict.iteritems():
+               logging.info("moving motor %s to %f", role, pos)
+               if motor_wait.needs_move(motor[role], pos):
+                 moving.append(motor[role])
+               motor[role].move(pos)
+
+            # motors states may not be MOVING right after the move
+            # command, wait for them to report a state change (up to the
+            # former 1 s for the motors that never report it)
+            motors.wait_started(moving, timeout=0.1, fallback_timeout=0.9)
+            motors.wait_ready()
 
         _aperture_move.get()
 
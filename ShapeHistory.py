@@ -246,6 +246,29 @@ class ShapeHistory(HardwareObject):
         """
         self.shapes[shape].move(new_positions)
 
+    def move_shapes_to_screen(self, diffractometer):
+        """
+        Moves all the shapes to the screen positions of their centred
+        positions, after a motor move. The positions are projected all at
+        once by <diffractometer> (motor_positions_list_to_screen).
+        """
+        shapes = [shape for shape in self.get_shapes() \
+                  if shape.get_centred_positions()]
+        centred_positions = []
+        for shape in shapes:
+            centred_positions.extend([cpos.as_dict() for cpos in shape.get_centred_positions()])
+
+        if not centred_positions:
+            return
+
+        screen_positions = diffractometer.motor_positions_list_to_screen(centred_positions)
+
+        i = 0
+        for shape in shapes:
+            n = len(shape.get_centred_positions())
+            shape.move(screen_positions[i:i + n])
+            i += n
+
     def clear_all(self):
         """
         Clear the shape history, remove all contents.
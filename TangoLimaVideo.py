@@ -14,6 +14,7 @@ import PyTango
 from PyTango.gevent import DeviceProxy
 import numpy
 import struct
+from video_frame_hub import FrameHub
 
 class TangoLimaVideo(BaseHardwareObjects.Device):
     def __init__(self, name):
@@ -23,10 +24,13 @@ class TangoLimaVideo(BaseHardwareObjects.Device):
         self.__gainExists = False
         self.__gammaExists = False
         self.__polling = None
+        self.__sendImages = False
         self.scaling = pixmaptools.LUT.Scaling()
+        self.frameHub = None
         
     def init(self):
         self.device = None
+        self.frameHub = FrameHub(self.getProperty("frame_buffers") or 4, self._frame_to_qimage)
         
         try:
             self.device = DeviceProxy(self.tangoname)
@@ -47,29 +51,65 @@ class TangoLimaVideo(BaseHardwareObjects.Device):
     def imageType(self):
         return BayerType("RG16")
 
-    def _get_last_image(self):
+    def get_frame_hub(self):
+        return self.frameHub
+
+    def _frame_to_qimage(self, frame):
+        raw_buffer = frame.array
+        self.scaling.autoscale_min_max(raw_buffer, frame.width, frame.height, pixmaptools.LUT.Scaling.BAYER_RG16)
+        validFlag, qimage = pixmaptools.LUT.raw_video_2_image(raw_buffer,
+                                                              frame.width, frame.height,
+                                                              pixmaptools.LUT.Scaling.BAYER_RG16,
+                                                              self.scaling)
+        if validFlag:
+            return qimage
+
+    def _read_frame(self):
+        """Stores the last image of the device in the frame hub,
+        returns None if it is not a new one"""
         img_data = self.device.video_last_image
         if img_data[0]=="VIDEO_IMAGE":
             header_fmt = ">IHHqiiHHHH"
             _, ver, img_mode, frame_number, width, height, _, _, _, _ = struct.unpack(header_fmt, img_data[1][:struct.calcsize(header_fmt)])
-            raw_buffer = numpy.fromstring(img_data[1][32:], numpy.uint16)
-            self.scaling.autoscale_min_max(raw_buffer, width, height, pixmaptools.LUT.Scaling.BAYER_RG16)
-            validFlag, qimage = pixmaptools.LUT.raw_video_2_image(raw_buffer,
-                                                                  width, height,
-                                                                  pixmaptools.LUT.Scaling.BAYER_RG16,
-                                                                  self.scaling)
-            if validFlag:
-                return qimage
+            return self.frameHub.publish(frame_number, img_data[1], width, height, numpy.uint16, 32)
+
+    def get_frame(self, new_frame=False, timeout=5):
+        """Returns the latest frame; if <new_frame> is True, a frame
+        read after the call"""
+        newer_than = time.time() if new_frame else None
+        if self.__polling is None or self.__polling.ready():
+            # nobody polls the device: read it now
+            with gevent.Timeout(timeout):
+                while True:
+                    self._read_frame()
+                    frame = self.frameHub.latest()
+                    if frame is not None and (newer_than is None or frame.timestamp > newer_than):
+                        return frame
+                    time.sleep(self.getProperty("interval")/1000.0)
+        return self.frameHub.wait_frame(newer_than, timeout)
 
     def _do_polling(self, sleep_time):
         while True:
-            qimage = self._get_last_image()
-   	    self.emit("imageReceived", qimage, qimage.width(), qimage.height(), False)
+            try:
+                frame = self._read_frame()
+            except:
+                logging.getLogger("HWR").exception("%s: could not read video image", self.name())
+                frame = None
+
+            if frame is not None:
+                self.emit("frameReceived", frame)
+                if self.__sendImages:
+                    qimage = frame.qimage()
+                    if qimage is not None:
+                        self.emit("imageReceived", qimage, qimage.width(), qimage.height(), False)
 
             time.sleep(sleep_time)
 
     def connectNotify(self, signal):
-        if signal=="imageReceived":
+        if signal in ("imageReceived", "frameReceived"):
+            if signal == "imageReceived":
+                # frames are converted to QImage only for these receivers
+                self.__sendImages = True
             if self.__polling is None:
                 self.__polling = gevent.spawn(self._do_polling, self.device.video_exposure)
 
@@ -109,8 +149,8 @@ class TangoLimaVideo(BaseHardwareObjects.Device):
 
     def takeSnapshot(self, *args, **kwargs):
         """tango"""
-        qimage = self._get_last_image()
         try:
+            qimage = self.get_frame(kwargs.get("new_frame", False)).qimage()
             qimage.save(args[0], "PNG")
         except:
             logging.getLogger("HWR").exception("%s: could not save snapshot", self.name())
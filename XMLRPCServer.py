@@ -14,6 +14,7 @@ import gevent
 import socket
 import time
 import json
+import timings
 
 from HardwareRepository.BaseHardwareObjects import HardwareObject
 from SimpleXMLRPCServer import SimpleXMLRPCServer
@@ -98,6 +99,8 @@ class XMLRPCServer(HardwareObject):
         self._server.register_function(self.get_aperture_list)
         self._server.register_function(self.get_cp)
         self._server.register_function(self.save_current_pos)
+        self._server.register_function(self.get_timings)
+        self._server.register_function(self.get_lims_metrics)
  
         # Register functions from modules specified in <apis> element
         if self.hasObject("apis"):
@@ -335,6 +338,23 @@ class XMLRPCServer(HardwareObject):
         self.diffractometer_hwobj.saveCurrentPos()
         return True
 
+    def get_timings(self, run_id=None):
+        """
+        Returns the stage timings of the queue run <run_id> (latest run if
+        None, all the runs kept if -1), see the timings module.
+        """
+        return timings.get_timings(run_id)
+
+    def get_lims_metrics(self):
+        """
+        Returns the statistics of the ISPyB web-service calls by method
+        name (calls, errors, latency histogram, payload sizes).
+        """
+        lims = self.beamline_setup_hwobj.lims_client_hwobj
+        if lims is None or not hasattr(lims, "get_ws_metrics"):
+            return {}
+        return lims.get_ws_metrics()
+
     def cryo_temperature(self):
         return self.beamline_setup_hwobj.collect_hwobj.get_cryo_temperature()
 
@@ -1,82 +1,313 @@
+"""
+Auto-processing dispatcher.
+
+The programs configured for the data collection events (before, image,
+after, end_multicollect) are started by a long-lived dispatcher instead
+of one shell per event:
+
+- each event gives a typed job request (event, program arguments),
+- at most <max_processes> child processes run at the same time, the
+  other jobs wait in the queue,
+- the per-frame "image" events are coalesced: for a given program and
+  collection at most one process is started every <image_interval>
+  seconds, with the parameters of the latest frame,
+- finished processes are reaped by the dispatcher, and get_status()
+  gives the running, queued and recently finished jobs.
+"""
+
 import os
 import sys
+import time
 import logging
+import itertools
+import collections
 import subprocess
+import gevent
+import gevent.event
+
+EVENTS = ("before", "image", "after", "end_multicollect")
+
+
+class AutoProcessingJob(object):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, job_id, event, executable, args, env=None, coalesce_key=None):
+        if not event in EVENTS:
+            raise ValueError("unknown auto-processing event %r" % event)
+        self.id = job_id
+        self.event = event
+        self.executable = executable
+        self.args = [str(arg) for arg in args]
+        self.env = env
+        self.coalesce_key = coalesce_key
+        self.coalesced = 0
+        self.flush = False
+        self.status = AutoProcessingJob.QUEUED
+        self.process = None
+        self.returncode = None
+        self.submit_time = time.time()
+        self.start_time = None
+        self.end_time = None
+
+    def command_line(self):
+        return " ".join([self.executable] + self.args)
+
+    def as_dict(self):
+        return {"id": self.id, "event": self.event, "command": self.command_line(),
+                "status": self.status, "returncode": self.returncode,
+                "coalesced": self.coalesced,
+                "pid": self.process is not None and self.process.pid or None,
+                "submit_time": self.submit_time, "start_time": self.start_time,
+                "end_time": self.end_time}
+
+
+class AutoProcessingDispatcher(object):
+    def __init__(self, max_processes=4, image_interval=5, poll_interval=1,
+                 max_finished_jobs=50):
+        self.max_processes = max_processes
+        self.image_interval = image_interval
+        self.poll_interval = poll_interval
+
+        self._ids = itertools.count(1)
+        self._queue = collections.deque()
+        self._running = []
+        self._finished = collections.deque(maxlen=max_finished_jobs)
+        # coalesce key -> pending image job, and time of the last start
+        self._pending_images = {}
+        self._last_image_start = {}
+        self._wakeup = gevent.event.Event()
+        self._task = None
+
+
+    def configure(self, max_processes=None, image_interval=None):
+        if max_processes is not None:
+            self.max_processes = max(1, int(max_processes))
+        if image_interval is not None:
+            self.image_interval = float(image_interval)
+        self._wakeup.set()
+
+
+    def submit(self, event, executable, args=(), env=None, coalesce_key=None):
+        """
+        Queues the execution of <executable> with <args>. Image events
+        with the same <coalesce_key> replace each other until they are
+        started.
+
+        :returns: the job
+        """
+        if event != "image":
+            coalesce_key = None
+            # rate limited image jobs must not run after the next events
+            for pending in self._pending_images.itervalues():
+                pending.flush = True
+
+        job = AutoProcessingJob(self._ids.next(), event, executable, args, env, coalesce_key)
+
+        if coalesce_key is not None:
+            pending = self._pending_images.get(coalesce_key)
+            if pending is not None:
+                job.coalesced = pending.coalesced + 1
+                self._queue.remove(pending)
+            self._pending_images[coalesce_key] = job
+
+        self._queue.append(job)
+
+        if self._task is None or self._task.ready():
+            self._task = gevent.spawn(self._dispatch)
+        self._wakeup.set()
+
+        return job
+
+
+    def _image_delay(self, job):
+        if job.coalesce_key is None or job.flush:
+            return 0
+        last_start = self._last_image_start.get(job.coalesce_key)
+        if last_start is None:
+            return 0
+        return max(0, last_start + self.image_interval - time.time())
+
+
+    def _start(self, job):
+        if job.coalesce_key is not None and \
+          self._pending_images.get(job.coalesce_key) is job:
+            del self._pending_images[job.coalesce_key]
+            self._last_image_start[job.coalesce_key] = time.time()
+
+        env = None
+        if job.env:
+            env = dict(os.environ)
+            env.update(job.env)
+
+        logging.info("Process event %s, executing %s" % (job.event, job.command_line()))
+        job.start_time = time.time()
+        try:
+            devnull = open(os.devnull, "w")
+            try:
+                job.process = subprocess.Popen([job.executable] + job.args, stdin=None,
+                                               stdout=devnull, stderr=None,
+                                               close_fds=True, env=env)
+            finally:
+                devnull.close()
+        except:
+            logging.exception("autoprocessing: could not start %s", job.executable)
+            job.status = AutoProcessingJob.FAILED
+            job.end_time = time.time()
+            self._finished.append(job)
+        else:
+            job.status = AutoProcessingJob.RUNNING
+            self._running.append(job)
+
+
+    def _reap(self):
+        for job in self._running[:]:
+            returncode = job.process.poll()
+            if returncode is not None:
+                job.returncode = returncode
+                job.status = returncode == 0 and AutoProcessingJob.DONE or AutoProcessingJob.FAILED
+                job.end_time = time.time()
+                self._running.remove(job)
+                self._finished.append(job)
+
+
+    def _dispatch(self):
+        while self._queue or self._running:
+            self._wakeup.clear()
+            self._reap()
+
+            delays = []
+            for job in list(self._queue):
+                if len(self._running) >= self.max_processes:
+                    break
+                delay = self._image_delay(job)
+                if delay > 0:
+                    # rate limited image event, keep its place
+                    delays.append(delay)
+                    continue
+                self._queue.remove(job)
+                self._start(job)
+
+            if self._running:
+                delays.append(self.poll_interval)
+            timeout = delays and min(delays) or None
+
+            if self._queue or self._running:
+                self._wakeup.wait(timeout)
+
+
+    def wait(self, timeout=None):
+        """
+        Waits until all the jobs are started and finished
+        """
+        with gevent.Timeout(timeout):
+            while self._task is not None and not self._task.ready():
+                self._task.join()
+
+
+    def get_status(self):
+        return {"max_processes": self.max_processes,
+                "image_interval": self.image_interval,
+                "running": [job.as_dict() for job in self._running],
+                "queued": [job.as_dict() for job in self._queue],
+                "finished": [job.as_dict() for job in self._finished]}
+
+
+_dispatcher = None
+
+def get_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = AutoProcessingDispatcher()
+    return _dispatcher
+
+
+def get_status():
+    return get_dispatcher().get_status()
+
+
+def _options(params):
+    options = []
+
+    spacegroup = params.get('spacegroup')
+    if spacegroup:
+        options += ['-sg', spacegroup]
+
+    unit_cell_constants = params.get('cell')
+    if unit_cell_constants:
+        options += ['-cell', unit_cell_constants]
+
+    return options
+
 
 def grouped_processing(processEvent, params):
-    endOfLineToExecute = ''
+    args = []
 
     for param_dict in params:
         dataCollectionId = param_dict.get('collect_id')
         residues = param_dict.get('residues', 0)
         anomalous = param_dict.get('anomalous', False)
-        spacegroup = param_dict.get('spacegroup')
-
-        if spacegroup: 
-            sg_opt = ' -sg {0}'.format(spacegroup)
-        else:
-            sg_opt = ''
 
-        unit_cell_constants = param_dict.get('cell')
-        if unit_cell_constants:
-            cell_opt = ' -cell "{0}"'.format(unit_cell_constants)
-        else:
-            cell_opt = ''
-
-        endOfLineToExecute += ' -mode %s -collect %d:%s' % (processEvent, dataCollectionId, param_dict["xds_dir"])
-	endOfLineToExecute += ' -residues ' + str(residues) + ' -anomalous ' + str(anomalous) + \
-                              sg_opt + cell_opt
+        args += ['-mode', processEvent,
+                 '-collect', '%d:%s' % (dataCollectionId, param_dict["xds_dir"]),
+                 '-residues', str(residues), '-anomalous', str(anomalous)]
+        args += _options(param_dict)
         # + (param_dict["inverse_beam"] and ' -inverse' or '')
-    return endOfLineToExecute
+    return args
+
 
 def start(programs, processEvent, paramsDict):
+    """
+    Submits the programs configured for <processEvent> to the dispatcher
+    """
+    dispatcher = get_dispatcher()
+    try:
+        dispatcher.configure(programs.getProperty("max_processes"),
+                             programs.getProperty("image_interval"))
+    except AttributeError:
+        pass
+
     for program in programs["program"]:
         try:
-	    allowed_events = program.getProperty("event").split(" ")
-	    if processEvent in allowed_events:
-		executable = program.getProperty('executable')
-		
-		if os.path.isfile(executable):
+            allowed_events = program.getProperty("event").split(" ")
+            if processEvent in allowed_events:
+                executable = program.getProperty('executable')
+
+                if os.path.isfile(executable):
+                    coalesce_key = None
                     if processEvent == "end_multicollect":
-                        endOfLineToExecute = grouped_processing("end_multicollect", paramsDict)
-		    elif os.path.isdir(paramsDict["xds_dir"]):
+                        args = grouped_processing("end_multicollect", paramsDict)
+                    elif os.path.isdir(paramsDict["xds_dir"]):
                         dataCollectionId = paramsDict.get('datacollect_id')
                         residues = paramsDict.get('residues', 0)
                         anomalous = paramsDict.get('anomalous', False)
-                        spacegroup = paramsDict.get('spacegroup')
-                        if spacegroup: 
-                            sg_opt = ' -sg {0}'.format(spacegroup)
-                        else:
-                            sg_opt = ''
-
-                        unit_cell_constants = paramsDict.get('cell')
-                        if unit_cell_constants:
-                            cell_opt = ' -cell "{0}"'.format(unit_cell_constants)
-                        else:
-                            cell_opt = ''
-
-			endOfLineToExecute = ' -path ' + paramsDict["xds_dir"] +\
-					     ' -mode ' + processEvent +\
-					     ' -datacollectionID ' + str(dataCollectionId) +\
-					     ' -residues ' + str(residues) +\
-					     ' -anomalous ' + str(anomalous) +\
-					     sg_opt + cell_opt #+\
-					     #(paramsDict["inverse_beam"] and ' -inverse' or '')
-                    lineToExecute = executable + endOfLineToExecute + ' 2>&1 > /dev/null &'
-		    logging.info("Process event %s, executing %s" % (processEvent,str(lineToExecute)))
-
-                    subprocess.Popen(str(lineToExecute), shell=True, stdin=None,
-                                     stdout=None, stderr=None, close_fds=True)
-		else:
+
+                        args = ['-path', paramsDict["xds_dir"],
+                                '-mode', processEvent,
+                                '-datacollectionID', str(dataCollectionId),
+                                '-residues', str(residues),
+                                '-anomalous', str(anomalous)] + _options(paramsDict)
+                                #(paramsDict["inverse_beam"] and ' -inverse' or '')
+                        if processEvent == "image":
+                            coalesce_key = (executable, dataCollectionId, paramsDict["xds_dir"])
+                    else:
+                        continue
+                    dispatcher.submit(processEvent, executable, args, coalesce_key=coalesce_key)
+                else:
                     logging.getLogger().error("No program to execute found (%s)",executable)
         except:
             logging.exception("autoprocessing: an error occurred")
 
+
 def startInducedRadDam(datacollect_params, old={"xds_dir":None}):
     if not datacollect_params["xds_dir"] == old["xds_dir"]:
         old["xds_dir"]=datacollect_params["xds_dir"]
         eda_dirs=filter(os.path.isdir, [os.path.join(datacollect_params['EDNA_files_dir'], x) for x in os.listdir(datacollect_params['EDNA_files_dir']) if x.startswith("EDA")])
         eda_dirs.sort()
         EDApplication = eda_dirs[-1]
-        os.system("export TCL_LIBRARY=/usr/share/tcl8.4;/opt/pxsoft/bin/InducedRadDam.py -i -e %s -p %s &" % (EDApplication, datacollect_params["xds_dir"]))
+        get_dispatcher().submit("after", "/opt/pxsoft/bin/InducedRadDam.py",
+                                ["-i", "-e", EDApplication, "-p", datacollect_params["xds_dir"]],
+                                env={"TCL_LIBRARY": "/usr/share/tcl8.4"})
     return True
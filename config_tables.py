@@ -0,0 +1,193 @@
+"""
+Static tables read from the spec configuration files (edge energies and
+undulator parameters).
+
+Each file is parsed once into an indexed table, which is kept in memory
+and parsed again only when the file modification time changes. The
+modification time is checked at most every <check_interval> seconds, so
+that many queries in a row (e.g MAD energies planning) do not touch the
+filesystem.
+"""
+
+import os
+import time
+import math
+import logging
+import numpy
+
+EDGE_SCAN_FILE = "/users/blissadm/local/spec/userconf/EdgeScan.dat"
+UNDULATORS_FILE = "/users/blissadm/local/spec/userconf/undulators.dat"
+
+
+def read_rows(config_file):
+    """
+    Returns the split lines of <config_file>, without the comment lines
+    """
+    f = open(config_file)
+    try:
+        return [line.split() for line in f if not line.startswith('#')]
+    finally:
+        f.close()
+
+
+class ConfigTable(object):
+    """
+    Table built from the rows of a config file by <parse_fun>, reloaded
+    when the file changes.
+    """
+    def __init__(self, config_file, parse_fun, check_interval=1):
+        self.config_file = config_file
+        self.parse_fun = parse_fun
+        self.check_interval = check_interval
+        self._table = None
+        self._mtime = None
+        self._last_check = 0
+
+
+    def get(self):
+        """
+        Returns the table, raises IOError if the file cannot be read
+        """
+        now = time.time()
+        if self._table is None or now - self._last_check >= self.check_interval:
+            self._last_check = now
+            mtime = os.stat(self.config_file).st_mtime
+            if self._table is None or mtime != self._mtime:
+                self._table = self.parse_fun(read_rows(self.config_file))
+                self._mtime = mtime
+        return self._table
+
+
+    def invalidate(self):
+        self._table = None
+
+
+_tables = {}
+
+def get_table(config_file, parse_fun):
+    """
+    Returns the table of <config_file>, one instance per file and parser
+    """
+    key = (config_file, parse_fun)
+    try:
+        table = _tables[key]
+    except KeyError:
+        table = _tables[key] = ConfigTable(config_file, parse_fun)
+    return table.get()
+
+
+def parse_edges(rows):
+    """
+    {(element, shell): [energies and ROI values]}, shell being the first
+    letter of the edge ("K" or "L"). The last line wins for duplicates.
+    """
+    edges = {}
+    for row in rows:
+        try:
+            edges[(row[1], row[2])] = map(float, row[3:13]) + [float(row[17])]
+        except (IndexError, ValueError):
+            continue
+    return edges
+
+
+def get_edge_parameters(element, edge, config_file=EDGE_SCAN_FILE):
+    """
+    Returns the edge energy [keV] and the ROI limits for <element> and
+    <edge> ("K", "L1", "L2", "L3")
+    """
+    larr = list(get_table(config_file, parse_edges)[(element, edge[0])])
+
+    if edge == "K":
+        to_delete = [1,2,3,4,5,6,7]
+    else:
+        try:
+            if int(edge[1]) == 1:
+                to_delete = [0,1,2,4,5,6,7]
+            elif int(edge[1]) == 2:
+                to_delete = [0,1,2,3,5,6,7]
+            else:
+                to_delete = [0,1,2,3,4,6,7]
+        except:
+            to_delete = [0,1,2,3,4,6,7]
+    for ii in sorted(to_delete, reverse=True):
+        del larr[ii]
+
+    return larr[0] / 1000, larr[1], larr[2]
+
+
+class Undulator(object):
+    def __init__(self, name, max_gap, parameters):
+        self.name = name
+        self.max_gap = max_gap
+        self.parameters = parameters
+
+
+def parse_undulators(rows):
+    """
+    Ordered list of Undulator objects, as in the file
+    """
+    return [Undulator(row[0], row[1], map(float, row[2:])) for row in rows if row]
+
+
+def get_undulators(config_file=UNDULATORS_FILE):
+    return get_table(config_file, parse_undulators)
+
+
+def calc_gap_array(energies, arr):
+    """
+    Gaps [mm] of the undulator of parameters <arr> for an array of
+    <energies> [keV], using the lowest harmonic giving a gap above the
+    minimum gap; 0 when there is no solution.
+    """
+    energies = numpy.asarray(energies, dtype=float)
+    contst_en = 6.04
+    const = 13.056*arr[1]*100/pow(contst_en,2)
+    k2 = (math.pi/arr[1])/1000
+    #Transform energy in wavelength
+    h_over_e = 12.3984
+    target = (h_over_e/energies)/const
+
+    gaps = numpy.zeros(energies.shape)
+    solved = numpy.zeros(energies.shape, dtype=bool)
+    for i in range(1, 19, 2):
+        targ = (target*i - 1)*2
+        valid = (targ > 0) & ~solved
+        if not valid.any():
+            continue
+        k = numpy.sqrt(numpy.where(valid, targ, 1))
+        bo = k/(arr[1]*93.4)
+        #gap is not quite right - correction factors
+        g = -1*numpy.log(bo/arr[2])/k2 + arr[5]
+        found = valid & (g > arr[4])
+        gaps[found] = g[found]
+        solved |= found
+    return gaps
+
+
+if __name__ == '__main__':
+    # per energy cost of the undulator gap calculation: file parsing and
+    # scalar loop on each call, as before, versus table and array
+    import sys
+    import tempfile
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    fd, filename = tempfile.mkstemp()
+    f = os.fdopen(fd, "w")
+    f.write("#name max_gap parameters\n")
+    f.write("u21d 30. 1.6 2.1 1.9 0 6 0.3\n")
+    f.write("u35 30. 1.6 3.5 1.9 0 11 0.3\n")
+    f.close()
+    energies = numpy.linspace(6, 18, n)
+
+    t0 = time.time()
+    for energy in energies:
+        for row in read_rows(filename):
+            calc_gap_array([energy], map(float, row[2:]))
+    t1 = time.time()
+    for undulator in get_undulators(filename):
+        calc_gap_array(energies, undulator.parameters)
+    t2 = time.time()
+    os.unlink(filename)
+
+    print "%d energies: %.2f ms re-reading the file, %.2f ms with the cached table" % \
+          (n, 1000 * (t1 - t0), 1000 * (t2 - t1))
@@ -0,0 +1,229 @@
+"""
+Motor positions of a diffractometer, kept in memory.
+
+The positions and states of the axes are updated by the 'positionChanged'
+and 'stateChanged' signals of the motors, so that reading them does not
+query the hardware (a Tango/EPICS round trip per motor):
+
+    state = DiffractometerState({"phi": phi_motor, "phiz": phiz_motor, ...})
+    positions = state.get_positions()       # {"phi": 30.0, "phiz": 0.1, ...}
+
+An axis is stale, and read from the hardware by get_positions(), when
+- its position is not known (not read yet, or not a number),
+- its motor did not emit any 'positionChanged' signal yet (connecting
+  to a motor always succeeds, even if it never emits that signal),
+- its motor state changed since the last position update (the final
+  position of a movement is read once, in case the motor does not emit
+  it), or its predefined position changed,
+- it was invalidated (invalidate()),
+- its last update is older than <max_age> seconds, if given.
+
+get_positions() reads the stale axes first, then copies all the positions
+without yielding to other greenlets: the positions returned were all held
+at the same time. The version is incremented on every change, so that the
+values computed from the positions can be cached.
+"""
+
+import time
+import logging
+
+
+class AxisState(object):
+    def __init__(self, store, role, motor):
+        self.store = store
+        self.role = role
+        self.motor = motor
+        self.position = None
+        self.state = None
+        self.timestamp = None
+        self.connected = False
+        self.signalled = False
+        self.valid = False
+
+
+    def connect(self):
+        try:
+            self.motor.connect("positionChanged", self.position_changed)
+            self.motor.connect("stateChanged", self.state_changed)
+            self.motor.connect("predefinedPositionChanged", self.predefined_position_changed)
+        except:
+            logging.getLogger("HWR").debug("%s motor does not emit signals, reading it from the hardware",
+                                           self.role)
+        else:
+            self.connected = True
+
+
+    def disconnect(self):
+        if self.connected:
+            try:
+                self.motor.disconnect("positionChanged", self.position_changed)
+                self.motor.disconnect("stateChanged", self.state_changed)
+                self.motor.disconnect("predefinedPositionChanged", self.predefined_position_changed)
+            except:
+                pass
+            self.connected = False
+            self.signalled = False
+
+
+    def position_changed(self, position, *args):
+        # the motor emits its positions, they can be trusted from now on
+        self.signalled = self.connected
+        self._set_position(position)
+
+
+    def _set_position(self, position):
+        try:
+            self.position = float(position)
+        except (TypeError, ValueError):
+            self.position = None
+        self.timestamp = time.time()
+        self.valid = self.position is not None
+        self.store.version += 1
+
+
+    def state_changed(self, state, *args):
+        self.state = state
+        self.valid = False
+        self.store.version += 1
+
+
+    def predefined_position_changed(self, *args):
+        self.valid = False
+        self.store.version += 1
+
+
+    def refresh(self):
+        try:
+            self.state = self.motor.getState()
+        except:
+            pass
+        self._set_position(self.motor.getPosition())
+
+
+    def is_stale(self, max_age=None):
+        if not (self.valid and self.signalled):
+            return True
+        return max_age is not None and time.time() - self.timestamp > max_age
+
+
+class DiffractometerState(object):
+    def __init__(self, motors, max_age=None):
+        """
+        :param motors: motor hardware objects by role, None are ignored
+        :param max_age: seconds after which a position is read again from
+                        the hardware (None: the signals are trusted)
+        """
+        self.max_age = max_age
+        self.version = 0
+        self.axes = {}
+
+        for role, motor in motors.iteritems():
+            if motor is not None:
+                axis = self.axes[role] = AxisState(self, role, motor)
+                axis.connect()
+
+
+    def close(self):
+        for axis in self.axes.itervalues():
+            axis.disconnect()
+
+
+    def stale(self, roles=None):
+        """
+        Returns the roles of the stale axes (among <roles>)
+        """
+        if roles is None:
+            roles = self.axes.iterkeys()
+        return [role for role in roles if self.axes[role].is_stale(self.max_age)]
+
+
+    def invalidate(self, roles=None):
+        """
+        Marks the axes (all if None) as stale, their positions will be read
+        again from the hardware
+        """
+        for role in self.axes if roles is None else roles:
+            self.axes[role].valid = False
+        self.version += 1
+
+
+    def refresh(self, roles=None):
+        """
+        Reads the axes (all if None) from the hardware
+        """
+        for role in self.axes.keys() if roles is None else roles:
+            self.axes[role].refresh()
+
+
+    def get_position(self, role):
+        """
+        Returns the position of the axis <role> (None if not defined)
+        """
+        axis = self.axes.get(role)
+        if axis is None:
+            return None
+        if axis.is_stale(self.max_age):
+            axis.refresh()
+        return axis.position
+
+
+    def get_positions(self, roles=None):
+        """
+        Returns the positions of the axes (all if None) by role
+        """
+        if roles is None:
+            roles = self.axes.keys()
+        self.refresh(self.stale(roles))
+        axes = self.axes
+        return dict([(role, axes[role].position) for role in roles])
+
+
+    def get_state(self, role):
+        axis = self.axes.get(role)
+        return None if axis is None else axis.state
+
+
+if __name__ == '__main__':
+    # getPositions of 9 axes: hardware reads (1 ms round trip) against
+    # the state store, with 100 positions changes per read
+    import sys
+
+    class Motor(object):
+        def __init__(self, position, latency=1e-3):
+            self.position = position
+            self.latency = latency
+            self.slots = {}
+        def connect(self, signal, slot):
+            self.slots[signal] = slot
+        def disconnect(self, signal, slot):
+            del self.slots[signal]
+        def getPosition(self):
+            time.sleep(self.latency)
+            return self.position
+        def getState(self):
+            return 2
+        def move(self, position):
+            self.position = position
+            self.slots["positionChanged"](position)
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    roles = ("phi", "focus", "phiy", "phiz", "sampx", "sampy", "kappa", "kappa_phi", "zoom")
+    motors = dict([(role, Motor(i)) for i, role in enumerate(roles)])
+
+    t0 = time.time()
+    for i in range(n):
+        positions = dict([(role, float(motor.getPosition())) for role, motor in motors.iteritems()])
+    t1 = time.time()
+    state = DiffractometerState(motors)
+    for motor in motors.itervalues():
+        # first position signal of each motor
+        motor.move(motor.position)
+    for i in range(n):
+        for j in range(100):
+            motors["phi"].move(i + j / 100.0)
+        positions = state.get_positions()
+    t2 = time.time()
+    assert positions["phi"] == motors["phi"].position
+
+    print "%d reads: %.3f ms per read from the hardware, %.3f ms from the store (version %d)" % \
+          (n, 1000 * (t1 - t0) / n, 1000 * (t2 - t1) / n, state.version)
@@ -0,0 +1,316 @@
+"""
+Energy scan analysis, shared by the energy scan hardware objects.
+
+Scan points are accumulated in a preallocated NumPy buffer while they
+arrive, Chooch runs on the in-memory points as soon as the scan is over
+and the result files (raw scan files, archive copies of the Chooch .efs
+file and PNG graphs) are written by a worker thread, so that the scan
+result is available right after the last point.
+
+Usage:
+
+    points = ScanPoints()
+    points.append(energy_in_eV(x), y)
+    ...
+    result = run_chooch(points, "Se", "K", efs_filename)
+    save_scan_files(points, raw_files=[raw_filename],
+                    copies=[(efs_filename, archive_efs_filename)],
+                    png_files=[png_filename], chooch_result=result,
+                    title=title)
+"""
+
+import os
+import shutil
+import logging
+import numpy
+import gevent
+import PyChooch
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+
+def energy_in_eV(energy):
+    """
+    Scan energies can be given in keV or in eV, Chooch wants eV
+    """
+    return energy < 1000 and energy * 1000.0 or energy
+
+
+class ScanPoints(object):
+    """
+    (energy, counts) points of an energy scan, stored in a NumPy
+    buffer which is allocated once and doubled when full.
+    """
+    def __init__(self, size=512):
+        self._points = numpy.zeros((max(size, 1), 2))
+        self._n = 0
+        self._last_x = None
+
+
+    def __len__(self):
+        return self._n
+
+
+    def __getitem__(self, index):
+        return tuple(self.data[index])
+
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+
+    def clear(self):
+        self._n = 0
+        self._last_x = None
+
+
+    def append(self, x, y, increasing=False):
+        """
+        Adds a point, returns False if <increasing> is True and the point
+        energy is not greater than the one of the last point (Chooch
+        needs increasing energies).
+        """
+        if increasing and self._last_x is not None and x <= self._last_x:
+            return False
+
+        if self._n == len(self._points):
+            self._points = numpy.resize(self._points, (2 * len(self._points), 2))
+
+        self._points[self._n] = (x, y)
+        self._n += 1
+        self._last_x = x
+        return True
+
+
+    def extend(self, x, y):
+        x = numpy.asarray(x, dtype=float)
+        y = numpy.asarray(y, dtype=float)
+        n = self._n + len(x)
+
+        if n > len(self._points):
+            self._points = numpy.resize(self._points, (max(n, 2 * len(self._points)), 2))
+
+        self._points[self._n:n, 0] = x
+        self._points[self._n:n, 1] = y
+        self._n = n
+        if n > 0:
+            self._last_x = self._points[n - 1, 0]
+
+
+    def load(self, filename, skip_lines=2, delimiter=None, to_eV=False):
+        """
+        Replaces the points by the 2 first columns of a scan file
+        """
+        data = numpy.loadtxt(filename, skiprows=skip_lines, delimiter=delimiter,
+                             usecols=(0, 1), ndmin=2)
+        self.clear()
+        if to_eV:
+            data[:, 0] = numpy.where(data[:, 0] < 1000, data[:, 0] * 1000.0, data[:, 0])
+        self.extend(data[:, 0], data[:, 1])
+
+
+    @property
+    def data(self):
+        """
+        View on the stored points, as a (n, 2) array
+        """
+        return self._points[:self._n]
+
+
+    @property
+    def x(self):
+        return self._points[:self._n, 0]
+
+
+    @property
+    def y(self):
+        return self._points[:self._n, 1]
+
+
+    def tolist(self):
+        return [tuple(point) for point in self.data.tolist()]
+
+
+class ChoochResult(object):
+    """
+    Chooch results, energies in keV; the graph energies are kept in eV
+    as returned by Chooch.
+    """
+    def __init__(self, pk, fppPeak, fpPeak, ip, fppInfl, fpInfl, graph_data):
+        self.pk = pk / 1000.0
+        self.fppPeak = fppPeak
+        self.fpPeak = fpPeak
+        self.ip = ip / 1000.0
+        self.fppInfl = fppInfl
+        self.fpInfl = fpInfl
+        self.rm = (pk + 30) / 1000.0
+
+        if graph_data:
+            graph_x, graph_y1, graph_y2 = zip(*graph_data)
+        else:
+            graph_x, graph_y1, graph_y2 = (), (), ()
+        self.graph_x = list(graph_x)
+        self.graph_y1 = graph_y1
+        self.graph_y2 = graph_y2
+
+
+    def graph_x_keV(self):
+        return [x / 1000.0 for x in self.graph_x]
+
+
+def run_chooch(points, element, edge, efs_filename):
+    """
+    Runs Chooch on the in-memory scan points, Chooch itself writes
+    <efs_filename>.
+    """
+    pk, fppPeak, fpPeak, ip, fppInfl, fpInfl, chooch_graph_data = \
+        PyChooch.calc(points.tolist(), element, edge, efs_filename)
+    return ChoochResult(pk, fppPeak, fpPeak, ip, fppInfl, fpInfl, chooch_graph_data)
+
+
+def write_raw_file(filename, data):
+    numpy.savetxt(filename, data, fmt="%f", delimiter=",", newline="\r\n")
+
+
+def render_graphs(png_files, data, graph_x, graph_y1, graph_y2, title,
+                  same_xlim=False, dpi=80):
+    """
+    Renders the scan and the Chooch graphs in one figure, saved to each
+    of <png_files>
+    """
+    fig = Figure(figsize=(15, 11))
+    ax = fig.add_subplot(211)
+    ax.set_title(title)
+    ax.grid(True)
+    ax.plot(data[:, 0], data[:, 1], color='black')
+    ax.set_xlabel("Energy")
+    ax.set_ylabel("MCA counts")
+    ax2 = fig.add_subplot(212)
+    ax2.grid(True)
+    ax2.set_xlabel("Energy")
+    ax2.set_ylabel("")
+    if same_xlim:
+        # same x axis range for the Chooch results as for the raw data
+        xmin, xmax = ax.get_xlim()
+        ax2.set_autoscalex_on(False)
+        ax2.set_xlim(xmin, xmax)
+    ax2.plot(graph_x, graph_y1, color='blue')
+    ax2.plot(graph_x, graph_y2, color='red')
+    canvas = FigureCanvasAgg(fig)
+
+    for png_file in png_files:
+        canvas.print_figure(png_file, dpi=dpi)
+
+
+def _write_scan_files(data, raw_files, copies, png_files, graph, title, same_xlim):
+    # runs in a worker thread: errors are returned, to be logged from
+    # the gevent loop
+    errors = []
+
+    for filename in raw_files:
+        try:
+            write_raw_file(filename, data)
+        except Exception, err:
+            errors.append("could not write raw scan file %s (%s)" % (filename, err))
+
+    for src, dst in copies:
+        try:
+            shutil.copyfile(src, dst)
+        except Exception, err:
+            errors.append("could not copy %s to %s (%s)" % (src, dst, err))
+
+    if png_files and graph is not None:
+        try:
+            render_graphs(png_files, data, graph[0], graph[1], graph[2],
+                          title, same_xlim)
+        except Exception, err:
+            errors.append("could not render energy scan graphs to %s (%s)" % (", ".join(png_files), err))
+
+    return errors
+
+
+def _wait_scan_files(async_result, callback):
+    try:
+        errors = async_result.get()
+    except:
+        logging.getLogger("HWR").exception("EnergyScan: could not save scan files")
+        errors = None
+    else:
+        for error in errors:
+            logging.getLogger("HWR").error("EnergyScan: %s", error)
+
+    if callable(callback):
+        try:
+            callback(errors == [])
+        except:
+            logging.getLogger("HWR").exception("EnergyScan: error in scan files callback")
+
+    return errors == []
+
+
+def save_scan_files(points, raw_files=(), copies=(), png_files=(),
+                    chooch_result=None, graph_x=None, title="",
+                    same_xlim=False, callback=None):
+    """
+    Writes the scan points to <raw_files>, copies the (src, dst) files of
+    <copies> and renders the scan and Chooch graphs to <png_files> in a
+    worker thread.
+
+    The points are copied, so the buffer can be reused right away.
+    <graph_x> defaults to the Chooch graph energies in eV. <callback> is
+    called from the gevent loop with True if all files were written.
+
+    Returns a greenlet, whose value is True if all files were written.
+    """
+    data = numpy.array(points.data)
+
+    for filename in list(raw_files) + [dst for src, dst in copies] + list(png_files):
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    graph = None
+    if chooch_result is not None:
+        if graph_x is None:
+            graph_x = chooch_result.graph_x
+        graph = (graph_x, chooch_result.graph_y1, chooch_result.graph_y2)
+
+    async_result = gevent.get_hub().threadpool.spawn(_write_scan_files, data,
+        list(raw_files), list(copies), list(png_files), graph, title, same_xlim)
+    return gevent.spawn(_wait_scan_files, async_result, callback)
+
+
+if __name__ == '__main__':
+    # time spent by the caller between the last scan point and the Chooch
+    # call, compared to the former list + synchronous raw files writing
+    import sys
+    import time
+    import tempfile
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    directory = tempfile.mkdtemp()
+    raw_files = [os.path.join(directory, "scan%d.raw" % i) for i in range(2)]
+    scan_data = [[12000.0 + i, float(i)] for i in xrange(n)]
+    points = ScanPoints()
+    for x, y in scan_data:
+        points.append(x, y, increasing=True)
+
+    t0 = time.time()
+    chooch_input = []
+    raw = [open(filename, "w") for filename in raw_files]
+    for x, y in scan_data:
+        chooch_input.append((float(x), float(y)))
+        for f in raw:
+            f.write("%f,%f\r\n" % (x, y))
+    for f in raw:
+        f.close()
+    t1 = time.time()
+    chooch_input = points.tolist()
+    writer = save_scan_files(points, raw_files=raw_files)
+    t2 = time.time()
+    writer.join()
+    t3 = time.time()
+
+    print "%d points: list + raw files %.2f ms, ScanPoints %.2f ms (files written %.2f ms later)" % \
+          (n, 1000 * (t1 - t0), 1000 * (t2 - t1), 1000 * (t3 - t2))
+    shutil.rmtree(directory)
@@ -0,0 +1,560 @@
+"""
+Offline throughput benchmarks of the data collection and queue code, on
+a headless mock beamline.
+
+MultiCollectMockup, DiffractometerMockup, ISPyBClient2Mockup,
+SampleChangerMockup, EnergyScanMockup, BeamlineSetup, QueueModel and
+QueueManager are wired together without XML configuration nor GUI: the
+tree items of the queue brick are replaced by NullView objects and the
+shape history by NullShapeHistory, and the centrings are accepted as
+soon as they are started. The workloads are built as queue models,
+turned into queue entries the way the queue brick does it
+(QueueModel.view_created) and executed by the queue manager, with a
+zero exposure time, so that everything measured is overhead:
+
+- sweep: one data collection of 1000 frames,
+- samples: 100 samples, mounted and centred, with a 10 frames
+  collection each,
+- characterisation: reference images and characterisation, then a
+  100 frames collection, for 20 samples,
+- mad: energy scan, then peak, inflection and remote collections of
+  100 frames, for 5 samples.
+
+Each workload runs in its own process, and gives:
+
+- wall_time_s: execution time of the whole queue,
+- frame_dead_time_ms: mean time between two frames of a collection,
+- sample_overhead_ms: time spent out of the data collections, per
+  sample (mount, centring, queue entries, LIMS),
+- greenlet_switches: number of greenlet switches during the execution
+  (None if the greenlet module cannot trace them),
+- peak_rss_kb: maximum resident set size of the process.
+
+The results are written as JSON (-o), and compared to the results of a
+previous run (-c): a metric more than <threshold> above the previous
+value is reported as a regression, and the exit status is 1. The exit
+status is also 1 if a workload failed (crashed, timed out or stopped the
+queue), and a failed or missing workload is a regression.
+
+    python mock_beamline_benchmark.py -o before.json
+    ...
+    python mock_beamline_benchmark.py -c before.json -o after.json
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import logging
+import optparse
+import resource
+import tempfile
+import subprocess
+import gevent
+import gevent.event
+import greenlet
+
+import queue_model_objects_v1 as queue_model_objects
+from queue_model_enumerables_v1 import CENTRING_METHOD
+
+WORKLOADS = ("sweep", "samples", "characterisation", "mad")
+METRICS = ("wall_time_s", "frame_dead_time_ms", "sample_overhead_ms",
+           "greenlet_switches", "peak_rss_kb")
+
+
+class NullView(object):
+    """
+    Headless tree item of the queue brick
+    """
+    def __init__(self, parent, list_view):
+        self._parent = parent
+        self._list_view = list_view
+        self._queue_entry = None
+        self._data_model = None
+        self.texts = {}
+
+    def set_queue_entry(self, queue_entry):
+        self._queue_entry = queue_entry
+
+    def get_queue_entry(self):
+        return self._queue_entry
+
+    def get_model(self):
+        return self._data_model
+
+    def parent(self):
+        return self._parent
+
+    def listView(self):
+        return self._list_view
+
+    def setText(self, column, text):
+        self.texts[column] = text
+
+    def setOn(self, state):
+        # checking an item enables its queue entry
+        if self._queue_entry is not None:
+            self._queue_entry.set_enabled(state)
+
+    def setHighlighted(self, state):
+        pass
+
+    def setBackgroundColor(self, color):
+        pass
+
+    def set_checkable(self, state):
+        pass
+
+
+class NullListView(object):
+    """
+    Headless tree of the queue brick, which is also its own parent (the
+    brick, giving the queue model and the centring method)
+    """
+    def __init__(self, queue_model_hwobj, centring_method):
+        self.queue_model_hwobj = queue_model_hwobj
+        self.centring_method = centring_method
+
+    def parent(self):
+        return self
+
+
+class NullShapeHistory(object):
+    """
+    Shape history without drawing
+    """
+    def clear_all(self):
+        pass
+
+    def de_select_all(self):
+        pass
+
+    def select_shape_with_cpos(self, cpos):
+        pass
+
+    def get_snapshot(self, qub_objects):
+        return None
+
+
+class SwitchCounter(object):
+    """
+    Counts the greenlet switches while started
+    """
+    def __init__(self):
+        self.switches = None
+        self._previous_trace = None
+
+    def _trace(self, event, args):
+        if event in ("switch", "throw"):
+            self.switches += 1
+        if self._previous_trace is not None:
+            self._previous_trace(event, args)
+
+    def start(self):
+        if hasattr(greenlet, "settrace"):
+            self.switches = 0
+            self._previous_trace = greenlet.settrace(self._trace)
+
+    def stop(self):
+        if self.switches is not None:
+            greenlet.settrace(self._previous_trace)
+
+
+class MockBeamline(object):
+    def __init__(self, base_directory, mount_samples=True, frame_pipeline_depth=0):
+        from MotorMockup import MotorMockup
+        from DiffractometerMockup import DiffractometerMockup
+        from ISPyBClient2Mockup import ISPyBClient2Mockup
+        from SampleChangerMockup import SampleChangerMockup
+        from EnergyScanMockup import EnergyScanMockup
+        from MultiCollectMockup import MultiCollectMockup
+        from Session import Session
+        from BeamlineSetup import BeamlineSetup
+        from QueueManager import QueueManager
+        from QueueModel import QueueModel
+
+        self.base_directory = base_directory
+        self.mount_samples = mount_samples
+        queue_model_objects.PathTemplate.set_archive_path("", "")
+
+        self.lims = ISPyBClient2Mockup("/dbconnection")
+
+        self.diffractometer = DiffractometerMockup("/minidiff")
+        for role in ("kappa", "kappa_phi"):
+            motor = MotorMockup("/%s" % role)
+            motor.init()
+            self.diffractometer.addObject(role, motor, role=role)
+        self.diffractometer.init()
+        # the user accepts the centrings right away
+        self.diffractometer.connect("centringStarted", self._centring_started)
+
+        self.sample_changer = None
+        if mount_samples:
+            self.sample_changer = SampleChangerMockup("/sc")
+            self.sample_changer.init()
+
+        self.energy_scan = EnergyScanMockup("/energyscan")
+        self.energy_scan.init()
+
+        self.session = Session("/session")
+        self.session.session_id = 1
+        self.session.proposal_code = "mx"
+        self.session.proposal_number = "1234"
+        self.session.proposal_id = 1
+        self.session.endstation_name = "mock"
+        self.session.suffix = "cbf"
+        self.session.base_directory = base_directory
+        self.session.base_process_directory = base_directory
+        self.session.raw_data_folder_name = "RAW_DATA"
+        self.session.processed_data_folder_name = "PROCESSED_DATA"
+
+        self.collect = MultiCollectMockup("/mxcollect")
+        self.collect.addObject("diffractometer", self.diffractometer, role="diffractometer")
+        self.collect.addObject("dbserver", self.lims, role="dbserver")
+        if self.sample_changer is not None:
+            self.collect.addObject("sample_changer", self.sample_changer, role="sample_changer")
+        self.collect.setProperty("frame_pipeline_depth", frame_pipeline_depth)
+        self.collect.init()
+        self.collect.setBeamlineConfiguration(**dict([(field, None) for field in \
+            self.collect.bl_config._fields], detector_fileext="cbf", directory_prefix="mock",
+            undulators=[]))
+
+        self.beamline_setup = BeamlineSetup("/beamline-setup")
+        for role, hwobj in (("collect", self.collect),
+                            ("diffractometer", self.diffractometer),
+                            ("sample_changer", self.sample_changer),
+                            ("lims_client", self.lims),
+                            ("session", self.session),
+                            ("shape_history", NullShapeHistory()),
+                            ("energyscan", self.energy_scan)):
+            self.beamline_setup.addObject(role, hwobj, role=role)
+        self.beamline_setup.init()
+
+        self.queue = QueueManager("/queue")
+        self.queue.addObject("beamline_setup", self.beamline_setup, role="beamline_setup")
+        self.queue_model = QueueModel("/queue-model")
+        self.queue_model.addObject("queue", self.queue, role="queue")
+        self.queue_model.init()
+        self.list_view = NullListView(self.queue_model, CENTRING_METHOD.FULLY_AUTOMATIC)
+        self._views = {}
+
+        self.samples = 0
+        self.frames = 0
+        self.frame_intervals = 0
+        self.frame_time = 0
+        self.collections = 0
+        self.collection_time = 0
+        self.failed = False
+        self._finished = None
+        self._collect_start = None
+        self._last_frame = None
+        self.collect.connect("collectOscillationStarted", self._collect_started)
+        self.collect.connect("collectOscillationFinished", self._collect_ended)
+        self.collect.connect("collectOscillationFailed", self._collect_ended)
+        self.collect.connect("collectImageTaken", self._image_taken)
+
+
+    def _centring_started(self, method, flag):
+        gevent.spawn(self._accept_centring)
+
+
+    def _accept_centring(self):
+        self.diffractometer.current_centring_method = None
+        self.diffractometer.accept_centring()
+
+
+    def _collect_started(self, *args):
+        self._collect_start = time.time()
+        self._last_frame = None
+
+
+    def _collect_ended(self, *args):
+        if self._collect_start is not None:
+            self.collections += 1
+            self.collection_time += time.time() - self._collect_start
+            self._collect_start = None
+
+
+    def _image_taken(self, frame):
+        now = time.time()
+        self.frames += 1
+        if self._last_frame is not None:
+            self.frame_intervals += 1
+            self.frame_time += now - self._last_frame
+        self._last_frame = now
+
+
+    def add(self, parent, node):
+        """
+        Adds <node> to the queue model under <parent>, and its queue entry
+        like the queue brick does
+        """
+        self.queue_model.add_child(parent, node)
+        view = NullView(self._views.get(parent), self.list_view)
+        self._views[node] = view
+        self.queue_model.view_created(view, node)
+        return node
+
+
+    def add_sample(self, name):
+        sample = queue_model_objects.Sample()
+        sample.set_name(name)
+        sample.loc_str = name
+        sample.location = (self.samples // 10 % 5 + 1, self.samples % 10 + 1)
+        sample.free_pin_mode = not self.mount_samples
+        self.samples += 1
+        self.add(self.queue_model.get_model_root(), sample)
+        group = queue_model_objects.TaskGroup()
+        group.set_name("Group")
+        self.add(sample, group)
+        return sample, group
+
+
+    def _path_template(self, path_template, name, num_files):
+        path_template.directory = os.path.join(self.base_directory, "RAW_DATA", name)
+        path_template.process_directory = os.path.join(self.base_directory, "PROCESSED_DATA", name)
+        path_template.base_prefix = name
+        path_template.precision = "04"
+        path_template.suffix = "cbf"
+        path_template.start_num = 1
+        path_template.num_files = num_files
+        path_template.run_number = self.queue_model.get_next_run_number(path_template)
+
+
+    def data_collection(self, name, num_images, osc_range=0.1, energy=12.4):
+        dc = queue_model_objects.DataCollection()
+        acquisition_parameters = dc.acquisitions[0].acquisition_parameters
+        acquisition_parameters.first_image = 1
+        acquisition_parameters.num_images = num_images
+        acquisition_parameters.osc_range = osc_range
+        acquisition_parameters.exp_time = 0
+        acquisition_parameters.num_passes = 1
+        acquisition_parameters.energy = energy
+        acquisition_parameters.take_snapshots = False
+        acquisition_parameters.take_dark_current = False
+        dc.processing_parameters.process_data = False
+        self._path_template(dc.acquisitions[0].path_template, name, num_images)
+        dc.set_name(name)
+        dc.set_number(dc.acquisitions[0].path_template.run_number)
+        return dc
+
+
+    def characterisation(self, name, num_images=2):
+        reference = self.data_collection("ref-" + name, num_images, osc_range=1)
+        characterisation = queue_model_objects.Characterisation(reference, name=name)
+        characterisation.set_number(reference.acquisitions[0].path_template.run_number)
+        return characterisation
+
+
+    def energy_scan_task(self, name, element="Se", edge="K"):
+        energy_scan = queue_model_objects.EnergyScan()
+        energy_scan.element_symbol = element
+        energy_scan.edge = edge
+        self._path_template(energy_scan.path_template, name, 1)
+        energy_scan.set_name(name)
+        return energy_scan
+
+
+    def run(self, timeout=None):
+        """
+        Executes the queue, returns the metrics
+        """
+        self._finished = gevent.event.Event()
+        self.queue.connect("queue_execution_finished", self._queue_finished)
+        self.queue.connect("queue_stopped", self._queue_stopped)
+
+        counter = SwitchCounter()
+        counter.start()
+        t0 = time.time()
+        try:
+            self.queue.execute()
+            with gevent.Timeout(timeout):
+                self._finished.wait()
+        finally:
+            wall_time = time.time() - t0
+            counter.stop()
+
+        return {"wall_time_s": wall_time,
+                "samples": self.samples,
+                "collections": self.collections,
+                "frames": self.frames,
+                "frame_dead_time_ms": 1000 * self.frame_time / self.frame_intervals \
+                    if self.frame_intervals else None,
+                "sample_overhead_ms": 1000 * (wall_time - self.collection_time) / self.samples \
+                    if self.samples else None,
+                "greenlet_switches": counter.switches,
+                "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                "failed": self.failed}
+
+
+    def _queue_finished(self, *args):
+        self._finished.set()
+
+
+    def _queue_stopped(self, *args):
+        self.failed = True
+
+
+def build_sweep(beamline, num_images=1000):
+    sample, group = beamline.add_sample("sweep")
+    beamline.add(group, beamline.data_collection("sweep", num_images))
+
+
+def build_samples(beamline, num_samples=100, num_images=10):
+    for i in range(num_samples):
+        sample, group = beamline.add_sample("sample%d" % i)
+        beamline.add(group, beamline.data_collection("sample%d" % i, num_images))
+
+
+def build_characterisation(beamline, num_samples=20, num_images=100):
+    for i in range(num_samples):
+        sample, group = beamline.add_sample("char%d" % i)
+        beamline.add(group, beamline.characterisation("char%d" % i))
+        beamline.add(group, beamline.data_collection("char%d" % i, num_images))
+
+
+def build_mad(beamline, num_samples=5, num_images=100):
+    for i in range(num_samples):
+        sample, group = beamline.add_sample("mad%d" % i)
+        beamline.add(group, beamline.energy_scan_task("mad%d" % i))
+        for name, energy in (("pk", 12.66), ("ip", 12.65), ("rm", 12.9)):
+            beamline.add(group, beamline.data_collection("mad%d-%s" % (i, name),
+                                                         num_images, energy=energy))
+
+
+def run_workload(name, mount_samples=True, frame_pipeline_depth=0, timeout=600):
+    """
+    Builds and executes the workload <name> on a new mock beamline, in
+    a temporary directory
+    """
+    directory = tempfile.mkdtemp(prefix="mock_beamline_")
+    try:
+        beamline = MockBeamline(directory, mount_samples, frame_pipeline_depth)
+        globals()["build_" + name](beamline)
+        return beamline.run(timeout)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run_workloads(names, mount_samples=True, frame_pipeline_depth=0):
+    """
+    Runs each workload in a child process, so that their peak memory
+    and their state are independent
+    """
+    results = {}
+    for name in names:
+        args = [sys.executable, os.path.abspath(__file__), "--child", name,
+                "--pipeline-depth", str(frame_pipeline_depth)]
+        if not mount_samples:
+            args.append("--no-mount")
+        child = subprocess.Popen(args, stdout=subprocess.PIPE)
+        output = child.communicate()[0]
+        lines = output.strip().splitlines()
+        if child.returncode != 0 or not lines:
+            logging.getLogger("HWR").error("benchmark %s failed (exit status %s)", name, child.returncode)
+            results[name] = {"failed": True}
+        else:
+            results[name] = json.loads(lines[-1])
+    return results
+
+
+def compare(previous, current, threshold):
+    """
+    Prints the metrics of <current> against <previous> results, returns
+    the regressions as (workload, metric, previous, current) tuples. A
+    workload of <previous> that is missing or failed in <current> is a
+    regression with the metric "failed". A workload that failed in
+    <previous> has no baseline: it is only reported as fixed if it passes
+    in <current>.
+    """
+    regressions = []
+    print "%-18s %-20s %14s %14s %8s" % ("workload", "metric", "previous", "current", "change")
+    for name in sorted(set(previous.get("workloads", {})) | set(current["workloads"])):
+        before = previous.get("workloads", {}).get(name)
+        after = current["workloads"].get(name)
+        if before is None:
+            # new workload
+            continue
+        if after is None or after.get("failed"):
+            old = "failed" if before.get("failed") else "ok"
+            new = "missing" if after is None else "failed"
+            regressions.append((name, "failed", old, new))
+            print "%-18s %-20s %14s %14s %8s <-- regression" % (name, "failed", old, new, "")
+            continue
+        if before.get("failed"):
+            # no baseline
+            print "%-18s %-20s %14s %14s %8s <-- fixed" % (name, "failed", "failed", "ok", "")
+            continue
+        for metric in METRICS:
+            old, new = before.get(metric), after.get(metric)
+            if old is None or new is None:
+                continue
+            change = old and (float(new) - old) / old or 0
+            flag = ""
+            if change > threshold:
+                flag = " <-- regression"
+                regressions.append((name, metric, old, new))
+            print "%-18s %-20s %14.3f %14.3f %+7.1f%%%s" % (name, metric, old, new, 100 * change, flag)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-w", "--workloads", default=",".join(WORKLOADS),
+                      help="comma separated workloads to run (%default)")
+    parser.add_option("-o", "--output", help="JSON file to write the results to")
+    parser.add_option("-c", "--compare", help="JSON results of a previous run to compare with")
+    parser.add_option("-t", "--threshold", type="float", default=0.1,
+                      help="relative increase reported as a regression (%default)")
+    parser.add_option("--no-mount", action="store_true", default=False,
+                      help="free pin mode, without sample changer nor centring")
+    parser.add_option("--pipeline-depth", type="int", default=0,
+                      help="frame_pipeline_depth of the collect object (%default)")
+    parser.add_option("--child", help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+
+    if options.child:
+        result = run_workload(options.child, not options.no_mount, options.pipeline_depth)
+        sys.stdout.write(json.dumps(result) + "\n")
+        sys.exit(0)
+
+    names = [name for name in options.workloads.split(",") if name]
+    for name in names:
+        if name not in WORKLOADS:
+            parser.error("unknown workload %s" % name)
+
+    results = {"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+               "python": sys.version.split()[0],
+               "options": {"mount_samples": not options.no_mount,
+                           "frame_pipeline_depth": options.pipeline_depth},
+               "workloads": run_workloads(names, not options.no_mount, options.pipeline_depth)}
+
+    for name in names:
+        result = results["workloads"][name]
+        print "%s: %s" % (name, ", ".join(["%s=%s" % (key, result[key]) for key in sorted(result)]))
+
+    if options.output:
+        f = open(options.output, "w")
+        try:
+            json.dump(results, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    failed = [name for name in names if results["workloads"][name].get("failed")]
+    if failed:
+        logging.getLogger("HWR").error("failed workloads: %s", ", ".join(failed))
+
+    if options.compare:
+        f = open(options.compare)
+        try:
+            previous = json.load(f)
+        finally:
+            f.close()
+        if compare(previous, results, options.threshold):
+            sys.exit(1)
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,187 @@
+"""
+Waiting for the end of motor movements.
+
+A MotorGroup is woken up by the 'stateChanged' signals of its motors
+instead of sleeping between state queries. The states are also polled
+every poll_interval, for the motors that do not emit signals; without
+any signal the interval grows up to max_poll_interval, which is the
+same by default so that the end of their movement is not seen later
+than with plain polling.
+
+Only the motors that are not already at their target position have to
+report the start of their movement (see needs_move()): a motor already
+there neither changes its state nor signals anything. The state changes
+are recorded from mark(), to be called right before the move commands
+so that earlier signals are not taken for the start of the movement.
+"""
+
+import logging
+import gevent
+import gevent.event
+
+
+# positions closer than that are considered reached
+POSITION_TOLERANCE = 1E-4
+
+
+def needs_move(motor, position, tolerance=POSITION_TOLERANCE):
+    """
+    Returns False if <motor> is already at <position>, True otherwise
+    (or if its position can not be read)
+    """
+    try:
+        return abs(float(motor.getPosition()) - float(position)) > tolerance
+    except:
+        return True
+
+
+def not_moving(motor):
+    return not motor.motorIsMoving()
+
+
+def state_ready(motor):
+    return motor.getState() == motor.READY
+
+
+class MotorGroup(object):
+    """
+    Usage:
+
+        with MotorGroup(motors) as group:
+            group.mark()
+            for motor, position in positions.iteritems():
+                motor.move(position)
+            group.wait_started(timeout=0.1)
+            group.wait_ready(timeout=30)
+    """
+    def __init__(self, motors, ready_fun=not_moving,
+                 poll_interval=0.1, max_poll_interval=0.1):
+        self.motors = [motor for motor in motors if motor is not None]
+        self.ready_fun = ready_fun
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+
+        self._changed = gevent.event.Event()
+        self._signalled = set()
+        self._callbacks = {}
+        self._polled = False
+
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+
+    def __exit__(self, *args):
+        self.disconnect()
+
+
+    def connect(self):
+        for motor in self.motors:
+            if motor in self._callbacks:
+                continue
+            # keep a reference, the dispatcher only holds weak references
+            callback = self._callbacks[motor] = self._make_callback(motor)
+            try:
+                motor.connect("stateChanged", callback)
+            except:
+                logging.getLogger("HWR").debug("motor %r does not emit stateChanged, polling it", motor)
+                self._polled = True
+
+
+    def disconnect(self):
+        for motor, callback in self._callbacks.iteritems():
+            try:
+                motor.disconnect("stateChanged", callback)
+            except:
+                pass
+        self._callbacks = {}
+
+
+    def _make_callback(self, motor):
+        def state_changed(*args):
+            self._signalled.add(motor)
+            self._changed.set()
+        return state_changed
+
+
+    def mark(self):
+        """
+        Forgets the state changes reported so far, to be called right
+        before the move commands
+        """
+        self._signalled.clear()
+
+
+    def ready(self):
+        return all([self.ready_fun(motor) for motor in self.motors])
+
+
+    def _wait_for(self, condition):
+        interval = self.poll_interval
+
+        while True:
+            # clear before checking, so that no state change is missed
+            self._changed.clear()
+            if condition():
+                return
+            self._changed.wait(interval)
+            if self._changed.is_set() or self._polled:
+                interval = self.poll_interval
+            else:
+                interval = min(2*interval, self.max_poll_interval)
+
+
+    def wait_ready(self, timeout=None):
+        """
+        Waits until all the motors are ready, raises gevent.Timeout
+        after <timeout> seconds.
+        """
+        with gevent.Timeout(timeout):
+            self._wait_for(self.ready)
+
+
+    def wait_started(self, motors=None, timeout=0.1, fallback_timeout=None):
+        """
+        Waits until each motor of <motors> (all by default) has reported a
+        state change since mark() or is not ready any more, for at most
+        <timeout> seconds. Covers controllers that are slow at reporting
+        the MOVING state after a move command. If some motors did not
+        report their movement, waits <fallback_timeout> seconds more for
+        them (motors that never report a MOVING state).
+
+        :returns: True if all the motors reported their movement
+        """
+        motors = [motor for motor in (self.motors if motors is None else motors) \
+                  if motor is not None]
+
+        def started():
+            return all([motor in self._signalled or not self.ready_fun(motor) \
+                        for motor in motors])
+
+        with gevent.Timeout(timeout, False):
+            self._wait_for(started)
+            return True
+
+        if fallback_timeout:
+            with gevent.Timeout(fallback_timeout, False):
+                self._wait_for(started)
+                return True
+
+        return False
+
+
+def move_motors(motor_positions_dict, ready_fun=not_moving, timeout=None, start_timeout=0.1):
+    """
+    Moves all the motors of <motor_positions_dict> ({motor: position})
+    and waits until they are all ready.
+    """
+    with MotorGroup(motor_positions_dict.iterkeys(), ready_fun) as group:
+        group.mark()
+        moving = []
+        for motor, position in motor_positions_dict.iteritems():
+            if needs_move(motor, position):
+                moving.append(motor)
+            motor.move(position)
+        group.wait_started(moving, timeout=start_timeout)
+        group.wait_ready(timeout)
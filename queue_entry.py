@@ -28,6 +28,7 @@ import queue_model_objects_v1 as queue_model_objects
 import os
 import ShapeHistory as shape_history
 import autoprocessing
+import timings
 
 #import edna_test_data
 #from XSDataMXCuBEv1_3 import XSDataInputMXCuBE
@@ -828,9 +829,23 @@ class CharacterisationGroupQueueEntry(BaseQueueEntry):
         self.char_qe = char_qe
 
     def post_execute(self):
+        if self.char_qe.job_id is not None:
+            # EDNA is still running: the status of the group is set by
+            # characterisation_finished
+            self.get_view().setOn(False)
+            return
+
         self.status = self.char_qe.status
         BaseQueueEntry.post_execute(self)
 
+    def characterisation_finished(self, char_qe):
+        """
+        Called by the characterisation entry <char_qe> when its
+        background job is finished
+        """
+        self.status = char_qe.status
+        BaseQueueEntry.post_execute(self)
+
 
 class CharacterisationQueueEntry(BaseQueueEntry):
     """
@@ -845,11 +860,13 @@ class CharacterisationQueueEntry(BaseQueueEntry):
         self.queue_model_hwobj = None
         self.session_hwobj = None
         self.edna_result = None
+        self.job_id = None
 
     def execute(self):
         BaseQueueEntry.execute(self)
         log = logging.getLogger("user_level_log")
 
+        self.edna_result = None
         self.get_view().setText(1, "Characterising")
         log.info("Characterising, please wait ...")
         char = self.get_data_model()
@@ -865,8 +882,52 @@ class CharacterisationQueueEntry(BaseQueueEntry):
             #edna_input.process_directory = reference_image_collection.acquisitions[0].\
             #                                path_template.process_directory
 
+            if hasattr(self.data_analysis_hwobj, "submit_characterisation"):
+                # EDNA runs in the background, the queue goes on with the
+                # next entries meanwhile
+                self.job_id = self.data_analysis_hwobj.\
+                    submit_characterisation(edna_input, self.characterisation_finished)
+                log.info("Characterisation submitted (job %d)." % self.job_id)
+                return
+
             self.edna_result = self.data_analysis_hwobj.characterise(edna_input)
 
+        self.process_edna_result(self.data_analysis_hwobj is not None and \
+                                 self.data_analysis_hwobj.is_running())
+
+    def characterisation_finished(self, job):
+        """
+        Callback of the characterisation job submitted by execute
+        """
+        if self.job_id != job.id:
+            return
+        self.job_id = None
+        self.edna_result = job.result
+
+        if job.status == job.CANCELLED:
+            self.get_view().setText(1, "Cancelled")
+            self.status = QUEUE_ENTRY_STATUS.FAILED
+            logging.getLogger("user_level_log").\
+                warning("Characterisation (job %d) cancelled." % job.id)
+        else:
+            self.process_edna_result(False)
+            if not self.edna_result:
+                self.status = QUEUE_ENTRY_STATUS.FAILED
+
+        # the entry is finished now, not when the queue went on with the
+        # next entries
+        self.get_queue_controller().remove_background_entry(self)
+        BaseQueueEntry.post_execute(self)
+
+        group_entry = self.get_container()
+        if isinstance(group_entry, CharacterisationGroupQueueEntry):
+            group_entry.characterisation_finished(self)
+
+    def process_edna_result(self, not_responding):
+        log = logging.getLogger("user_level_log")
+        char = self.get_data_model()
+        reference_image_collection = char.reference_image_collection
+
         if self.edna_result:
             log.info("Characterisation completed.")
 
@@ -925,7 +986,7 @@ class CharacterisationQueueEntry(BaseQueueEntry):
         else:
             self.get_view().setText(1, "Charact. Failed")
 
-            if self.data_analysis_hwobj.is_running():
+            if not_responding:
                 log.error('EDNA-Characterisation, software is not responding.')
                 log.error("Characterisation completed with error: "\
                           + " data analysis server is not responding.")
@@ -947,7 +1008,22 @@ class CharacterisationQueueEntry(BaseQueueEntry):
         self.session_hwobj = self.beamline_setup.session_hwobj
 
     def post_execute(self):
-        BaseQueueEntry.post_execute(self)
+        if self.job_id is None:
+            BaseQueueEntry.post_execute(self)
+            return
+
+        # EDNA is still running: the entry is finished by
+        # characterisation_finished, and stopped with the queue until then
+        logging.getLogger('queue_exec').\
+            info('Characterisation running in the background: ' + str(self))
+        self.get_view().setOn(False)
+        self.get_queue_controller().add_background_entry(self)
+
+    def stop(self):
+        BaseQueueEntry.stop(self)
+
+        if self.job_id is not None:
+            self.data_analysis_hwobj.cancel_characterisation(self.job_id)
 
 
 class EnergyScanQueueEntry(BaseQueueEntry):
@@ -1316,6 +1392,7 @@ def mount_sample(beamline_setup_hwobj, view, data_model,
     view.setText(1, "Loading sample")
     beamline_setup_hwobj.shape_history_hwobj.clear_all()
     log = logging.getLogger("user_level_log")
+    sample_laps = timings.laps("sample")
 
     loc = data_model.location
     holder_length = data_model.holder_length
@@ -1333,6 +1410,7 @@ def mount_sample(beamline_setup_hwobj, view, data_model,
             # if sample could not be loaded, but no exception is raised, let's skip the sample
             raise QueueSkippEntryException("Sample changer could not load sample", "")
 
+    sample_laps.lap("load")
     dm = beamline_setup_hwobj.diffractometer_hwobj
 
     if dm is not None:
@@ -1357,6 +1435,7 @@ def mount_sample(beamline_setup_hwobj, view, data_model,
 
             view.setText(1, "Centring !")
             async_result.get()
+            sample_laps.lap("centring")
             view.setText(1, "Centring done !")
             log.info("Centring saved")
         finally:
@@ -947,27 +947,91 @@ class Acquisition(object):
         :returns: The full paths.
         :rtype: str
         """
-        paths = []
+        return ImageFileSequence(self.path_template.get_archive_directory(),
+                                 self.path_template.get_image_file_name(\
+                                     suffix='thumb.jpeg'),
+                                 self.acquisition_parameters.first_image,
+                                 self.acquisition_parameters.num_images)
 
-        for i in range(self.acquisition_parameters.first_image,
-                       self.acquisition_parameters.num_images + \
-                       self.acquisition_parameters.first_image):
 
-            path = os.path.join(self.path_template.get_archive_directory(),
-                                self.path_template.get_image_file_name(\
-                                    suffix='thumb.jpeg') % i)
+class ImageFileSequence(object):
+    """
+    Paths of a range of image files, made on demand: behaves like a
+    read-only list of the <count> paths, from image number <start>.
+    """
+    def __init__(self, directory, file_name_template, start, count):
+        self.directory = directory
+        self.file_name_template = file_name_template
+        self.start = start
+        self.count = max(count, 0)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in xrange(self.start, self.start + self.count):
+            yield os.path.join(self.directory, self.file_name_template % i)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("image file index out of range")
+        return os.path.join(self.directory,
+                            self.file_name_template % (self.start + index))
+
+    def __contains__(self, path):
+        directory, file_name = os.path.split(path)
+        if os.path.normpath(directory) != os.path.normpath(self.directory):
+            return False
+        # the image number is the only varying part of the names
+        prefix = self.file_name_template.partition("%")[0]
+        if not file_name.startswith(prefix):
+            return False
+        try:
+            number = int(file_name[len(prefix):].split(".")[0])
+        except ValueError:
+            return False
+        return self.start <= number < self.start + self.count and \
+               self.file_name_template % number == file_name
+
+    def __eq__(self, other):
+        return list(self) == list(other)
 
-            paths.append(path)
+    def __ne__(self, other):
+        return not self == other
 
-        return paths
+    def __repr__(self):
+        return repr(list(self))
 
 
 class PathTemplate(object):
+    # Attributes the file names depend on. The QueueModel indexes the
+    # file ranges of the path templates of the model, index_changes
+    # counts the changes of these attributes on indexed path templates.
+    INDEXED_ATTRIBUTES = frozenset(("directory", "base_prefix", "mad_prefix",
+                                    "reference_image_prefix", "wedge_prefix",
+                                    "run_number", "start_num", "num_files"))
+    index_changes = 0
+
     @staticmethod
     def set_archive_path(archive_base_directory, archive_folder):
         PathTemplate.archive_base_directory = archive_base_directory
         PathTemplate.archive_folder = archive_folder
 
+    def __setattr__(self, name, value):
+        if name in PathTemplate.INDEXED_ATTRIBUTES and self.__dict__.get("_indexed"):
+            PathTemplate.index_changes += 1
+        object.__setattr__(self, name, value)
+
+    def __getstate__(self):
+        # copies are not indexed
+        state = self.__dict__.copy()
+        state.pop("_indexed", None)
+        return state
+
     def __init__(self):
         object.__init__(self)
 
@@ -1044,16 +1108,16 @@ class PathTemplate(object):
         return archive_directory
 
     def get_files_to_be_written(self):
-        file_locations = []
-        file_name_template = self.get_image_file_name()
-
-        for i in range(self.start_num,
-                       self.start_num + self.num_files):
-
-            file_locations.append(os.path.join(self.directory,
-                                               file_name_template % i))
+        return ImageFileSequence(self.directory, self.get_image_file_name(),
+                                 self.start_num, self.num_files)
 
-        return file_locations
+    def get_key(self):
+        """
+        :returns: The (directory, prefix) of the files, path templates
+                  with the same key are equal.
+        :rtype: tuple
+        """
+        return (os.path.normpath(self.directory), self.get_prefix())
 
     def __eq__(self, path_template):
         result = False
@@ -1070,12 +1134,14 @@ class PathTemplate(object):
         result = False
 
         #Only do the intersection if there is possibilty for
-        #Collision, that is directories are the same.
-        if (self == rh_pt) and (self.run_number == rh_pt.run_number):
-            if self.start_num < (rh_pt.start_num + rh_pt.num_files) and \
-               rh_pt.start_num < (self.start_num + self.num_files):
-
-               result = True
+        #Collision, that is same run, overlapping images and same
+        #directories (compared last, the most expensive).
+        if self.run_number == rh_pt.run_number and \
+           self.start_num < (rh_pt.start_num + rh_pt.num_files) and \
+           rh_pt.start_num < (self.start_num + self.num_files):
+
+            if self == rh_pt:
+                result = True
     
         return result
 
@@ -6,6 +6,7 @@ import time
 import logging
 import os
 import tempfile
+import motor_wait
 
 try:
   import lucid
@@ -86,32 +87,25 @@ def ready(*motors):
   return not any([m.motorIsMoving() for m in motors])
 
 def move_motors(motor_positions_dict):
-  #import pdb; pdb.set_trace()
-  def wait_ready(timeout=None):
-    with gevent.Timeout(timeout):
-      while not ready(*motor_positions_dict.keys()):
-        time.sleep(0.1)
-        
-  def wait_moving(timeout=None):
-      with gevent.Timeout(timeout):
-          while ready(*motor_positions_dict.keys()):
-              time.sleep(0.1)
-
-  wait_ready(timeout=30)
-
-  if not ready(*motor_positions_dict.keys()):
-    raise RuntimeError("Motors not ready")
-
-  for motor, position in motor_positions_dict.iteritems():
-    motor.move(position)
-
-  try:
-     wait_moving(timeout=0.1) # waits first that at least the movement has started. 
-                   # To cope with MD2 delay in state reporting
-  except gevent.timeout.Timeout:
-     pass
+  with motor_wait.MotorGroup(motor_positions_dict.keys()) as motors:
+    motors.wait_ready(timeout=30)
+
+    if not motors.ready():
+      raise RuntimeError("Motors not ready")
+
+    # the state changes of the wait above are not movement starts
+    motors.mark()
+    moving = []
+    for motor, position in motor_positions_dict.iteritems():
+      if motor_wait.needs_move(motor, position):
+        moving.append(motor)
+      motor.move(position)
+
+    # waits first that at least the movement has started. 
+    # To cope with MD2 delay in state reporting
+    motors.wait_started(moving, timeout=0.1)
   
-  wait_ready()
+    motors.wait_ready()
 
 def user_click(x,y, wait=False):
   READY_FOR_NEXT_POINT.clear()
@@ -218,7 +212,11 @@ def start_auto(camera,  centring_motors_dict,
 
 def find_loop(camera, pixelsPerMm_Hor, chi_angle, msg_cb, new_point_cb):
   snapshot_filename = os.path.join(tempfile.gettempdir(), "mxcube_sample_snapshot.png")
-  camera.takeSnapshot(snapshot_filename, bw=True)
+  if hasattr(camera, "get_frame_hub"):
+    # image of the shared video buffers, taken after the last move
+    camera.get_frame(new_frame=True).qimage().save(snapshot_filename, "PNG")
+  else:
+    camera.takeSnapshot(snapshot_filename, bw=True)
 
   info, x, y = lucid.find_loop(snapshot_filename, debug=False,pixels_per_mm_horizontal=pixelsPerMm_Hor, chi_angle=chi_angle)
   
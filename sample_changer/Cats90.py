@@ -99,6 +99,14 @@ class Cats90(SampleChanger):
         if self._lidStatus is not None:
             self._lidStatus.connectSignal("update", self._updateOperationMode)
 
+        # update the sample changer information when these channels change,
+        # instead of polling the device server
+        self._setUpdateChannels(self._chnState, self._chnPowered, self._chnNumLoadedSample,
+                                self._chnLidLoadedSample, self._chnSampleBarcode, self._chnPathRunning,
+                                self._chnSampleIsDetected,
+                                *[getattr(self, "_chnBasket%dState" % (basket_index + 1)) \
+                                  for basket_index in range(Cats90.NO_OF_BASKETS)])
+
         self._initSCContents()
 
         # SampleChanger.init must be called _after_ initialization of the Cats because it starts the update methods which access
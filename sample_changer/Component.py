@@ -125,6 +125,7 @@ class Component(object):
         changed=False
         if self.id!=None:
             self.id=None
+            self._idChanged()
             changed=True  
         if self.present:
             self.present=False
@@ -139,6 +140,7 @@ class Component(object):
         changed=False
         if self.id!=id:
             self.id=id
+            self._idChanged()
             changed=True      
         if self.id:
             present=True
@@ -161,6 +163,11 @@ class Component(object):
         self.selected=selected
         
         
+    def _idChanged(self):
+        container=self.getContainer()
+        if container is not None:
+            container._invalidateIdIndex()
+
     def _isDirty(self):
         return self.dirty
         
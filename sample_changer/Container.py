@@ -9,6 +9,7 @@ class Container(Component):
         super(Container, self).__init__(container, address, scannable)
         self.type = type
         self.components = []     
+        self._resetIndexes()
     
     
     #########################           PUBLIC           #########################
@@ -43,13 +44,7 @@ class Container(Component):
         Returns the list of all Sample objects under of this container (recursivelly)
         :rtype: list 
         """        
-        samples=[]
-        for c in self.getComponents():
-            if isinstance(c,Sample):
-                samples.append(c)
-            else:
-                samples.extend(c.getSampleList())
-        return samples
+        return list(self._getSampleList())
 
     def getPresentSamples(self):
         """
@@ -57,16 +52,17 @@ class Container(Component):
         :rtype: list 
         """        
         ret = []
-        for sample in self.getSampleList():
+        for sample in self._getSampleList():
             if sample.isPresent():
                 ret.append(sample)
+        return ret
 
     def isEmpty(self):
         """
         Returns true if there is no sample present sample under this container
         :rtype: bool 
         """        
-        for s in self.getSampleList():
+        for s in self._getSampleList():
             if s.isPresent():
                 return False
         return True
@@ -76,14 +72,7 @@ class Container(Component):
         Returns a component through its slot address or None if address is invalid
         :rtype: Component 
         """        
-        for c in self.getComponents():
-            if c.getAddress() == address:
-                return c            
-            if isinstance(c,Container):
-                aux=c.getComponentByAddress(address)
-                if aux is not None:
-                    return aux
-        return None
+        return self._getAddressIndex().get(address)
 
     def hasComponentAddress(self, address):
         """
@@ -97,14 +86,7 @@ class Container(Component):
         Returns a component through its id or None if id is invalid
         :rtype: Component 
         """        
-        for c in self.getComponents():
-            if c.getID() == id:
-                return c            
-            if  isinstance(c,Container):
-                aux=c.getComponentById(id)
-                if aux is not None:
-                    return aux
-        return None
+        return self._getIdIndex().get(id)
 
 
     def hasComponentId(self, id):
@@ -115,7 +97,7 @@ class Container(Component):
         return self.getComponentById(id) is not None
     
     def getSelectedSample(self):
-        for s in self.getSampleList():
+        for s in self._getSampleList():
             if s.isSelected():
                 return s
         return None
@@ -135,12 +117,71 @@ class Container(Component):
     
     def _addComponent(self, c):
         self.components.append(c)
+        self._invalidateIndexes()
 
     def _removeComponent(self, c):
         self.components.remove(c)
+        self._invalidateIndexes()
 
     def _clearComponents(self):
         self.components = []     
+        self._invalidateIndexes()
+
+    def _resetIndexes(self):
+        self._address_index = None
+        self._id_index = None
+        self._sample_list = None
+
+    def _invalidateIndexes(self):
+        """
+        Drops the lookup indexes of this container and of its parents,
+        they are rebuilt on the next lookup
+        """
+        container = self
+        while container is not None:
+            container._resetIndexes()
+            container = container.getContainer()
+
+    def _invalidateIdIndex(self):
+        # an invalid index implies invalid parent indexes
+        container = self
+        while container is not None and container._id_index is not None:
+            container._id_index = None
+            container = container.getContainer()
+
+    def _buildIndex(self, key, child_index):
+        # first match in depth-first order, as a recursive search would find
+        index = {}
+        for c in self.getComponents():
+            index.setdefault(key(c), c)
+            if isinstance(c,Container):
+                for k, v in child_index(c).iteritems():
+                    index.setdefault(k, v)
+        return index
+
+    def _getAddressIndex(self):
+        if self._address_index is None:
+            self._address_index = self._buildIndex(lambda c: c.getAddress(), lambda c: c._getAddressIndex())
+        return self._address_index
+
+    def _getIdIndex(self):
+        if self._id_index is None:
+            self._id_index = self._buildIndex(lambda c: c.getID(), lambda c: c._getIdIndex())
+        return self._id_index
+
+    def _getSampleList(self):
+        """
+        Returns the cached list of samples, not to be modified
+        """
+        if self._sample_list is None:
+            samples=[]
+            for c in self.getComponents():
+                if isinstance(c,Sample):
+                    samples.append(c)
+                else:
+                    samples.extend(c._getSampleList())
+            self._sample_list = samples
+        return self._sample_list
 
     def _resetDirty(self):
         Component._resetDirty(self)
@@ -148,7 +189,7 @@ class Container(Component):
             c._resetDirty()  
 
     def _setSelectedSample(self,sample):
-        for s in self.getSampleList():
+        for s in self._getSampleList():
             if s==sample:
                 s._setSelected(True)
             else:
@@ -167,4 +208,43 @@ class Container(Component):
             for c in self.getComponents():
                 c._setSelected(False)        
         Component._setSelected(self, selected)
-        
+
+
+if __name__ == "__main__":
+    # lookups in a synthetic 30 pucks x 16 pins dewar
+    import time
+
+    def find_by_address(container, address):
+        # former recursive search
+        for c in container.getComponents():
+            if c.getAddress() == address:
+                return c
+            if isinstance(c,Container):
+                aux=find_by_address(c, address)
+                if aux is not None:
+                    return aux
+        return None
+
+    dewar = Container("Dewar", None, "dewar", False)
+    for i in range(1, 31):
+        puck = Container("Puck", dewar, "%d" % i, True)
+        dewar._addComponent(puck)
+        for j in range(1, 17):
+            pin = Sample(puck, "%d:%02d" % (i, j), True)
+            puck._addComponent(pin)
+            pin._setInfo(True, "PIN%d_%d" % (i, j), True)
+
+    addresses = [s.getAddress() for s in dewar.getSampleList()]
+    n = 10
+
+    def timeit(msg, fun):
+        t0 = time.time()
+        for k in range(n):
+            fun()
+        print "%-40s %8.3f ms" % (msg, (time.time()-t0)/n*1E3)
+
+    timeit("recursive search of every address", lambda: [find_by_address(dewar, a) for a in addresses])
+    timeit("indexed search of every address", lambda: [dewar.getComponentByAddress(a) for a in addresses])
+    timeit("indexed search of every ID", lambda: [dewar.getComponentById("PIN%d_%d" % (1+k//16, 1+k%16)) for k in range(480)])
+    timeit("getSampleList x 480", lambda: [dewar.getSampleList() for a in addresses])
+    timeit("ID change + lookup x 480 (index rebuilt)", lambda: [(s._setInfo(True, s.getID()[::-1], True), dewar.getComponentById(s.getID())) for s in dewar.getSampleList()])
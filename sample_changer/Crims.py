@@ -1,24 +1,374 @@
+"""
+CRIMS (crystallization database) client: processing plans and crystal
+images of the plates.
+
+The requests go through a CrimsClient, which
+- keeps the downloaded images in a bounded LRU cache, in memory and, if
+  a <cache_dir> is configured, on disk (images do not change for a given
+  barcode/inspection/well), and the processing plans in memory for
+  <plan_ttl> seconds,
+- reuses at most <max_connections> HTTP connections per server,
+- prefetches, in parallel, the drop images of a plate once its
+  processing plan is parsed.
+
+The module functions use the default client, see configure(). The URLs
+are templates, so that the client can be pointed to a local server.
+"""
+
+import os
 import time
-import urllib
+import errno
+import socket
+import hashlib
+import httplib
+import logging
+import urlparse
+import collections
+import gevent
+import gevent.event
+import gevent.queue
+
+IMAGE_URL = "https://embl.fr/htxlab/index.php?option=com_getbarcodextalinfos&task=getImage&format=raw&barcode=%(barcode)s&inspection=%(inspection)d&row=%(row)s&column=%(col)d&shelf=%(shelf)d"
+#PLAN_URL = "https://embl.fr/htxlab/index.php?option=com_getbarcodextalinfos&task=getBarcodeXtalInfos&barcode=%(barcode)s"
+#Crims V3
+PLAN_URL = "https://embl.fr/htxlabj3/index.php?option=com_getbarcodextalinfos&task=getBarcodeXtalInfos&format=xml&barcode=%(barcode)s"
+
+
+class LRUCache(object):
+    """
+    Least recently used items, in memory (at most <max_items>) and, if
+    <directory> is given, on disk (at most <max_bytes> in total). The
+    directory is created, and the files written, readable by the owner
+    only.
+    """
+    def __init__(self, max_items=256, directory=None, max_bytes=256*1024*1024):
+        self.max_items = max_items
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._items = collections.OrderedDict()
+        self._files = collections.OrderedDict()
+        self._files_bytes = 0
+
+        if directory:
+            self._load_directory()
+
+
+    def _load_directory(self):
+        try:
+            os.makedirs(self.directory, 0700)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        files = []
+        for name in os.listdir(self.directory):
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, name, st.st_size))
+        for mtime, name, size in sorted(files):
+            self._files[name] = size
+            self._files_bytes += size
+        self._evict_files()
+
+
+    def _filename(self, key):
+        return hashlib.sha1(key).hexdigest()
+
+
+    def get(self, key):
+        data = self._items.pop(key, None)
+        if data is not None:
+            self._items[key] = data
+            return data
+
+        if self.directory:
+            name = self._filename(key)
+            if name in self._files:
+                path = os.path.join(self.directory, name)
+                try:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                    os.utime(path, None)
+                except (IOError, OSError):
+                    self._remove_file(name)
+                    return None
+                self._files[name] = self._files.pop(name)
+                self._put_item(key, data)
+                return data
+
+        return None
+
+
+    def put(self, key, data):
+        self._put_item(key, data)
+
+        if self.directory:
+            name = self._filename(key)
+            try:
+                with os.fdopen(os.open(os.path.join(self.directory, name),
+                                       os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), "wb") as f:
+                    f.write(data)
+            except (IOError, OSError):
+                logging.getLogger("HWR").exception("Could not write CRIMS cache file")
+                return
+            self._files_bytes -= self._files.pop(name, 0)
+            self._files[name] = len(data)
+            self._files_bytes += len(data)
+            self._evict_files()
+
+
+    def _put_item(self, key, data):
+        self._items.pop(key, None)
+        self._items[key] = data
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+
+    def _remove_file(self, name):
+        self._files_bytes -= self._files.pop(name, 0)
+        try:
+            os.unlink(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+
+    def _evict_files(self):
+        while self._files_bytes > self.max_bytes and self._files:
+            self._remove_file(next(iter(self._files)))
+
+
+    def __contains__(self, key):
+        return key in self._items or \
+            (self.directory is not None and self._filename(key) in self._files)
+
+
+    def clear(self):
+        self._items.clear()
+        if self.directory:
+            for name in self._files.keys():
+                self._remove_file(name)
+
+
+class ConnectionPool(object):
+    """
+    At most <max_connections> HTTP(S) connections per server, kept open
+    between the requests.
+    """
+    def __init__(self, max_connections=4, timeout=10):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._slots = {}
+
+
+    def request(self, url):
+        """
+        GET <url>
+
+        :returns: the response body
+        :raises IOError: connection error or HTTP status other than 200
+        """
+        parts = urlparse.urlsplit(url)
+        server = (parts.scheme, parts.netloc)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        slots = self._slots.get(server)
+        if slots is None:
+            slots = self._slots[server] = gevent.queue.Queue()
+            for i in range(self.max_connections):
+                slots.put(None)
+
+        connection = slots.get()
+        try:
+            for attempt in (0, 1):
+                if connection is None:
+                    connection_class = httplib.HTTPSConnection if parts.scheme == "https" \
+                                       else httplib.HTTPConnection
+                    connection = connection_class(parts.netloc, timeout=self.timeout)
+                try:
+                    connection.request("GET", path)
+                    response = connection.getresponse()
+                    data = response.read()
+                except (httplib.HTTPException, socket.error), ex:
+                    # the server may have closed a kept connection
+                    connection.close()
+                    connection = None
+                    if attempt:
+                        raise IOError("could not get %s: %s" % (url, ex))
+                    continue
+                except:
+                    connection.close()
+                    connection = None
+                    raise
+                if response.will_close:
+                    connection.close()
+                    connection = None
+                if response.status != 200:
+                    raise IOError("could not get %s: HTTP %d %s" % (url, response.status, response.reason))
+                return data
+        finally:
+            slots.put(connection)
+
+
+    def close(self):
+        for slots in self._slots.itervalues():
+            while not slots.empty():
+                connection = slots.get_nowait()
+                if connection is not None:
+                    connection.close()
+        self._slots.clear()
+
+
+class CrimsClient(object):
+    def __init__(self, image_url=IMAGE_URL, plan_url=PLAN_URL, cache_dir=None,
+                 cache_items=256, cache_bytes=256*1024*1024, plan_ttl=60,
+                 max_connections=4, timeout=10, prefetch=True, force_https=True):
+        self.image_url = image_url
+        self.plan_url = plan_url
+        self.plan_ttl = plan_ttl
+        self.prefetch = prefetch
+        self.force_https = force_https
+        self.images = LRUCache(cache_items, cache_dir, cache_bytes)
+        self.pool = ConnectionPool(max_connections, timeout)
+        self._plans = {}
+        self._pending = {}
+
+
+    def getURL(self, url, cache=True):
+        """
+        Returns the data of <url>, from the cache if <cache>. A request
+        already in progress for <url> is waited for, not repeated.
+        """
+        if cache:
+            data = self.images.get(url)
+            if data is not None:
+                return data
+
+        pending = self._pending.get(url)
+        if pending is None:
+            pending = self._pending[url] = gevent.event.AsyncResult()
+            self._request(url, cache, pending)
+
+        return pending.get()
+
+
+    def _request(self, url, cache, pending):
+        try:
+            data = self.pool.request(url)
+        except Exception, ex:
+            pending.set_exception(ex)
+        else:
+            if cache:
+                self.images.put(url, data)
+            pending.set(data)
+        finally:
+            del self._pending[url]
+
+
+    def xtalImageURL(self, url):
+        """
+        Returns the URL of a crystal image given by the processing plan
+        """
+        if not url:
+            return None
+        if self.force_https and url.startswith("http://"):
+            url = "https://" + url[7:]
+        return url
+
+
+    def getImage(self, barcode, inspection, row, col, shelf):
+        return self.getURL(self.image_url % {"barcode": barcode,
+                                             "inspection": inspection,
+                                             "row": row,
+                                             "col": col,
+                                             "shelf": shelf})
+
+
+    def getProcessingPlanXML(self, barcode):
+        now = time.time()
+        plan = self._plans.get(barcode)
+        if plan is not None and now - plan[0] < self.plan_ttl:
+            return plan[1]
+        xml = self.getURL(self.plan_url % {"barcode": barcode}, cache=False)
+        self._plans[barcode] = (now, xml)
+        return xml
+
+
+    def getProcessingPlan(self, barcode):
+        try:
+            pp = parseProcessingPlan(self.getProcessingPlanXML(barcode))
+        except:
+            logging.getLogger("HWR").exception("Could not get the CRIMS processing plan of %s" % barcode)
+            return None
+        if self.prefetch:
+            self.prefetchImages(pp)
+        return pp
+
+
+    def prefetchImages(self, pp):
+        """
+        Downloads, in the background, the images of the crystals of the
+        processing plan <pp> not cached yet.
+
+        :returns: the greenlets
+        """
+        tasks = []
+        for xtal in pp.Plate.Xtal:
+            url = self.xtalImageURL(xtal.IMG_URL)
+            if url and url not in self.images and url not in self._pending:
+                pending = self._pending[url] = gevent.event.AsyncResult()
+                tasks.append(gevent.spawn(self._prefetch, url, pending))
+        return tasks
+
+
+    def _prefetch(self, url, pending):
+        self._request(url, True, pending)
+        if pending.exception is not None:
+            logging.getLogger("HWR").debug("Could not prefetch CRIMS image %s: %s" % (url, pending.exception))
+
+
+    def wait(self, timeout=None):
+        """
+        Waits for the requests in progress (prefetch included)
+        """
+        with gevent.Timeout(timeout, False):
+            for pending in self._pending.values():
+                pending.wait()
+
+
+    def clear(self):
+        self.images.clear()
+        self._plans.clear()
+
+
+_client = None
+
+def configure(**kwargs):
+    """
+    Replaces the default client by a CrimsClient(**kwargs)
+    """
+    global _client
+    if _client is not None:
+        _client.pool.close()
+    _client = CrimsClient(**kwargs)
+    return _client
+
+
+def getClient():
+    if _client is None:
+        # no disk cache unless configured
+        configure()
+    return _client
 
 
 def getImage(barcode, inspection,row, col, shelf):
     #print (barcode, inspection,row, col, shelf)
-    url = "https://embl.fr/htxlab/index.php?option=com_getbarcodextalinfos&task=getImage&format=raw&barcode=%s&inspection=%d&row=%s&column=%d&shelf=%d" %  (barcode, inspection,row, col, shelf)    
-    f = urllib.urlopen(url)           
-    img=f.read() 
-    return img
+    return getClient().getImage(barcode, inspection, row, col, shelf)
 
 def getProcessingPlanXML(barcode):
-    #url = "https://embl.fr/htxlab/index.php?option=com_getbarcodextalinfos&task=getBarcodeXtalInfos&barcode=%s" % barcode
-    #Crims V3
-    url = "https://embl.fr/htxlabj3/index.php?option=com_getbarcodextalinfos&task=getBarcodeXtalInfos&format=xml&barcode=%s" % barcode
-    #print "Opening URL: " + url
-    f = urllib.urlopen(url)        
-    #print "Reading: " + barcode
-    xml = f.read()  
-    #print "Received: " + xml
-    return xml
+    return getClient().getProcessingPlanXML(barcode)
 
 
 class Xtal:
@@ -38,27 +388,26 @@ class Xtal:
         self.IMG_URL=""
         self.ImageRotation=0.0
         self.SUMMARY_URL=""
-        
-        
+
+
     def getAddress(self):
         return "%s%02d-%d" % (self.Row,self.Column,self.Shelf)
 
+    def getImageURL(self):
+        return getClient().xtalImageURL(self.IMG_URL)
+
     def getImage(self):
-        if (len(self.IMG_URL)==0):
+        url = self.getImageURL()
+        if url is None:
             return None
-        if (self.IMG_URL.startswith("http://")):
-           self.IMG_URL = "https://" + self.IMG_URL[7];
-        #print "Fetching: " + self.IMG_URL
-        f = urllib.urlopen(self.IMG_URL)           
-        
-        img=f.read() 
-        return img
+        #print "Fetching: " + url
+        return getClient().getURL(url)
 
     def getSummaryURL(self):
         if (len(self.SUMMARY_URL)==0):
             return None
         return self.SUMMARY_URL
-        
+
 class Plate:
     def __init__(self, *args):
         self.Barcode=""
@@ -68,53 +417,137 @@ class Plate:
 class ProcessingPlan:
     def __init__(self, *args):
         self.Plate=Plate()
- 
+
+def parseProcessingPlan(sxml):
+    import xml.etree.cElementTree as et
+    tree=et.fromstring(sxml)
+
+    pp=ProcessingPlan()
+    plate = tree.findall("Plate")[0]
+
+    pp.Plate.Barcode = plate.find("Barcode").text
+    pp.Plate.PlateType = plate.find("PlateType").text
+
+    for x in plate.findall("Xtal"):
+        xtal=Xtal()
+        xtal.CrystalUUID=x.find("CrystalUUID").text
+        xtal.PinID=x.find("Label").text
+        xtal.Login=x.find("Login").text
+        xtal.Sample=x.find("Sample").text
+        xtal.Column=int(x.find("Column").text)
+        xtal.idSample=int(x.find("idSample").text)
+        xtal.idTrial=int(x.find("idTrial").text)
+        xtal.Row=x.find("Row").text
+        xtal.Shelf=int(x.find("Shelf").text)
+        xtal.Comments=x.find("Comments").text
+        xtal.offsetX=float(x.find("offsetX").text)
+        xtal.offsetY=float(x.find("offsetY").text)
+        xtal.IMG_URL=x.find("IMG_URL").text
+        xtal.ImageRotation=float(x.find("ImageRotation").text)
+        xtal.SUMMARY_URL=x.find("SUMMARY_URL").text
+        pp.Plate.Xtal.append(xtal)
+    return pp
+
 def getProcessingPlan(barcode):
-    try:    
-        sxml = getProcessingPlanXML(barcode)
- 
-        import xml.etree.cElementTree as et
-        tree=et.fromstring(sxml)
-
-        pp=ProcessingPlan()
-        plate = tree.findall("Plate")[0]
-
-        pp.Plate.Barcode = plate.find("Barcode").text
-        pp.Plate.PlateType = plate.find("PlateType").text
-
-        for x in plate.findall("Xtal"):
-            xtal=Xtal()
-            xtal.CrystalUUID=x.find("CrystalUUID").text
-            xtal.PinID=x.find("Label").text
-            xtal.Login=x.find("Login").text
-            xtal.Sample=x.find("Sample").text
-            xtal.Column=int(x.find("Column").text)
-            xtal.idSample=int(x.find("idSample").text)
-            xtal.idTrial=int(x.find("idTrial").text)
-            xtal.Row=x.find("Row").text
-            xtal.Shelf=int(x.find("Shelf").text)
-            xtal.Comments=x.find("Comments").text
-            xtal.offsetX=float(x.find("offsetX").text)
-            xtal.offsetY=float(x.find("offsetY").text)
-            xtal.IMG_URL=x.find("IMG_URL").text
-            xtal.ImageRotation=float(x.find("ImageRotation").text)
-            xtal.SUMMARY_URL=x.find("SUMMARY_URL").text
-            pp.Plate.Xtal.append(xtal)
-        return pp
-    except:
-        return None
+    return getClient().getProcessingPlan(barcode)
+
+
+def _serve_mock_plate(nxtals=96, delay=0.05):
+    """
+    Local stand-in of the CRIMS server: a plate of <nxtals> crystals,
+    each request answered after <delay> seconds. The server runs in a
+    thread of its own, it does not need the monkey patching of gevent.
 
+    :returns: (server, base URL)
+    """
+    import threading
+    import BaseHTTPServer
+    import SocketServer
 
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            time.sleep(delay)
+            query = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+            if query.get("task") == ["getBarcodeXtalInfos"]:
+                xtals = ""
+                for i in range(nxtals):
+                    xtals += ("<Xtal><CrystalUUID>%d</CrystalUUID><Label>X%d</Label><Login>mx</Login>"
+                              "<Sample>s%d</Sample><Column>%d</Column><idSample>%d</idSample>"
+                              "<idTrial>1</idTrial><Row>%s</Row><Shelf>1</Shelf><Comments></Comments>"
+                              "<offsetX>0.5</offsetX><offsetY>0.5</offsetY>"
+                              "<IMG_URL>%s?task=getImage&amp;xtal=%d</IMG_URL>"
+                              "<ImageRotation>0</ImageRotation><SUMMARY_URL></SUMMARY_URL></Xtal>") % \
+                             (i, i, i, i % 12 + 1, i, "ABCDEFGH"[i / 12 % 8], base_url, i)
+                body = "<ProcessingPlan><Plate><Barcode>%s</Barcode><PlateType>Greiner</PlateType>%s</Plate></ProcessingPlan>" % \
+                       (query["barcode"][0], xtals)
+            else:
+                body = "JPEG" * 10000
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(("127.0.0.1", 0), Handler)
+    base_url = "http://127.0.0.1:%d/" % server.server_address[1]
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    return server, base_url
 
 
 if __name__ == "__main__":
-    pp= getProcessingPlan("JZ005209")
-    img=getImage("JZ005209",1,'C',12,1)
-    print pp
-    print pp.Plate
-    
-    
-        
-        
-    
-        
+    import sys
+    from gevent import monkey
+    monkey.patch_all()
+
+    if len(sys.argv) > 1 and sys.argv[1] != "--local":
+        pp= getProcessingPlan(sys.argv[1])
+        print pp
+        print pp.Plate
+        sys.exit(0)
+
+    # browsing the images of a plate served by a local stand-in: one
+    # connection per image as before, against the client (prefetch, then
+    # browsing twice)
+    import urllib
+    import shutil
+    import tempfile
+
+    server, base_url = _serve_mock_plate()
+    plan_url = base_url + "?task=getBarcodeXtalInfos&barcode=%(barcode)s"
+    cache_dir = tempfile.mkdtemp()
+
+    t0 = time.time()
+    pp = parseProcessingPlan(urllib.urlopen(plan_url % {"barcode": "MOCK0001"}).read())
+    for browse in range(2):
+        for xtal in pp.Plate.Xtal:
+            urllib.urlopen(xtal.IMG_URL).read()
+    t1 = time.time()
+
+    client = configure(plan_url=plan_url, cache_dir=cache_dir, force_https=False)
+    pp = getProcessingPlan("MOCK0001")
+    client.wait()
+    t2 = time.time()
+    for browse in range(2):
+        for xtal in pp.Plate.Xtal:
+            xtal.getImage()
+    t3 = time.time()
+
+    # new client, images from the disk cache
+    client = configure(plan_url=plan_url, cache_dir=cache_dir, cache_items=0, force_https=False)
+    for xtal in pp.Plate.Xtal:
+        assert xtal.getImage() == "JPEG" * 10000
+    t4 = time.time()
+
+    server.shutdown()
+    shutil.rmtree(cache_dir)
+    print "%d crystals, browsed twice: %.2f s before, %.2f s with the client (prefetch %.2f s), disk cache %.3f s" % \
+          (len(pp.Plate.Xtal), t1 - t0, t3 - t1, t2 - t1, t4 - t3)
@@ -7,6 +7,7 @@ import abc
 import logging
 import time
 import gevent
+import gevent.event
 import types
 
 class SampleChangerState:
@@ -92,9 +93,10 @@ class SampleChanger(Container,Equipment):
         self._transient=False
         self._token=None
         self._timer_update_inverval = 5 # defines the interval in periods of 100 ms
-        self._timer_update_counter = 0            
-        task1s=self.__timer_1s_task(wait=False)
-        task1s.link(self._onTimer1sExit)
+        self._timer_update_max_inverval = 100 # longest interval without update (adaptive polling)
+        self._update_event = gevent.event.Event()
+        self._update_channels = []
+        self._last_update = 0
         updateTask=self.__update_timer_task(wait=False)
         updateTask.link(self._onTimerUpdateExit)
         
@@ -102,43 +104,78 @@ class SampleChanger(Container,Equipment):
         self.updateInfo()
         
         
-    def _onTimer1sExit(self, task):
-        logging.warning("Exiting Sample Changer 1s timer task")
-        
     def _onTimerUpdateExit(self, task):
         logging.warning("Exiting Sample Changer update timer task")
         
-        
-    @task
-    def __timer_1s_task(self, *args):
-        while(True):
-            gevent.sleep(1.0)
-            try:
-                if self.isEnabled():
-                    self._onTimer1s()
-            except:
-                pass                
              
     @task
     def __update_timer_task(self, *args):
+        """
+        Calls _onTimerUpdate every _timer_update_inverval periods of 100 ms,
+        or as soon as one of the update channels changes (but not more often
+        than the interval). When nothing changes the interval grows up to
+        _timer_update_max_inverval, or is kept there if the update channels
+        signal the changes. Also calls _onTimer1s if overridden.
+        """
+        has_timer_1s = self._onTimer1s.im_func is not SampleChanger._onTimer1s.im_func
+        interval = self._timer_update_inverval
+        next_1s = time.time() + 1.0
+        next_update = time.time() + interval * 0.1
+
         while(True):
-            gevent.sleep(0.1)
+            wakeup = min(next_update, next_1s) if has_timer_1s else next_update
+            self._update_event.wait(max(0, wakeup - time.time()))
             try:
-                if self.isEnabled():
-                    self._timer_update_counter += 1
-                    if (self._timer_update_counter >= self._timer_update_counter):
-                        self._onTimerUpdate()
-                        self._timer_update_counter = 0
+                now = time.time()
+                if has_timer_1s and now >= next_1s:
+                    next_1s = now + 1.0
+                    if self.isEnabled():
+                        self._onTimer1s()
+
+                if self._update_event.is_set() or now >= next_update:
+                    min_period = self._timer_update_inverval * 0.1
+                    if now < self._last_update + min_period:
+                        gevent.sleep(self._last_update + min_period - now)
+                    self._update_event.clear()
+
+                    changed = True
+                    if self.isEnabled():
+                        self._last_update = time.time()
+                        changed = self._onTimerUpdate() is not False
+
+                    if self.isExecutingTask():
+                        interval = self._timer_update_inverval
+                    elif self._update_channels:
+                        interval = self._timer_update_max_inverval
+                    elif changed:
+                        interval = self._timer_update_inverval
+                    else:
+                        interval = min(2 * interval, self._timer_update_max_inverval)
+                    next_update = time.time() + interval * 0.1
             except:
                 pass                
 
+    def _setUpdateChannels(self, *channels):
+        """
+        Registers the channels whose 'update' signal triggers an update of
+        the sample changer information, instead of periodic polling
+        """
+        for channel in channels:
+            if channel is not None and channel not in self._update_channels:
+                channel.connectSignal("update", self._onChannelUpdate)
+                self._update_channels.append(channel)
+
+    def _onChannelUpdate(self, *args):
+        self._update_event.set()
+
 #########################           TIMER           #########################
     def _setTimerUpdateInterval(self,value):
         self._timer_update_inverval=value
+        self._update_event.set()
     
     def _onTimerUpdate(self):        
         #if not self.isExecutingTask():
-            self.updateInfo()  
+            return self.updateInfo()  
              
     def _onTimer1s(self):
         pass        
@@ -243,7 +280,7 @@ class SampleChanger(Container,Equipment):
         Returns current loaded sample
         :rtype: str
         """           
-        for s in self.getSampleList():
+        for s in self._getSampleList():
             if s.isLoaded():
                 return s            
         return None
@@ -279,18 +316,23 @@ class SampleChanger(Container,Equipment):
 
     def updateInfo(self):
         """
+        Returns True if the state or the information changed
         """
         former_loaded = self.getLoadedSample()
+        former_state = (self.state, self.status)
         self._doUpdateInfo()        
-        if self._isDirty():
+        changed = self._isDirty()
+        if changed:
             self._triggerInfoChangedEvent()
         
         loaded=self.getLoadedSample()
         if loaded != former_loaded:
+            changed = True
             if (loaded is None) or (former_loaded is None) or (loaded.getAddress()!=former_loaded.getAddress()):
                 self._triggerLoadedSampleChangedEvent(loaded)
                 
         self._resetDirty()                    
+        return changed or former_state != (self.state, self.status)
 
     
     def isTransient(self):
@@ -534,12 +576,12 @@ class SampleChanger(Container,Equipment):
                 self._triggerStatusChangedEvent()        
         
     def _resetLoadedSample(self):
-        for s in self.getSampleList():
+        for s in self._getSampleList():
             s._setLoaded(False)
         self._triggerLoadedSampleChangedEvent(None)
 
     def _setLoadedSample(self, sample):
-        for s in self.getSampleList():
+        for s in self._getSampleList():
             if s != sample:
                 s._setLoaded(False)
             else:
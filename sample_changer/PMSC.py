@@ -38,6 +38,13 @@ class Xtal(Sample):
     def getCell(self):
         return self.getDrop().getCell()
 
+    def getImage(self):
+        client = Crims.getClient()
+        url = client.xtalImageURL(self.getImageURL())
+        if url is None:
+            return None
+        return client.getURL(url)
+
     @staticmethod
     def _getXtalAddress(well, index):
         return str(well.getAddress()) + "-" + str(index)    
@@ -116,6 +123,11 @@ class PMSC(SampleChanger):
         else:
             self._image = self.addChannel({"type":self.channel_type, "name":self.channel_image ,"timeout":5}, self.channel_image)
         SampleChanger.init(self)   
+
+        # images cached in memory only if no (private) directory is configured
+        cache_dir = self.getProperty("crims_cache_dir")
+        cache_size = self.getProperty("crims_cache_size") or 256
+        Crims.configure(cache_dir=cache_dir, cache_bytes=int(cache_size)*1024*1024)
                 
         #self.setToken("JZ005320")
         #self.scan()    
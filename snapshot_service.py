@@ -0,0 +1,257 @@
+"""
+Crystal snapshots encoding and persistence.
+
+- encode_snapshot(drawing) gives the JPEG data of the sample view with
+  its drawings, encoded in memory. The first snapshot with drawings is
+  also saved by QubImageSave (temporary file written and read back) and
+  both images are compared: if the drawings are not rendered the same
+  way, or if the in-memory encoding fails, QubImageSave is used,
+- the snapshots are written to the archive directory by a
+  SnapshotWriter: write() returns the file name right away and the file
+  is written by the gevent thread pool, in parallel with the other
+  snapshots and with the data collection. join() waits for the pending
+  writes, failed() tells if a file could not be written (or is not
+  written yet): LIMS gets the paths at once, and the paths of the files
+  that could not be written are cleared afterwards.
+
+Usage:
+
+    writer = get_writer()
+    path = writer.write("/data/.../snapshot.jpeg", encode_snapshot(drawing))
+    ...
+    writer.join(timeout=10)
+    if not writer.failed(path):
+        ...
+"""
+
+import os
+import errno
+import logging
+import tempfile
+import gevent
+
+
+def _to_jpeg(pixmap, canvas, zoom, quality=-1):
+    import qt
+    if canvas is not None:
+        # same rendering as QubImageSave: the visible canvas items are
+        # drawn on a copy of the image, scaled to the image size
+        pixmap = qt.QPixmap(pixmap)
+        painter = qt.QPainter()
+        painter.begin(pixmap)
+        try:
+            painter.setWorldMatrix(qt.QWMatrix(1.0 / zoom, 0, 0, 1.0 / zoom, 0, 0))
+            for item in canvas.allItems():
+                if item.isVisible():
+                    item.draw(painter)
+        finally:
+            painter.end()
+    buf = qt.QBuffer()
+    buf.open(qt.IO_WriteOnly)
+    if not pixmap.save(buf, "JPEG", quality):
+        raise RuntimeError("could not encode the snapshot")
+    buf.close()
+    return str(buf.buffer())
+
+
+def _to_jpeg_file(pixmap, canvas, zoom):
+    from Qub.Tools import QubImageSave
+    fd, name = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        QubImageSave.save(name, pixmap, canvas, zoom, "JPEG")
+        f = open(name, "r")
+        try:
+            return f.read()
+        finally:
+            f.close()
+    finally:
+        os.unlink(name)
+
+
+def _same_image(jpeg_data, reference_data, tolerance=48):
+    """
+    Compares two JPEG images pixel by pixel: True if they have the same
+    size and at most 1 pixel in 10000 with a color component differing
+    by more than <tolerance> (JPEG encoding differences)
+    """
+    if jpeg_data == reference_data:
+        return True
+    import qt
+    image, reference = qt.QImage(), qt.QImage()
+    if not (image.loadFromData(jpeg_data, "JPEG") and reference.loadFromData(reference_data, "JPEG")):
+        return False
+    width, height = image.width(), image.height()
+    if (width, height) != (reference.width(), reference.height()):
+        return False
+    different = 0
+    for y in xrange(height):
+        for x in xrange(width):
+            pixel, reference_pixel = image.pixel(x, y), reference.pixel(x, y)
+            if pixel != reference_pixel and \
+                   max(abs(qt.qRed(pixel) - qt.qRed(reference_pixel)),
+                       abs(qt.qGreen(pixel) - qt.qGreen(reference_pixel)),
+                       abs(qt.qBlue(pixel) - qt.qBlue(reference_pixel))) > tolerance:
+                different += 1
+    return different <= width * height / 10000
+
+
+# None until the in-memory rendering of the drawings was compared with
+# QubImageSave, then the result of the comparison
+_in_memory_rendering_ok = None
+
+def encode_snapshot(drawing):
+    """
+    Returns the JPEG data of the image displayed by <drawing> (Qub
+    drawing manager), with its drawings
+    """
+    global _in_memory_rendering_ok
+
+    matrix = drawing.matrix()
+    zoom = 1
+    if matrix is not None:
+        zoom = matrix.m11()
+    pixmap = drawing.getPPP()
+    canvas = drawing.canvas()
+
+    drawings = canvas is not None and \
+               len([item for item in canvas.allItems() if item.isVisible()]) > 0
+    if drawings and _in_memory_rendering_ok is False:
+        return _to_jpeg_file(pixmap, canvas, zoom)
+
+    try:
+        jpeg_data = _to_jpeg(pixmap, canvas, zoom)
+    except:
+        logging.getLogger("HWR").debug("in-memory snapshot encoding failed, using a temporary file",
+                                       exc_info=True)
+        return _to_jpeg_file(pixmap, canvas, zoom)
+
+    if drawings and _in_memory_rendering_ok is None:
+        reference_data = _to_jpeg_file(pixmap, canvas, zoom)
+        _in_memory_rendering_ok = _same_image(jpeg_data, reference_data)
+        if not _in_memory_rendering_ok:
+            logging.getLogger("HWR").warning("in-memory snapshot rendering differs from QubImageSave, " + \
+                                             "using QubImageSave")
+            return reference_data
+
+    return jpeg_data
+
+
+def _write_file(filename, data):
+    directory = os.path.dirname(filename)
+    if directory:
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    f = open(filename, "wb")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+
+class SnapshotWriter(object):
+    def __init__(self):
+        self._pending = {}
+        self._failed = set()
+        self.errors = 0
+
+
+    def write(self, filename, data):
+        """
+        Writes <data> to <filename> (creating its directory) in a worker
+        thread.
+
+        :returns: <filename>
+        """
+        self._failed.discard(filename)
+        async_result = gevent.get_hub().threadpool.spawn(_write_file, filename, str(data))
+        self._pending[async_result] = filename
+        async_result.rawlink(self._done)
+        return filename
+
+
+    def _done(self, async_result):
+        # called by join() too, before the link callback
+        filename = self._pending.pop(async_result, None)
+        if filename is not None and not async_result.successful():
+            self.errors += 1
+            self._failed.add(filename)
+            logging.getLogger("HWR").error("Could not save snapshot %s: %s", filename,
+                                           async_result.exception)
+
+
+    def pending(self):
+        """
+        Returns the file names not written yet
+        """
+        return self._pending.values()
+
+
+    def failed(self, filename):
+        """
+        Returns True if <filename> is not written yet, or could not be
+        written
+        """
+        return filename in self._failed or filename in self._pending.values()
+
+
+    def join(self, timeout=None):
+        """
+        Waits for the pending writes, at most <timeout> seconds
+
+        :returns: True if all the files were written
+        """
+        pending = self._pending.keys()
+        try:
+            with gevent.Timeout(timeout):
+                for async_result in pending:
+                    async_result.wait()
+                    self._done(async_result)
+        except gevent.Timeout:
+            return False
+        return all([r.successful() for r in pending])
+
+
+_writer = None
+
+def get_writer():
+    global _writer
+    if _writer is None:
+        _writer = SnapshotWriter()
+    return _writer
+
+
+if __name__ == '__main__':
+    # time spent by the data collection greenlet to save 4 snapshots in
+    # the archive directory: sequential writes as before, against the
+    # background writer
+    import sys
+    import time
+    import shutil
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 200 * 1024
+    snapshots = [os.urandom(size) for i in range(4)]
+    directory = tempfile.mkdtemp()
+
+    # the thread pool is started once for the whole session
+    writer = SnapshotWriter()
+    writer.write(os.path.join(directory, "warmup"), "")
+    writer.join()
+
+    t0 = time.time()
+    for i, data in enumerate(snapshots):
+        filename = os.path.join(directory, "before", "sample_1_%d.snapshot.jpeg" % (i + 1))
+        _write_file(filename, data)
+    t1 = time.time()
+    for i, data in enumerate(snapshots):
+        writer.write(os.path.join(directory, "after", "sample_1_%d.snapshot.jpeg" % (i + 1)), data)
+    t2 = time.time()
+    ok = writer.join()
+    t3 = time.time()
+    shutil.rmtree(directory)
+
+    print "4 x %d kB snapshots: %.2f ms before, %.2f ms with the writer (written in %.2f ms, ok: %s)" % \
+          (size / 1024, 1000 * (t1 - t0), 1000 * (t2 - t1), 1000 * (t3 - t1), ok)
@@ -0,0 +1,124 @@
+"""
+CrimsClient against the local stand-in of the CRIMS server
+(Crims._serve_mock_plate), run from the HardwareObjects directory:
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import stat
+import shutil
+import httplib
+import tempfile
+import unittest
+
+import gevent
+import gevent.socket
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "sample_changer"))
+
+import Crims
+
+IMAGE = "JPEG" * 10000
+
+
+class CrimsClientTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server, cls.base_url = Crims._serve_mock_plate(nxtals=8, delay=0.05)
+        cls.plan_url = cls.base_url + "?task=getBarcodeXtalInfos&barcode=%(barcode)s"
+        # cooperative client connections, as in the monkey patched
+        # application, without patching the other tests
+        cls.httplib_socket = httplib.socket
+        httplib.socket = gevent.socket
+
+    @classmethod
+    def tearDownClass(cls):
+        httplib.socket = cls.httplib_socket
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.cache_dir = os.path.join(tempfile.mkdtemp(), "crims_cache")
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.pool.close()
+        shutil.rmtree(os.path.dirname(self.cache_dir))
+
+    def client(self, **kwargs):
+        """
+        New client, the URLs requested from the server are in its
+        <requests> list
+        """
+        kwargs.setdefault("plan_url", self.plan_url)
+        kwargs.setdefault("cache_dir", self.cache_dir)
+        client = Crims.CrimsClient(force_https=False, **kwargs)
+        client.requests = []
+        request = client.pool.request
+
+        def counting_request(url):
+            client.requests.append(url)
+            return request(url)
+
+        client.pool.request = counting_request
+        self.clients.append(client)
+        return client
+
+    def image_url(self, i):
+        return self.base_url + "?task=getImage&xtal=%d" % i
+
+    def test_cache(self):
+        client = self.client()
+        self.assertEqual(client.getURL(self.image_url(0)), IMAGE)
+        self.assertEqual(client.getURL(self.image_url(0)), IMAGE)
+        self.assertEqual(client.requests, [self.image_url(0)])
+
+        # private disk cache, used by a new client
+        self.assertEqual(stat.S_IMODE(os.stat(self.cache_dir).st_mode), 0700)
+        for name in os.listdir(self.cache_dir):
+            self.assertEqual(stat.S_IMODE(os.stat(os.path.join(self.cache_dir, name)).st_mode), 0600)
+
+        client = self.client(cache_items=0)
+        self.assertEqual(client.getURL(self.image_url(0)), IMAGE)
+        self.assertEqual(client.requests, [])
+
+    def test_no_cache_directory(self):
+        client = self.client(cache_dir=None)
+        self.assertEqual(client.getURL(self.image_url(1)), IMAGE)
+        self.assertEqual(client.getURL(self.image_url(1)), IMAGE)
+        self.assertEqual(client.requests, [self.image_url(1)])
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_shared_pending_download(self):
+        client = self.client()
+        readers = [gevent.spawn(client.getURL, self.image_url(2)) for i in range(5)]
+        gevent.joinall(readers, timeout=10)
+
+        self.assertEqual([reader.value for reader in readers], [IMAGE] * 5)
+        self.assertEqual(client.requests, [self.image_url(2)])
+
+    def test_prefetch(self):
+        client = self.client()
+        pp = client.getProcessingPlan("MOCK0001")
+        self.assertEqual(len(pp.Plate.Xtal), 8)
+        client.wait(timeout=10)
+
+        self.assertEqual(sorted(client.requests[1:]), sorted([self.image_url(i) for i in range(8)]))
+
+        # browsing the plate does not request anything
+        del client.requests[:]
+        for xtal in pp.Plate.Xtal:
+            self.assertEqual(client.getURL(client.xtalImageURL(xtal.IMG_URL)), IMAGE)
+        self.assertEqual(client.requests, [])
+
+        # the processing plan is cached for plan_ttl seconds
+        client.getProcessingPlan("MOCK0001")
+        self.assertEqual(client.requests, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+"""
+Characterisation jobs run by DataAnalysis with the fake EDNA command,
+run from the HardwareObjects directory:
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import functools
+
+import gevent
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import DataAnalysis
+from DataAnalysis import CharacterisationJob
+from DataAnalysis import CharacterisationJobManager
+from XSDataMXCuBEv1_3 import XSDataInputMXCuBE
+
+
+class CharacterisationJobsTest(unittest.TestCase):
+    def setUp(self):
+        self.process_directory = tempfile.mkdtemp()
+        self.data_analysis = DataAnalysis.DataAnalysis("data-analysis")
+        self.data_analysis.start_edna_command = \
+          functools.partial(DataAnalysis.fake_edna_command, delay=0.2)
+        self.data_analysis.job_manager = \
+          CharacterisationJobManager(self.data_analysis._run_characterisation)
+        self.finished = []
+
+    def tearDown(self):
+        shutil.rmtree(self.process_directory)
+
+    def edna_input(self):
+        edna_input = XSDataInputMXCuBE()
+        edna_input.process_directory = self.process_directory
+        return edna_input
+
+    def submit(self):
+        return self.data_analysis.submit_characterisation(self.edna_input(),
+                                                          self.finished.append)
+
+    def test_submit(self):
+        job_id = self.submit()
+        self.assertEqual(self.data_analysis.job_manager.status(job_id),
+                         CharacterisationJob.QUEUED)
+
+        result = self.data_analysis.job_manager.result(job_id, timeout=5)
+
+        self.assertEqual(result.getCharacterisationExecutiveSummary().getValue(),
+                         "Fake characterisation of 0 images")
+        self.assertEqual(self.data_analysis.job_manager.status(job_id),
+                         CharacterisationJob.DONE)
+        self.assertEqual([job.id for job in self.finished], [job_id])
+        self.assertTrue(self.finished[0].result is result)
+
+    def test_cancel_queued(self):
+        running_id = self.submit()
+        queued_id = self.submit()
+
+        self.assertTrue(self.data_analysis.cancel_characterisation(queued_id))
+
+        # the callback of a queued job is called right away
+        self.assertEqual([(job.id, job.status) for job in self.finished],
+                         [(queued_id, CharacterisationJob.CANCELLED)])
+
+        self.data_analysis.job_manager.result(running_id, timeout=5)
+        self.assertEqual(self.data_analysis.job_manager.status(running_id),
+                         CharacterisationJob.DONE)
+        self.assertFalse(self.data_analysis.cancel_characterisation(running_id))
+
+    def test_cancel_running(self):
+        job_id = self.submit()
+        gevent.sleep(0.05)
+        self.assertEqual(self.data_analysis.job_manager.status(job_id),
+                         CharacterisationJob.RUNNING)
+
+        self.assertTrue(self.data_analysis.cancel_characterisation(job_id))
+
+        self.assertTrue(self.data_analysis.job_manager.result(job_id, timeout=5) is None)
+        self.assertEqual([(job.id, job.status) for job in self.finished],
+                         [(job_id, CharacterisationJob.CANCELLED)])
+
+    def test_cancel_before_edna_start(self):
+        job = CharacterisationJob(1, self.edna_input())
+        job.status = CharacterisationJob.CANCELLED
+
+        self.assertTrue(self.data_analysis._run_characterisation(job) is None)
+        self.assertTrue(job.edna_thread is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,305 @@
+"""
+Stage timings of the data collection and queue execution.
+
+The instrumented code measures its stages with laps:
+
+    laps = timings.laps("collect")
+    ...
+    laps.lap("lims_store")      # time since laps() or the previous lap
+    ...
+    laps.restart()              # not timed up to here
+    ...
+    laps.lap("snapshots")
+
+or with spans:
+
+    with timings.span("sample.load"):
+        ...
+
+The durations are added to the histograms of the current run, by stage
+name ("collect.lims_store", ...). A run is started by start_run() (the
+queue starts one per execution) and ended by end_run(); the last
+<max_runs> runs are kept, get_timings() gives their statistics
+(count, total, min, max, mean, percentiles, histogram) and the ended
+runs are appended, as a JSON line, to the export file if configured
+(rotated when larger than <max_bytes>).
+
+When disabled (the default), laps() and span() return a shared object
+doing nothing, so that the instrumentation costs a function call per
+stage.
+"""
+
+import time
+import json
+import math
+import logging
+import logging.handlers
+import collections
+
+# bucket i holds the durations in [2**(i-1), 2**i) * BUCKET_BASE s,
+# bucket 0 the durations shorter than BUCKET_BASE
+BUCKET_BASE = 1e-5
+NUM_BUCKETS = 32
+
+
+class Histogram(object):
+    __slots__ = ("count", "total", "min", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * NUM_BUCKETS
+
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if self.max is None or duration > self.max:
+            self.max = duration
+        if duration < BUCKET_BASE:
+            self.buckets[0] += 1
+        else:
+            i = int(math.log(duration / BUCKET_BASE, 2)) + 1
+            self.buckets[min(i, NUM_BUCKETS - 1)] += 1
+
+
+    def percentile(self, fraction):
+        """
+        Upper bound of the bucket holding the <fraction> percentile
+        (limited to the maximum)
+        """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return min(BUCKET_BASE * 2 ** i, self.max)
+        return self.max
+
+
+    def as_dict(self):
+        return {"count": self.count,
+                "total": self.total,
+                "min": self.min,
+                "max": self.max,
+                "mean": self.total / self.count if self.count else None,
+                "p50": self.percentile(0.5),
+                "p90": self.percentile(0.9),
+                "p99": self.percentile(0.99),
+                "buckets": dict([("%g" % (BUCKET_BASE * 2 ** i), count) \
+                                 for i, count in enumerate(self.buckets) if count])}
+
+
+class Run(object):
+    def __init__(self, run_id, label):
+        self.id = run_id
+        self.label = label
+        self.start_time = time.time()
+        self.end_time = None
+        self.histograms = {}
+
+
+    def add(self, name, duration):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.add(duration)
+
+
+    def as_dict(self):
+        return {"id": self.id,
+                "label": self.label,
+                "start_time": self.start_time,
+                "end_time": self.end_time,
+                "stages": dict([(name, histogram.as_dict()) \
+                                for name, histogram in self.histograms.iteritems()])}
+
+
+class Laps(object):
+    __slots__ = ("prefix", "_last")
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._last = time.time()
+
+
+    def restart(self):
+        self._last = time.time()
+
+
+    def lap(self, name):
+        now = time.time()
+        _record("%s.%s" % (self.prefix, name), now - self._last)
+        self._last = now
+
+
+    def __enter__(self):
+        self._last = time.time()
+        return self
+
+
+    def __exit__(self, *args):
+        _record(self.prefix, time.time() - self._last)
+
+
+class _Null(object):
+    __slots__ = ()
+
+    def restart(self):
+        pass
+
+    def lap(self, name):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+_NULL = _Null()
+
+
+_enabled = False
+_runs = collections.deque(maxlen=20)
+_current_run = None
+_run_ids = 0
+_export_logger = None
+
+
+def _record(name, duration):
+    if _current_run is None:
+        start_run("default")
+    _current_run.add(name, duration)
+
+
+def laps(prefix):
+    """
+    Returns laps timing the stages of <prefix>
+    """
+    if not _enabled:
+        return _NULL
+    return Laps(prefix)
+
+
+def span(name):
+    """
+    Returns a context manager timing the stage <name>
+    """
+    if not _enabled:
+        return _NULL
+    return Laps(name)
+
+
+def is_enabled():
+    return _enabled
+
+
+def configure(enabled=None, max_runs=None, export_file=None, max_bytes=1024*1024, backup_count=5):
+    """
+    Enables or disables the timings, sets the number of runs kept and
+    the export file
+    """
+    global _enabled, _runs, _export_logger
+
+    if enabled is not None:
+        _enabled = bool(enabled)
+    if max_runs is not None:
+        _runs = collections.deque(_runs, maxlen=max(1, int(max_runs)))
+    if export_file:
+        handler = logging.handlers.RotatingFileHandler(export_file, maxBytes=int(max_bytes),
+                                                       backupCount=int(backup_count))
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        _export_logger = logging.getLogger("timings_export")
+        _export_logger.propagate = False
+        for old_handler in _export_logger.handlers[:]:
+            _export_logger.removeHandler(old_handler)
+            old_handler.close()
+        _export_logger.addHandler(handler)
+        _export_logger.setLevel(logging.INFO)
+
+
+def start_run(label):
+    """
+    Ends the current run and starts a new one, labelled <label>
+
+    :returns: run id
+    """
+    global _current_run, _run_ids
+    end_run()
+    _run_ids += 1
+    _current_run = Run(_run_ids, label)
+    _runs.append(_current_run)
+    return _current_run.id
+
+
+def end_run():
+    """
+    Ends the current run, and appends it to the export file
+    """
+    global _current_run
+    run = _current_run
+    if run is None:
+        return
+    _current_run = None
+    run.end_time = time.time()
+    if _export_logger is not None and run.histograms:
+        try:
+            _export_logger.info(json.dumps(run.as_dict(), sort_keys=True))
+        except:
+            logging.getLogger("HWR").exception("Could not export the timings")
+
+
+def get_timings(run_id=None):
+    """
+    Returns the statistics of the run <run_id> (latest run if None, all
+    the runs kept if -1)
+    """
+    if run_id == -1:
+        return [run.as_dict() for run in _runs]
+    for run in reversed(_runs):
+        if run_id is None or run.id == run_id:
+            return run.as_dict()
+    return None
+
+
+def clear():
+    global _current_run
+    _current_run = None
+    _runs.clear()
+
+
+if __name__ == '__main__':
+    # cost of an instrumented stage, disabled and enabled
+    import sys
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    def stages(n):
+        for i in xrange(n):
+            frame_laps = laps("frame")
+            frame_laps.lap("prepare")
+            frame_laps.lap("oscillation")
+            frame_laps.lap("bookkeeping")
+
+    t0 = time.time()
+    for i in xrange(n):
+        pass
+    t1 = time.time()
+    stages(n)
+    t2 = time.time()
+    configure(enabled=True)
+    start_run("benchmark")
+    stages(n)
+    t3 = time.time()
+    end_run()
+
+    print "per stage: disabled %.3f us, enabled %.3f us" % \
+          (1e6 * (t2 - t1 - (t1 - t0)) / (3 * n), 1e6 * (t3 - t2 - (t1 - t0)) / (3 * n))
+    print json.dumps(get_timings()["stages"]["frame.oscillation"], indent=2, sort_keys=True)
@@ -0,0 +1,207 @@
+"""
+Shared video frame buffers, for the Lima video hardware objects.
+
+The raw frames read from the camera are copied once into a ring of
+preallocated NumPy buffers, indexed by the Lima frame number; a frame
+whose number did not change since the last read is not stored again.
+
+All the consumers (GUI, snapshots, auto-centring) get the same buffers:
+
+- frame.array is a read-only NumPy view on the raw data, (height, width)
+  or the shape given to publish(),
+  frame.memoryview() a read-only memoryview on it,
+- frame.qimage() converts the frame for display the first time it is
+  called, and returns the same QImage afterwards, so the conversion is
+  done at most once per frame, and only if somebody needs a QImage.
+
+A frame stays valid until its buffer is reused, i.e. while less than
+<size> newer frames were stored; frame.valid tells if it is still the
+case.
+
+Usage:
+
+    hub = FrameHub(4, converter=to_qimage)
+    frame = hub.publish(frame_number, raw_data, width, height, numpy.uint16)
+    if frame is not None:
+        # new frame
+        frame.qimage()
+    ...
+    hub.wait_frame(newer_than=time.time(), timeout=5).array
+"""
+
+import time
+import numpy
+import gevent
+import gevent.event
+
+
+class Frame(object):
+    def __init__(self, hub, index, generation, number, width, height, buffer_array):
+        self._hub = hub
+        self._index = index
+        self._generation = generation
+        self._array = buffer_array
+        self._qimage = None
+        self._converted = False
+        self.number = number
+        self.width = width
+        self.height = height
+        self.timestamp = time.time()
+
+
+    @property
+    def valid(self):
+        return self._hub._generations[self._index] == self._generation
+
+
+    @property
+    def array(self):
+        """
+        Read-only view on the raw frame
+        """
+        if not self.valid:
+            raise ValueError("frame %d was overwritten by a newer frame" % self.number)
+        return self._array
+
+
+    def memoryview(self):
+        return memoryview(self.array)
+
+
+    def qimage(self):
+        """
+        Frame converted for display by the hub converter (None if the
+        conversion failed), computed on the first call only
+        """
+        if not self._converted:
+            self._qimage = self._hub.converter(self)
+            self._converted = True
+        return self._qimage
+
+
+class FrameHub(object):
+    def __init__(self, size=4, converter=None):
+        """
+        <size> is the number of frames kept, <converter> a function giving
+        the QImage of a frame (or None)
+        """
+        self.size = max(int(size), 2)
+        self.converter = converter
+        self._buffers = [None] * self.size
+        self._generations = [0] * self.size
+        self._frames = [None] * self.size
+        self._index = -1
+        self._new_frame = gevent.event.Event()
+
+
+    def publish(self, number, data, width, height, dtype=numpy.uint16, offset=0, shape=None):
+        """
+        Copies the <width> x <height> frame of <dtype> pixels read from
+        <data> (string, buffer or array), starting at byte <offset>, in
+        the next buffer of the ring. <shape> is the shape of the frame
+        array if it is not (height, width), e.g (height, width, 3) for
+        RGB frames.
+
+        :returns: the new frame, or None if frame <number> is already the
+                  latest one (or is invalid, i.e negative)
+        :raises ValueError: if <data> is smaller than the frame
+        """
+        latest = self.latest()
+        if number < 0 or (latest is not None and latest.number == number):
+            return None
+
+        dtype = numpy.dtype(dtype)
+        shape = (height, width) if shape is None else tuple(shape)
+        count = int(numpy.prod(shape))
+        data_size = getattr(data, "nbytes", None)
+        if data_size is None:
+            data_size = len(data)
+        if data_size - offset < count * dtype.itemsize:
+            raise ValueError("frame %d: %d bytes, %d expected for %s %s pixels" % \
+                             (number, data_size - offset, count * dtype.itemsize, shape, dtype))
+
+        index = (self._index + 1) % self.size
+        buffer_array = self._buffers[index]
+        if buffer_array is None or buffer_array.shape != shape or \
+          buffer_array.dtype != dtype:
+            # allocated on the first frame, or when the image format changes
+            buffer_array = numpy.empty(shape, dtype)
+            self._buffers[index] = buffer_array
+
+        buffer_array[...] = numpy.frombuffer(data, dtype, count, offset).reshape(shape)
+
+        view = buffer_array.view()
+        view.flags.writeable = False
+        self._generations[index] += 1
+        frame = Frame(self, index, self._generations[index], number, width, height, view)
+        self._frames[index] = frame
+        self._index = index
+
+        new_frame, self._new_frame = self._new_frame, gevent.event.Event()
+        new_frame.set()
+
+        return frame
+
+
+    def latest(self):
+        """
+        Returns the latest frame, or None if there is none yet
+        """
+        if self._index < 0:
+            return None
+        return self._frames[self._index]
+
+
+    def frames(self):
+        """
+        Returns the valid frames, from the oldest to the latest
+        """
+        if self._index < 0:
+            return []
+        indexes = [(self._index + 1 + i) % self.size for i in range(self.size)]
+        return [self._frames[i] for i in indexes if self._frames[i] is not None]
+
+
+    def wait_frame(self, newer_than=None, timeout=None):
+        """
+        Returns the latest frame if it was stored after the <newer_than>
+        time, otherwise waits for the next one (e.g to get an image taken
+        after a motor move). Raises gevent.Timeout after <timeout> seconds.
+        """
+        with gevent.Timeout(timeout):
+            while True:
+                frame = self.latest()
+                if frame is not None and (newer_than is None or frame.timestamp > newer_than):
+                    return frame
+                self._new_frame.wait()
+
+
+if __name__ == '__main__':
+    # cost per polled frame when half of the polls return the same frame,
+    # and 3 consumers read it: copy + conversion on every poll for each
+    # consumer as before, against the shared ring
+    import sys
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    width, height = 1360, 1024
+    raw = numpy.random.randint(0, 4096, width * height).astype(">u2").tostring()
+
+    def convert(array):
+        # stands for the scaling and Bayer conversion
+        return (array >> 4).astype(numpy.uint8)
+
+    t0 = time.time()
+    for i in range(n):
+        for consumer in range(3):
+            convert(numpy.fromstring(raw, numpy.uint16))
+    t1 = time.time()
+    hub = FrameHub(4, converter=lambda frame: convert(frame.array))
+    for i in range(n):
+        frame = hub.publish(i // 2, raw, width, height)
+        if frame is not None:
+            for consumer in range(3):
+                frame.qimage()
+    t2 = time.time()
+
+    print "%d polls: %.1f ms per poll before, %.1f ms with the frame hub" % \
+          (n, 1000 * (t1 - t0) / n, 1000 * (t2 - t1) / n)
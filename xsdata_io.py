@@ -0,0 +1,460 @@
+"""
+Fast input/output backend for the XSData bindings generated by
+EDGenerateDS (XSDataCommon, XSDataMXv1, XSDataMXCuBEv1_3).
+
+Objects are built directly from the expat events: when an element
+starts, the generated buildChildren of the parent object is given an
+empty probe element. For a complex element, the generated code creates
+the child object and attaches it to its parent, and the build method
+installed here records it instead of reading the probe: the following
+events are built into that object. Only the simple elements (values) are
+read into light nodes providing the part of the minidom interface used
+by the generated buildChildren methods (nodeType, nodeName, childNodes,
+firstChild, nodeValue, toxml), and given to their parent object as soon
+as they are complete. The whole document is never held in memory.
+
+Exports are collected in memory and written to the file in one go.
+
+The generated modules are left as generated: importing this module
+installs the backend in their classes (parseString, parseFile,
+exportToFile, marshal, build) and showIndent functions, see install().
+"""
+
+import xml.parsers.expat
+from xml.dom import Node
+
+import XSDataCommon
+import XSDataMXv1
+import XSDataMXCuBEv1_3
+
+
+def _escape(data):
+    return data.replace("&", "&amp;").replace("<", "&lt;"). \
+        replace("\"", "&quot;").replace(">", "&gt;")
+
+
+class Text(object):
+    __slots__ = ("nodeValue",)
+    nodeType = Node.TEXT_NODE
+    nodeName = "#text"
+    childNodes = ()
+    firstChild = None
+
+    def __init__(self, value):
+        self.nodeValue = value
+
+    def toxml(self):
+        return _escape(self.nodeValue)
+
+
+class Element(object):
+    __slots__ = ("nodeName", "attributes", "childNodes")
+    nodeType = Node.ELEMENT_NODE
+    nodeValue = None
+
+    def __init__(self, name, attributes):
+        self.nodeName = name
+        self.attributes = attributes
+        self.childNodes = []
+
+    @property
+    def firstChild(self):
+        if self.childNodes:
+            return self.childNodes[0]
+        return None
+
+    def toxml(self):
+        attributes = "".join([" %s=\"%s\"" % (name, _escape(self.attributes[name])) \
+                              for name in sorted(self.attributes)])
+        if not self.childNodes:
+            return "<%s%s/>" % (self.nodeName, attributes)
+        return "<%s%s>%s</%s>" % (self.nodeName, attributes,
+            "".join([child.toxml() for child in self.childNodes]), self.nodeName)
+
+
+class Document(object):
+    def __init__(self, document_element):
+        self.documentElement = document_element
+
+
+class Probe(object):
+    """
+    Empty element given to the generated buildChildren methods when an
+    element starts: if the element is complex, the object built from the
+    probe is recorded in <obj> (see _build_for)
+    """
+    __slots__ = ("nodeName", "obj")
+    nodeType = Node.ELEMENT_NODE
+    nodeValue = None
+    attributes = {}
+    childNodes = ()
+    firstChild = None
+
+    def __init__(self, name):
+        self.nodeName = name
+        self.obj = None
+
+    def toxml(self):
+        return "<%s/>" % self.nodeName
+
+
+_complex_children = {}
+
+def _is_complex(cls, name):
+    """
+    Tells if the <name> children of the <cls> objects are complex, from
+    the generated buildChildren of a throwaway object
+    """
+    try:
+        return _complex_children[cls, name]
+    except KeyError:
+        probe = Probe(name)
+        try:
+            cls().buildChildren(probe, name)
+        except Exception:
+            pass
+        _complex_children[cls, name] = probe.obj is not None
+        return probe.obj is not None
+
+
+class _Builder(object):
+    """
+    expat handlers building the light nodes
+    """
+    def __init__(self):
+        self.document_element = None
+        self._stack = []
+        self._text = []
+
+    def parser(self):
+        parser = xml.parsers.expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self.start_element
+        parser.EndElementHandler = self.end_element
+        parser.CharacterDataHandler = self.character_data
+        return parser
+
+    def _flush_text(self):
+        # like minidom, adjacent character data make a single text node
+        if self._text:
+            self._stack[-1].childNodes.append(Text("".join(self._text)))
+            self._text = []
+
+    def start_element(self, name, attributes):
+        self._flush_text()
+        element = Element(name, attributes)
+        if self._stack:
+            self._stack[-1].childNodes.append(element)
+        else:
+            self.document_element = element
+        self._stack.append(element)
+
+    def end_element(self, name):
+        self._flush_text()
+        self._stack.pop()
+
+    def character_data(self, data):
+        if self._stack:
+            self._text.append(data)
+
+
+class _ObjectBuilder(_Builder):
+    """
+    expat handlers building <root_obj> from the document: the complex
+    elements are built into their objects as they start, the simple
+    elements are read into light nodes and given to the buildChildren
+    method of their parent object once complete. The text between the
+    complex elements is dropped, the generated code ignores it.
+    """
+    def __init__(self, root_obj):
+        _Builder.__init__(self)
+        self._objects = []
+        self.root_obj = root_obj
+
+    def start_element(self, name, attributes):
+        if self._stack:
+            # inside a simple element
+            _Builder.start_element(self, name, attributes)
+            return
+        if not self._objects:
+            # document element
+            self._objects.append(self.root_obj)
+            return
+
+        parent = self._objects[-1]
+        local_name = name.split(':')[-1]
+        if _is_complex(parent.__class__, local_name):
+            probe = Probe(name)
+            parent.buildChildren(probe, local_name)
+            if probe.obj is not None:
+                self._objects.append(probe.obj)
+                return
+        self._text = []
+        self._stack.append(Element(name, attributes))
+
+    def end_element(self, name):
+        if not self._stack:
+            self._objects.pop()
+            return
+        self._flush_text()
+        element = self._stack.pop()
+        if not self._stack:
+            self._objects[-1].buildChildren(element, element.nodeName.split(':')[-1])
+
+
+def _parse(builder, source):
+    parser = builder.parser()
+    if isinstance(source, basestring):
+        f = open(source, "rb")
+        try:
+            parser.ParseFile(f)
+        finally:
+            f.close()
+    else:
+        parser.ParseFile(source)
+
+
+def parse(source):
+    """
+    Same as minidom.parse, for the generated build methods
+    """
+    builder = _Builder()
+    _parse(builder, source)
+    return Document(builder.document_element)
+
+
+def parseString(string):
+    """
+    Same as minidom.parseString, for the generated build methods
+    """
+    builder = _Builder()
+    builder.parser().Parse(string, True)
+    return Document(builder.document_element)
+
+
+def buildFile(root_obj, source):
+    """
+    Builds <root_obj> from the document read from <source> (file name or
+    file object), like root_obj.build(minidom.parse(source).documentElement)
+    """
+    _parse(_ObjectBuilder(root_obj), source)
+    return root_obj
+
+
+def buildString(root_obj, string):
+    """
+    Builds <root_obj> from the document in <string>, like
+    root_obj.build(minidom.parseString(string).documentElement)
+    """
+    _ObjectBuilder(root_obj).parser().Parse(string, True)
+    return root_obj
+
+
+class StringBuffer(object):
+    """
+    Write-only replacement for StringIO
+    """
+    def __init__(self):
+        self._chunks = []
+        self.write = self._chunks.append
+
+    def getvalue(self):
+        return "".join(self._chunks)
+
+    def close(self):
+        pass
+
+
+class BufferedFile(StringBuffer):
+    """
+    Output file written in one go when closed
+    """
+    def __init__(self, filename):
+        StringBuffer.__init__(self)
+        self.filename = filename
+
+    def close(self):
+        f = open(self.filename, "w")
+        try:
+            f.write(self.getvalue())
+        finally:
+            f.close()
+        self._chunks = []
+
+
+class NullFile(object):
+    """
+    Output discarding everything, for the export checks of parseString
+    """
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def _show_indent(outfile, level):
+    outfile.write(unicode('    ' * level))
+
+
+def _marshal_for(root_name):
+    # <root_name>: root element name of the generated method, also used
+    # by the subclasses
+    def marshal(self):
+        out = StringBuffer()
+        out.write(unicode('<?xml version="1.0" ?>\n'))
+        self.export(out, 0, name_=root_name)
+        return out.getvalue()
+    return marshal
+
+
+def _export_to_file_for(root_name):
+    def exportToFile(self, _outfileName):
+        outfile = BufferedFile(_outfileName)
+        outfile.write(unicode('<?xml version=\"1.0\" ?>\n'))
+        self.export(outfile, 0, name_=root_name)
+        outfile.close()
+    return exportToFile
+
+
+def _build_for(build):
+    # <build>: generated build method, used for the nodes other than the
+    # probes of the object builder
+    def _build(self, node_):
+        if node_.__class__ is Probe:
+            node_.obj = self
+        else:
+            build(self, node_)
+    return _build
+
+
+def _parse_string(cls, root_name):
+    def parseString(_inString):
+        rootObj = buildString(cls(), _inString)
+        # Check that all minOccurs are obeyed by marshalling the created object
+        rootObj.export(NullFile(), 0, name_=root_name)
+        return rootObj
+    return staticmethod(parseString)
+
+
+def _parse_file(cls):
+    def parseFile(_inFilePath):
+        return buildFile(cls(), _inFilePath)
+    return staticmethod(parseFile)
+
+
+def install(module):
+    """
+    Replaces the minidom/StringIO based methods of the classes generated
+    by EDGenerateDS in <module> by this backend, the output is unchanged.
+    The root element of the exports is named after the generated class,
+    as in the generated code.
+    """
+    module.showIndent = _show_indent
+
+    for cls in vars(module).values():
+        if not isinstance(cls, type) or cls.__module__ != module.__name__:
+            continue
+        if "build" in cls.__dict__:
+            cls.build = _build_for(cls.__dict__["build"])
+        if "parseString" in cls.__dict__:
+            cls.marshal = _marshal_for(cls.__name__)
+            cls.exportToFile = _export_to_file_for(cls.__name__)
+            cls.parseString = _parse_string(cls, cls.__name__)
+            cls.parseFile = _parse_file(cls)
+
+
+for _module in (XSDataCommon, XSDataMXv1, XSDataMXCuBEv1_3):
+    install(_module)
+
+
+if __name__ == '__main__':
+    # Benchmark on an XSDataResultMXCuBE document (given file, or a
+    # generated one with all the elements known to the bindings): minidom
+    # against this backend, and check that both give the same output.
+    import re
+    import sys
+    import time
+    import inspect
+    import tempfile
+    import os
+    from xml.dom import minidom
+    from StringIO import StringIO
+    import XSDataMXCuBEv1_3
+    from XSDataMXCuBEv1_3 import XSDataResultMXCuBE
+
+    def children(cls, _cache={}):
+        # (name, kind, class name) of the elements handled by buildChildren
+        if cls not in _cache:
+            result = []
+            for klass in inspect.getmro(cls):
+                if "buildChildren" not in klass.__dict__:
+                    continue
+                source = inspect.getsource(klass.__dict__["buildChildren"])
+                for block in source.split("nodeName_ == '")[1:]:
+                    name = block[:block.index("'")]
+                    complex_child = re.search(r"obj_ = (\w+)\(\)", block)
+                    if complex_child:
+                        kind = ".append(obj_)" in block and "list" or "complex"
+                        result.append((name, kind, complex_child.group(1)))
+                    elif "ival_ = True" in block:
+                        result.append((name, "simple", "true"))
+                    elif "int(sval_)" in block:
+                        result.append((name, "simple", "42"))
+                    elif "float(sval_)" in block:
+                        result.append((name, "simple", "1.234560e+00"))
+                    else:
+                        result.append((name, "simple", "/data/id29/inhouse/opid291/20150101/RAW_DATA"))
+            _cache[cls] = result
+        return _cache[cls]
+
+    def generate(out, cls, name, level, repeat):
+        out.write("%s<%s>\n" % ("    " * level, name))
+        if level < 12:
+            for child_name, kind, value in children(cls):
+                if kind == "simple":
+                    out.write("%s<%s>%s</%s>\n" % ("    " * (level + 1), child_name, value, child_name))
+                    continue
+                child_cls = getattr(XSDataMXCuBEv1_3, value, None)
+                if child_cls is None:
+                    for module in sys.modules.values():
+                        child_cls = getattr(module, value, None)
+                        if child_cls is not None:
+                            break
+                for i in range(kind == "list" and repeat or 1):
+                    generate(out, child_cls, child_name, level + 1, repeat)
+        out.write("%s</%s>\n" % ("    " * level, name))
+
+    if len(sys.argv) > 1:
+        document = open(sys.argv[1]).read()
+    else:
+        out = StringIO()
+        out.write('<?xml version="1.0" ?>\n')
+        generate(out, XSDataResultMXCuBE, "XSDataResultMXCuBE", 0, 4)
+        document = out.getvalue()
+
+    t0 = time.time()
+    minidom_obj = XSDataResultMXCuBE()
+    minidom_obj.build(minidom.parseString(document).documentElement)
+    t1 = time.time()
+    fast_obj = buildString(XSDataResultMXCuBE(), document)
+    t2 = time.time()
+
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    t3 = time.time()
+    outfile = open(filename, "w")
+    outfile.write(unicode('<?xml version=\"1.0\" ?>\n'))
+    minidom_obj.export(outfile, 0, name_='XSDataResultMXCuBE')
+    outfile.close()
+    minidom_output = open(filename).read()
+    t4 = time.time()
+    fast_obj.exportToFile(filename)
+    t5 = time.time()
+    fast_output = open(filename).read()
+    os.unlink(filename)
+
+    print "document: %d kB" % (len(document) / 1024)
+    print "parse:  minidom %.1f ms, expat %.1f ms" % (1000 * (t1 - t0), 1000 * (t2 - t1))
+    print "export: unbuffered %.1f ms, buffered %.1f ms" % (1000 * (t4 - t3), 1000 * (t5 - t4))
+    print "identical output: %s" % (minidom_output == fast_output)